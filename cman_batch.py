@@ -0,0 +1,231 @@
+import argparse
+import random
+import time
+import numpy as np
+import cman_game as cg
+import cman_game_map as gm
+import cman_bot as cb
+from cman_game import Player, State, MAX_ATTEMPTS
+
+
+class BatchGame:
+    """
+    Many games on the same map held in NumPy arrays and advanced together, for offline simulations
+    (balance testing, bot evaluation). A move applies one direction per game in a single vectorized
+    call and follows the rules of Game.apply_move: walls, point collection, collisions, lives and the
+    win at cman_game.win_score. Game stays the reference, see cross_check.
+    Attributes:
+        size (int): The number of games.
+        positions (ndarray): (size, 2) int32 cells of C-Man and of the Spirit, cells are numbered row by row.
+        collected (ndarray): (size, words) little endian uint64 bitmasks of the collected points, point i in
+                             bit i % 64 of word i // 64.
+        score (ndarray): (size,) int32 collected points.
+        lives (ndarray): (size,) int8 lives left to C-Man.
+        state (ndarray): (size,) int8 State of every game.
+        winner (ndarray): (size,) int8 declared Player, only meaningful while the state is WIN, like Game.winner.
+    """
+
+    def __init__(self, map_path, size):
+        compiled = gm.load_map(map_path)
+        self.map = compiled
+        self.size = size
+        self.cols = compiled.board_dims[1]
+        self.next_cell = np.frombuffer(compiled.next_cell, dtype=np.int32).copy()
+        self.cell_point = np.full(compiled.board_dims[0] * compiled.board_dims[1], -1, dtype=np.int32)
+        self.cell_point[np.frombuffer(compiled.point_cells, dtype=np.int32)] = np.arange(compiled.point_count, dtype=np.int32)
+        self.start = np.array(compiled.start_cells, dtype=np.int32)
+        self.win_score = cg.win_score(compiled.point_count)
+
+        self.positions = np.empty((size, 2), dtype=np.int32)
+        self.collected = np.zeros((size, (compiled.point_count + 63) // 64), dtype='<u8')
+        self.score = np.zeros(size, dtype=np.int32)
+        self.lives = np.zeros(size, dtype=np.int8)
+        self.state = np.zeros(size, dtype=np.int8)
+        self.winner = np.full(size, Player.NONE, dtype=np.int8)
+        self.restart_game()
+
+    def restart_game(self, games=slice(None)):
+        """
+        Restarts games, like Game.restart_game.
+        Parameters:
+            games (index): The games to restart, any NumPy index of the game axis. All of them by default.
+        """
+        self.positions[games] = self.start
+        self.collected[games] = 0
+        self.score[games] = 0
+        self.lives[games] = MAX_ATTEMPTS
+        self.state[games] = State.WAIT
+        self.winner[games] = Player.NONE
+
+    def next_round(self, games=slice(None)):
+        """
+        Moves the players of games back to their starting cells and lets them play, like Game.next_round.
+        """
+        self.positions[games] = self.start
+        self.state[games] = State.START
+
+    def declare_winner(self, games, player):
+        """
+        Declares player the winner of the given games that have no winner yet, like Game.declare_winner.
+        Parameters:
+            games (ndarray): Indices of the games.
+            player (Player): The winner.
+        """
+        games = games[self.state[games] != State.WIN]
+        self.state[games] = State.WIN
+        self.winner[games] = player
+
+    def apply_move(self, player, directions):
+        """
+        Applies one move of a player in every game, like Game.apply_move does for one game.
+        Parameters:
+            player (Player): The player to move.
+            directions (ndarray): (size,) the Direction to move in each game. Other values, such as -1,
+                                  leave the game unchanged like an invalid direction does.
+        Returns:
+            ndarray: (size,) bool, whether the state of each game changed.
+        """
+        directions = np.asarray(directions)
+        if player == Player.CMAN:
+            can_move = (self.state == State.PLAY) | (self.state == State.START)
+        else:
+            can_move = self.state == State.PLAY
+        games = np.flatnonzero(can_move & (directions >= 0) & (directions <= 3))
+        next_cells = self.next_cell[4 * self.positions[games, player] + directions[games]]
+        unblocked = next_cells >= 0
+        games, next_cells = games[unblocked], next_cells[unblocked]
+
+        self.state[games] = State.PLAY
+        self.positions[games, player] = next_cells
+        if player == Player.CMAN:
+            points = self.cell_point[next_cells]
+            on_point = points >= 0
+            point_games, points = games[on_point], points[on_point]
+            words = points >> 6
+            bits = np.left_shift(np.uint64(1), (points & 63).astype(np.uint64))
+            new = (self.collected[point_games, words] & bits) == 0
+            self.collected[point_games[new], words[new]] |= bits[new]
+            self.score[point_games[new]] += 1
+            self.declare_winner(point_games[self.score[point_games] >= self.win_score], Player.CMAN)
+
+        caught = games[self.positions[games, Player.CMAN] == self.positions[games, Player.SPIRIT]]
+        self.lives[caught] -= 1
+        self.declare_winner(caught[self.lives[caught] <= 0], Player.SPIRIT)
+        self.next_round(caught[self.lives[caught] > 0])
+
+        changed = np.zeros(self.size, dtype=bool)
+        changed[games] = True
+        return changed
+
+    def step(self, cman_directions, spirit_directions):
+        """
+        Applies a move of C-Man then a move of the Spirit in every game, the order of a server tick.
+        Parameters:
+            cman_directions (ndarray): (size,) the moves of C-Man, see apply_move.
+            spirit_directions (ndarray): (size,) the moves of the Spirit.
+        """
+        self.apply_move(Player.CMAN, cman_directions)
+        self.apply_move(Player.SPIRIT, spirit_directions)
+
+    def get_winner(self):
+        """
+        Returns:
+            ndarray: (size,) the winner of every game, Player.NONE where no winner was declared, like Game.get_winner.
+        """
+        return np.where(self.state == State.WIN, self.winner, Player.NONE)
+
+    def get_coords(self, player):
+        """
+        Returns:
+            ndarray: (size, 2) the (row, column) of the player in every game.
+        """
+        return np.stack(np.divmod(self.positions[:, player], self.cols), axis=1)
+
+    def get_collected_bytes(self, game):
+        """
+        Returns:
+            bytes: The collected points of one game encoded like Game.get_collected_bytes.
+        """
+        bits = np.unpackbits(self.collected[game].view(np.uint8), bitorder='little')[:self.map.point_count]
+        return np.packbits(bits, bitorder='big').tobytes().ljust(self.map.collected_size, b'\0')
+
+
+def cross_check(map_path, size=256, steps=2000, seed=0, invalid_rate=0.05):
+    """
+    Plays the same moves on a BatchGame and on as many Game instances and compares their state after
+    every move. The moves are chosen by two cman_bot bots per game, so games end with both kinds of win,
+    and some are replaced by invalid directions. Finished games are restarted.
+    Parameters:
+        map_path (str): The map of the games.
+        size (int): The number of games.
+        steps (int): The number of steps, a C-Man then a Spirit move each.
+        seed (int): The seed of the moves.
+        invalid_rate (float): The share of moves replaced by an invalid direction, -1 or 4.
+    Returns:
+        dict: The compared moves, the (game, move) pairs whose state differs (0 when the engines agree)
+              and the games won by C-Man and by the Spirit.
+    """
+    rng = np.random.default_rng(seed)
+    batch = BatchGame(map_path, size)
+    games = [cg.Game(map_path) for _ in range(size)]
+    bots = [[cb.Bot(game, player, rng=random.Random((seed * size + i) * 2 + player)) for i, game in enumerate(games)]
+            for player in (Player.CMAN, Player.SPIRIT)]
+    batch.next_round()
+    for game in games:
+        game.next_round()
+
+    result = {'moves': 0, 'mismatches': 0, 'cman_wins': 0, 'spirit_wins': 0}
+    for _ in range(steps):
+        for player in (Player.CMAN, Player.SPIRIT):
+            directions = np.array([bot.decide() for bot in bots[player]])
+            invalid = rng.random(size) < invalid_rate
+            directions[invalid] = rng.choice([-1, 4], invalid.sum())
+            changed = batch.apply_move(player, directions)
+            winners = batch.get_winner()
+            coords = [batch.get_coords(Player.CMAN), batch.get_coords(Player.SPIRIT)]
+            for i, game in enumerate(games):
+                expected = (game.apply_move(player, int(directions[i])), game.get_current_players_coords(),
+                            game.lives, game.score, game.state, game.get_winner(), game.get_collected_bytes())
+                actual = (bool(changed[i]), [tuple(coords[0][i]), tuple(coords[1][i])],
+                          int(batch.lives[i]), int(batch.score[i]), batch.state[i], winners[i],
+                          batch.get_collected_bytes(i))
+                result['mismatches'] += expected != actual
+            result['moves'] += size
+
+        finished = np.flatnonzero(batch.state == State.WIN)
+        result['cman_wins'] += int((batch.winner[finished] == Player.CMAN).sum())
+        result['spirit_wins'] += int((batch.winner[finished] == Player.SPIRIT).sum())
+        batch.restart_game(finished)
+        batch.next_round(finished)
+        for i in finished:
+            games[i].restart_game()
+            games[i].next_round()
+            bots[Player.CMAN][i].target = None
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-check and time the NumPy batch engine against Game")
+    parser.add_argument('--map', default='map.txt', help="map of the games (default: %(default)s)")
+    parser.add_argument('--games', type=int, default=256, help="games of the cross-check (default: %(default)s)")
+    parser.add_argument('--steps', type=int, default=2000, help="steps of the cross-check (default: %(default)s)")
+    parser.add_argument('--bench-games', type=int, default=100000, help="games of the timing run (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = cross_check(args.map, args.games, args.steps, args.seed)
+    print(f"cross-check: {result['moves']} moves over {args.games} games, {result['cman_wins']} C-Man wins, "
+          f"{result['spirit_wins']} Spirit wins, {result['mismatches']} mismatches")
+
+    rng = np.random.default_rng(args.seed)
+    batch = BatchGame(args.map, args.bench_games)
+    batch.next_round()
+    steps = 100
+    moves = [rng.integers(0, 4, (2, args.bench_games)) for _ in range(steps)]
+    started = time.perf_counter()
+    for cman_directions, spirit_directions in moves:
+        batch.step(cman_directions, spirit_directions)
+    elapsed = time.perf_counter() - started
+    print(f"batch: {2 * steps * args.bench_games / elapsed:,.0f} moves/s over {args.bench_games} games")
+    if result['mismatches']:
+        raise SystemExit(1)
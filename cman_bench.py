@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import shared_libary as sl
+
+STATE_OPCODES = (sl.OPCODE.GAME_STATE_UPDATE, sl.OPCODE.GAME_STATE_KEYFRAME, sl.OPCODE.GAME_STATE_DELTA)
+REJOIN_INTERVAL = 1  # Seconds between two joins while the room of a finished game is still closing
+GRACE_PERIOD = 0.5  # Seconds to wait for the last answers once the clients stop sending
+
+
+class Stats:
+    """
+    Counters shared by all the simulated clients of a benchmark run.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.moves = 0
+        self.answered = 0
+        self.latencies = []
+        self.errors = 0
+        self.games_ended = 0
+
+
+class SimulatedClient(asyncio.DatagramProtocol):
+    """
+    A scripted client speaking the game protocol. Players send a random move at a fixed rate and
+    time how long the server takes to answer it, watchers only receive.
+    Parameters:
+        stats (Stats): The counters to update.
+        server (tuple): The address of the server.
+        role (str): cman, spirit, or watcher.
+        room (str): The room to join.
+        rate (float): Moves per second sent by a player.
+        coalesced (bool): Whether the server answers many moves with a single state (tick mode).
+        delta (bool): Whether to ask for sequenced delta states.
+    """
+
+    def __init__(self, stats, server, role, room, rate, coalesced, delta):
+        self.stats = stats
+        self.server = server
+        self.role = role
+        self.room = room
+        self.rate = rate
+        self.coalesced = coalesced
+        self.delta = delta
+        self.transport = None
+        self.pending = []  # Send times of the moves not answered yet
+        self.playing = False
+        self.running = True
+        self.loop = asyncio.get_running_loop()
+
+    def send(self, message):
+        self.transport.sendto(message)
+        self.stats.sent += 1
+        self.stats.bytes_sent += len(message)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.join()
+        self.loop.call_later(sl.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def join(self):
+        if not self.running or self.playing:
+            return
+        self.send(sl.pack_join_User(self.role, self.room))
+        if self.delta:
+            self.send(sl.pack_resync_User())
+        self.loop.call_later(REJOIN_INTERVAL, self.join)  # Until a state arrives
+
+    def heartbeat(self):
+        if not self.running:
+            return
+        self.send(sl.pack_heartbeat_User())
+        self.loop.call_later(sl.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def move(self):
+        if not self.running or not self.playing:
+            return
+        self.pending.append(time.perf_counter())
+        self.stats.moves += 1
+        self.send(sl.pack_player_movement_User(random.randrange(4)))
+        self.loop.call_later(1 / self.rate, self.move)
+
+    def datagram_received(self, data, addr):
+        now = time.perf_counter()
+        self.stats.received += 1
+        self.stats.bytes_received += len(data)
+        opcode = data[0]
+        if opcode in STATE_OPCODES:
+            if opcode != sl.OPCODE.GAME_STATE_UPDATE:
+                self.send(sl.pack_state_ack_User(sl.STATE_ACK_CODEC.unpack_from(data)[1]))
+            if not self.playing:
+                self.playing = True
+                if self.role != 'watcher':
+                    self.loop.call_later(random.random() / self.rate, self.move)
+            elif self.pending:
+                answered = self.pending if self.coalesced else self.pending[:1]
+                self.stats.latencies.extend(now - sent for sent in answered)
+                self.stats.answered += len(answered)
+                del self.pending[:len(answered)]
+        elif opcode == sl.OPCODE.GAME_END:
+            if self.playing:
+                self.stats.games_ended += 1
+                self.playing = False
+                self.pending.clear()
+                self.loop.call_later(REJOIN_INTERVAL, self.join)
+        elif opcode == sl.OPCODE.ERROR:
+            self.stats.errors += 1
+
+    def error_received(self, exc):
+        self.stats.errors += 1
+
+
+def process_tree_cpu(pid):
+    """
+    Returns the CPU time used by a process and its children so far, from /proc.
+    Parameters:
+        pid (int): The root process.
+    Returns:
+        float: User plus system time in seconds, or None where /proc is not available.
+    """
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    total = 0
+    found = False
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:  # fields[1] is the parent pid
+            total += int(fields[11]) + int(fields[12])  # utime and stime
+            found = True
+    return total / ticks if found else None
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of a sorted list, or None if it is empty.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def to_ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as soc:
+        soc.bind(('localhost', 0))
+        return soc.getsockname()[1]
+
+
+def git_revision(path):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=path,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_clients(args, port, stats):
+    """
+    Runs the simulated clients for the configured duration.
+    """
+    loop = asyncio.get_running_loop()
+    server = ('127.0.0.1', port)
+    coalesced = args.tick_rate > 0
+    clients = []
+    for room in range(args.rooms):
+        roles = ['cman', 'spirit'] + ['watcher'] * (args.watchers // args.rooms + (room < args.watchers % args.rooms))
+        for role in roles:
+            _, client = await loop.create_datagram_endpoint(
+                lambda role=role, room=room: SimulatedClient(stats, server, role, f"bench-{room}", args.rate, coalesced, args.delta),
+                remote_addr=server)
+            clients.append(client)
+
+    await asyncio.sleep(args.duration)
+    for client in clients:
+        client.running = False
+    await asyncio.sleep(GRACE_PERIOD)
+    for client in clients:
+        client.send(sl.pack_quit_User())
+        client.transport.close()
+
+
+def run(args):
+    """
+    Starts the server, runs the clients against it and returns the results.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = args.port or free_port()
+    command = [sys.executable, os.path.join(here, 'cman_server.py'), str(port), '--engine', args.engine,
+               '--workers', str(args.workers), '--tick-rate', str(args.tick_rate)]
+    server = subprocess.Popen(command, cwd=here, stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(args.startup)
+        if server.poll() is not None:
+            raise RuntimeError(f"the server exited with code {server.returncode}")
+        stats = Stats()
+        cpu_start = process_tree_cpu(server.pid)
+        started = time.perf_counter()
+        asyncio.run(run_clients(args, port, stats))
+        elapsed = time.perf_counter() - started
+        cpu_end = process_tree_cpu(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(stats.latencies)
+    server_cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        'label': args.label,
+        'revision': git_revision(here),
+        'python': platform.python_version(),
+        'config': {
+            'rooms': args.rooms, 'watchers': args.watchers, 'rate': args.rate, 'duration': args.duration,
+            'engine': args.engine, 'workers': args.workers, 'tick_rate': args.tick_rate, 'delta': args.delta,
+        },
+        'elapsed_s': elapsed,
+        'datagrams_sent': stats.sent,
+        'datagrams_received': stats.received,
+        'datagrams_per_s': (stats.sent + stats.received) / elapsed,
+        'bytes_sent': stats.bytes_sent,
+        'bytes_received': stats.bytes_received,
+        'moves': stats.moves,
+        'moves_answered': stats.answered,
+        'drops': stats.moves - stats.answered,
+        'latency_ms': {
+            'p50': to_ms(percentile(latencies, 0.50)),
+            'p99': to_ms(percentile(latencies, 0.99)),
+            'max': to_ms(percentile(latencies, 1.0)),
+        },
+        'errors': stats.errors,
+        'games_ended': stats.games_ended,
+        'server_cpu_s': server_cpu,
+        'server_cpu_percent': server_cpu / elapsed * 100 if server_cpu is not None else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="C-Man server load generator and latency benchmark")
+    parser.add_argument('--rooms', type=int, default=10, help="rooms with a C-Man and a Spirit (default: %(default)s)")
+    parser.add_argument('--watchers', type=int, default=50, help="watchers spread over the rooms (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=10, help="moves per second of every player (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default: %(default)s)")
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--tick-rate', type=float, default=0)
+    parser.add_argument('--delta', action='store_true', help="clients ask for sequenced delta states")
+    parser.add_argument('--port', type=int, default=0, help="server port (default: a free port)")
+    parser.add_argument('--startup', type=float, default=1.0, help="seconds to wait for the server to start")
+    parser.add_argument('--label', default=None, help="free text stored with the results")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the random moves")
+    parser.add_argument('-o', '--output', default=None, help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    if args.rooms < 1:
+        parser.error("at least one room is needed")
+    random.seed(args.seed)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + "\n")
+    print(json.dumps(results, indent=2))
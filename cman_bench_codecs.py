@@ -0,0 +1,106 @@
+import argparse
+import json
+import platform
+import timeit
+import shared_libary as sl
+
+STATE = {
+    'freeze': 0,
+    'c_coords': (5, 9),
+    's_coords': (12, 3),
+    'attempts': 2,
+    'collected': bytes([0b10110000, 0, 0x0F, 0, 0x81]),
+}
+NEXT_STATE = dict(STATE, c_coords=(5, 10), collected=bytes([0b10110000, 0, 0x1F, 0, 0x81]))
+V2_POINTS = 200  # A map too large for the legacy game states
+V2_STATE = dict(STATE, collected=(1 << 199 | 1 << 120 | 1 << 7).to_bytes(25, 'big'))  # Sent as a list of indices
+V2_MIDGAME = bytes([0x5A]) * 25  # Half of the points collected, sent as a bitmap
+STATS = {'pid': 1, 'errors': 0, 'packets_in': {'JOIN': 10, 'PLAYER_MOVEMENT': 5000}, 'gauges': {'rooms': 5}}
+
+
+def cases():
+    """
+    Returns:
+        list: (name, statement) of every pack/unpack pair, the unpack functions reading
+              whole datagrams past their opcode like the client and server do.
+    """
+    join = sl.pack_join_User('spirit', 'arena')
+    movement = sl.pack_player_movement_User(2)
+    update = sl.pack_game_state_update_server(STATE)
+    keyframe = sl.pack_game_state_keyframe_server(7, STATE)
+    delta = sl.pack_game_state_delta_server(8, 7, STATE, NEXT_STATE)
+    ack = sl.pack_state_ack_User(8)
+    game_end = sl.pack_game_end_server(1, 3, 17)
+    error = sl.pack_error_server(0x01)
+    update_v2 = sl.pack_game_state_update_v2_server(V2_STATE, V2_POINTS)
+    keyframe_v2 = sl.pack_game_state_keyframe_v2_server(7, V2_STATE, V2_POINTS)
+    game_end_v2 = sl.pack_game_end_v2_server(0, 1, 300)
+    encoding, midgame = sl.pack_collected(V2_MIDGAME, V2_POINTS)
+    stats = sl.pack_stats_server(STATS)
+    profile = sl.pack_profile_User(5)
+    base = sl.unpack_game_state_keyframe_server(memoryview(keyframe), 1)
+    unpacked_delta = sl.unpack_game_state_delta_server(memoryview(delta), 1)
+    collected = base['collected']
+    return [
+        ("pack_join_User", lambda: sl.pack_join_User('spirit', 'arena')),
+        ("unpack_join_user", lambda: sl.unpack_join_user(join, 1)),
+        ("unpack_join_room", lambda: sl.unpack_join_room(join, 1)),
+        ("pack_player_movement_User", lambda: sl.pack_player_movement_User(2)),
+        ("unpack_player_movement_user", lambda: sl.unpack_player_movement_user(movement, 1)),
+        ("pack_quit_User", sl.pack_quit_User),
+        ("pack_game_state_update_server", lambda: sl.pack_game_state_update_server(STATE)),
+        ("unpack_game_state_update_server", lambda: sl.unpack_game_state_update_server(memoryview(update), 1)),
+        ("pack_game_state_keyframe_server", lambda: sl.pack_game_state_keyframe_server(7, STATE)),
+        ("unpack_game_state_keyframe_server", lambda: sl.unpack_game_state_keyframe_server(memoryview(keyframe), 1)),
+        ("pack_game_state_delta_server", lambda: sl.pack_game_state_delta_server(8, 7, STATE, NEXT_STATE)),
+        ("unpack_game_state_delta_server", lambda: sl.unpack_game_state_delta_server(memoryview(delta), 1)),
+        ("apply_game_state_delta", lambda: sl.apply_game_state_delta(base, unpacked_delta)),
+        ("pack_state_ack_User", lambda: sl.pack_state_ack_User(8)),
+        ("unpack_state_ack_user", lambda: sl.unpack_state_ack_user(ack, 1)),
+        ("pack_resync_User", sl.pack_resync_User),
+        ("pack_game_end_server", lambda: sl.pack_game_end_server(1, 3, 17)),
+        ("unpack_game_end_server", lambda: sl.unpack_game_end_server(game_end, 1)),
+        ("pack_error_server", lambda: sl.pack_error_server(0x01)),
+        ("unpack_error_server", lambda: sl.unpack_error_server(error, 1)),
+        ("pack_game_state_update_v2_server", lambda: sl.pack_game_state_update_v2_server(V2_STATE, V2_POINTS)),
+        ("unpack_game_state_update_v2_server", lambda: sl.unpack_game_state_update_v2_server(memoryview(update_v2), 1)),
+        ("pack_game_state_keyframe_v2_server", lambda: sl.pack_game_state_keyframe_v2_server(7, V2_STATE, V2_POINTS)),
+        ("unpack_game_state_keyframe_v2_server",
+         lambda: sl.unpack_game_state_keyframe_v2_server(memoryview(keyframe_v2), 1)),
+        ("pack_collected bitmap", lambda: sl.pack_collected(V2_MIDGAME, V2_POINTS)),
+        ("unpack_collected bitmap", lambda: sl.unpack_collected(midgame, 0, V2_POINTS, encoding)),
+        ("pack_game_end_v2_server", lambda: sl.pack_game_end_v2_server(0, 1, 300)),
+        ("unpack_game_end_v2_server", lambda: sl.unpack_game_end_v2_server(game_end_v2, 1)),
+        ("pack_heartbeat_User", sl.pack_heartbeat_User),
+        ("pack_stats_User", sl.pack_stats_User),
+        ("pack_stats_server", lambda: sl.pack_stats_server(STATS)),
+        ("unpack_stats_server", lambda: sl.unpack_stats_server(stats, 1)),
+        ("pack_profile_User", lambda: sl.pack_profile_User(5)),
+        ("unpack_profile_user", lambda: sl.unpack_profile_user(profile, 1)),
+        ("collected[i] x40", lambda: [collected[i] for i in range(40)]),
+    ]
+
+
+def measure(statement, repeat, number):
+    """
+    Returns:
+        float: The best time of one call over the repeats, in nanoseconds.
+    """
+    return min(timeit.repeat(statement, repeat=repeat, number=number)) / number * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark of the protocol codecs")
+    parser.add_argument('-n', '--number', type=int, default=100000, help="calls per measure (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5, help="measures per codec, the best is kept (default: %(default)s)")
+    parser.add_argument('--label', default=None, help="free text stored with the results")
+    parser.add_argument('-o', '--output', default=None, help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in cases():
+        results[name] = measure(statement, args.repeat, args.number)
+        print(f"{name:<36} {results[name]:8.0f} ns/op")
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'label': args.label, 'python': platform.python_version(), 'ns_per_op': results}) + "\n")
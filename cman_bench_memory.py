@@ -0,0 +1,108 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import time
+import tracemalloc
+import cman_game as cg
+import cman_game_map as gm
+import cman_server as cs
+from cman_game import Player
+
+ACTIVE_MOVES = 60  # Random moves played in every active room, C-Man and the Spirit alternating
+
+
+def make_game(map_path):
+    return cg.Game(map_path)
+
+
+def make_room(map_path):
+    return cs.Room("bench", map_path)
+
+
+TARGETS = {
+    'game': (make_game, lambda game: game),
+    'room': (make_room, lambda room: room.game),
+}
+
+
+def measure(target, count, active, map_path, seed):
+    """
+    Creates rooms and measures the memory they hold with tracemalloc.
+    Parameters:
+        target (str): 'game' for bare Game instances, 'room' for server Rooms with their Game.
+        count (int): The number of rooms to create.
+        active (bool): Whether to start every game and play ACTIVE_MOVES random moves in it.
+        map_path (str): The map of the games.
+        seed (int): The seed of the random moves.
+    Returns:
+        dict: The bytes held per room, the peak while creating them and the time to create one.
+    """
+    factory, game_of = TARGETS[target]
+    rng = random.Random(seed)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    rooms = [factory(map_path) for _ in range(count)]
+    created = time.perf_counter() - started
+    if active:
+        for room in rooms:
+            game = game_of(room)
+            game.next_round()
+            for move in range(ACTIVE_MOVES):
+                game.apply_move(Player(move % 2), rng.randrange(4))
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rooms
+    return {
+        'target': target,
+        'rooms': count,
+        'state': 'active' if active else 'idle',
+        'bytes_per_room': (held - before) / count,
+        'peak_bytes_per_room': (peak - before) / count,
+        'create_us_per_room': created / count * 1e6,
+    }
+
+
+def shared_map_bytes(map_path):
+    """
+    Returns:
+        int: The memory held by the compiled map all the games share, loaded from its cache file if there is one.
+    """
+    gm._compiled_maps.clear()
+    tracemalloc.start()
+    compiled = gm.load_map(map_path)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del compiled
+    return held
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory used per idle and per active room")
+    parser.add_argument('--rooms', type=int, nargs='+', default=[10000, 100000], help="room counts (default: %(default)s)")
+    parser.add_argument('--target', choices=['game', 'room', 'both'], default='both',
+                        help="measure bare Game instances, server Rooms, or both (default: %(default)s)")
+    parser.add_argument('--map', default=cs.MAP_PATH, help="map of the games (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random moves of the active rooms")
+    parser.add_argument('--label', default=None, help="free text stored with the results")
+    parser.add_argument('-o', '--output', default=None, help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    targets = ['game', 'room'] if args.target == 'both' else [args.target]
+    results = {'label': args.label, 'python': platform.python_version(), 'map': args.map,
+               'shared_map_bytes': shared_map_bytes(args.map), 'runs': []}
+    print(f"shared compiled map: {results['shared_map_bytes']} bytes")
+    for target in targets:
+        for count in args.rooms:
+            for active in (False, True):
+                run = measure(target, count, active, args.map, args.seed)
+                results['runs'].append(run)
+                print(f"{target:<5} {count:>7} {run['state']:<7} {run['bytes_per_room']:8.0f} B/room"
+                      f"  peak {run['peak_bytes_per_room']:8.0f} B/room  create {run['create_us_per_room']:6.1f} us/room")
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + "\n")
@@ -0,0 +1,167 @@
+import random
+from array import array
+import cman_game as cg
+from cman_game import Player, Direction
+
+NO_HOP = 0xFF  # Next hop of a cell towards itself or towards an unreachable cell
+UNREACHABLE = 0xFFFF
+FLEE_DISTANCE = 2  # C-Man runs away from the Spirit once it is this close
+RANDOMNESS = 0.1  # Share of random moves, keeps two bots from repeating the same loop forever
+OPPOSITE = (Direction.DOWN, Direction.RIGHT, Direction.UP, Direction.LEFT)
+MAX_WALKABLE_CELLS = 2000  # Largest map bots play on, its tables take about 12 MB and 3 seconds to compute
+
+_tables = {}  # CompiledMap -> NextHopTable
+
+
+class NextHopTable:
+    """
+    All-pairs shortest paths over the walkable cells of a map, computed once with a BFS from every cell.
+    hop(source, target) is the direction of the first move of a shortest path and distance(source, target)
+    its length, both are a single table lookup. The tables hold walkable_cells**2 entries: 3 bytes each.
+    Attributes:
+        walk_index (array): Cell -> index of the cell among the walkable cells, or -1 for walls.
+        walk_cells (array): Index -> cell of the walkable cells.
+    Raises:
+        ValueError: If the map has more than MAX_WALKABLE_CELLS walkable cells.
+    """
+
+    def __init__(self, compiled_map):
+        cell_count = compiled_map.board_dims[0] * compiled_map.board_dims[1]
+        next_cell = compiled_map.next_cell
+        # Walls have next cells too, the walkable cells are the ones a move leads to
+        walkable = {cell for cell in next_cell if cell >= 0}.union(compiled_map.start_cells)
+        self.walk_index = array('i', [-1]) * cell_count
+        self.walk_cells = array('i', sorted(walkable))
+        for index, cell in enumerate(self.walk_cells):
+            self.walk_index[cell] = index
+        size = self.size = len(self.walk_cells)
+        if size > MAX_WALKABLE_CELLS:
+            raise ValueError(f"bots only play on maps of up to {MAX_WALKABLE_CELLS} walkable cells, "
+                             f"this map has {size}.")
+        # Moves are reversible, so a BFS from the target finds the shortest paths of every cell towards it
+        neighbours = [[(direction, self.walk_index[next_cell[4*cell + direction]]) for direction in Direction
+                       if next_cell[4*cell + direction] >= 0] for cell in self.walk_cells]
+        self.hops = bytearray([NO_HOP]) * (size * size)
+        self.distances = array('H', [UNREACHABLE]) * (size * size)
+        for target in range(size):
+            row = target * size
+            self.distances[row + target] = 0
+            frontier = [target]
+            distance = 0
+            while frontier:
+                distance += 1
+                reached = []
+                for closer in frontier:
+                    for direction, index in neighbours[closer]:
+                        if self.distances[row + index] == UNREACHABLE:
+                            self.distances[row + index] = distance
+                            self.hops[row + index] = OPPOSITE[direction]
+                            reached.append(index)
+                frontier = reached
+
+    def hop(self, source, target):
+        """
+        Parameters:
+            source (int): The cell to move from.
+            target (int): The cell to reach.
+        Returns:
+            int: The Direction of the first move towards target, or NO_HOP if there is none.
+        """
+        source, target = self.walk_index[source], self.walk_index[target]
+        return self.hops[target * self.size + source]
+
+    def distance(self, source, target):
+        """
+        Returns:
+            int: The number of moves from source to target, or UNREACHABLE.
+        """
+        source, target = self.walk_index[source], self.walk_index[target]
+        return self.distances[target * self.size + source]
+
+
+def next_hop_table(compiled_map):
+    """
+    Returns the next hop table of a map, computed on first use and shared by every bot playing on it.
+    """
+    table = _tables.get(compiled_map)
+    if table is None:
+        table = _tables[compiled_map] = NextHopTable(compiled_map)
+    return table
+
+
+class Bot:
+    """
+    Plays one side of a game. The Spirit chases C-Man along a shortest path. C-Man walks to the nearest
+    point it has not collected yet and runs away from the Spirit once it comes within FLEE_DISTANCE.
+    A move is a few table lookups. Picking the next point to collect looks at the neighbouring cells, and at
+    every point only when none of them has one.
+    Attributes:
+        game (Game): The game played.
+        player (Player): The side the bot plays.
+        timer (TimerHandle): The scheduled next move, kept by the server driving the bot.
+    """
+
+    def __init__(self, game, player, randomness=RANDOMNESS, rng=None):
+        self.game = game
+        self.player = Player(player)
+        self.randomness = randomness
+        self.rng = rng or random.Random()
+        self.table = next_hop_table(game.map)
+        self.target = None  # The point C-Man walks to
+        self.timer = None
+
+    def positions(self):
+        """
+        Returns:
+            tuple: The cells of C-Man and of the Spirit.
+        """
+        positions = self.game.positions
+        return positions & cg.COORD_MASK, positions >> cg.COORD_BITS & cg.COORD_MASK
+
+    def decide(self):
+        """
+        Returns:
+            int: The Direction of the bot's next move.
+        """
+        if self.rng.random() < self.randomness:
+            return self.rng.randrange(4)
+        cman, spirit = self.positions()
+        if self.player == Player.SPIRIT:
+            direction = self.table.hop(spirit, cman)
+        elif self.table.distance(cman, spirit) <= FLEE_DISTANCE:
+            direction = self.flee(cman, spirit)
+        else:
+            direction = self.table.hop(cman, self.next_target(cman))
+        return self.rng.randrange(4) if direction == NO_HOP else direction
+
+    def flee(self, cman, spirit):
+        """
+        Returns:
+            int: The Direction that takes C-Man furthest from the Spirit.
+        """
+        next_cell = self.game.map.next_cell
+        best, best_distance = NO_HOP, -1
+        for direction in Direction:
+            cell = next_cell[4*cman + direction]
+            if cell >= 0 and self.table.distance(cell, spirit) > best_distance:
+                best, best_distance = direction, self.table.distance(cell, spirit)
+        return best
+
+    def next_target(self, cman):
+        """
+        Returns:
+            int: The cell of the point C-Man walks to, the nearest uncollected one once the last was collected.
+        """
+        masks = self.game.map.cell_point_masks
+        collected = self.game.collected
+        if self.target is None or collected & masks[self.target]:
+            next_cell = self.game.map.next_cell
+            for direction in Direction:  # A point next to C-Man is the nearest, no need to look at the others
+                cell = next_cell[4*cman + direction]
+                if cell >= 0 and masks[cell] and not collected & masks[cell]:
+                    self.target = cell
+                    return cell
+            distance = self.table.distance
+            uncollected = [cell for cell in self.game.map.point_cells if not collected & masks[cell]]
+            self.target = min(uncollected, key=lambda cell: distance(cman, cell), default=cman)
+        return self.target
@@ -1,22 +1,31 @@
+import argparse
+import functools
+import selectors
 import socket
 import sys
 import shared_libary as sl
 import cman_utils as cu
 import time
-import copy
 from cman_game import Player
 
 
-BUFFERSIZE = 1024
+BUFFERSIZE = 65535  # V2 game states grow with the points of the map
+STATE_HISTORY = 64  # Applied states kept as bases for the deltas sent by the server
+REFRESH_RATE = 30  # Frames drawn per second at most, faster updates are coalesced
 FUNCTIONS = {
     # Client messages
     sl.OPCODE.GAME_STATE_UPDATE: sl.unpack_game_state_update_server,
+    sl.OPCODE.GAME_STATE_KEYFRAME: sl.unpack_game_state_keyframe_server,
+    sl.OPCODE.GAME_STATE_UPDATE_V2: sl.unpack_game_state_update_v2_server,
+    sl.OPCODE.GAME_STATE_KEYFRAME_V2: sl.unpack_game_state_keyframe_v2_server,
+    sl.OPCODE.GAME_STATE_DELTA: sl.unpack_game_state_delta_server,
     sl.OPCODE.GAME_END: sl.unpack_game_end_server,
+    sl.OPCODE.GAME_END_V2: sl.unpack_game_end_v2_server,
     sl.OPCODE.ERROR: sl.unpack_error_server
 }
 
 
-def connect_to_server(client_socket, host, port, role):
+def connect_to_server(client_socket, host, port, role, room=None):
     """
     Send a join message to the server with the selected role.
 
@@ -25,19 +34,70 @@ def connect_to_server(client_socket, host, port, role):
     host (str): Server address.
     port (int): Server port.
     role (str): Player role (cman, spirit, or watcher).
+    room (str): Optional room to join, the server picks one when omitted.
     """
-    print(f"Connecting to server at {host}:{port} as {role}...")
-    join_message = sl.pack_join_User(role)
+    print(f"Connecting to server at {host}:{port} as {role}" + (f" in room {room}..." if room else "..."))
+    join_message = sl.pack_join_User(role, room, sl.CAPABILITY.VARIABLE_POINTS)
     client_socket.sendto(join_message, (host, port))
 
 
-def listen_to_server_non_blocking(client_socket):
+class StateSync:
+    """
+    Rebuilds the sequenced game states (keyframes and deltas) sent by the server.
+    Stale and out-of-order states are dropped, every applied state is acknowledged,
+    and a keyframe is requested when a delta refers to a state the client does not have.
+    """
+
+    def __init__(self, client_socket, server_address):
+        self.client_socket = client_socket
+        self.server_address = server_address
+        self.states = {}  # seq -> applied state
+        self.last_seq = 0
+
+    def request_keyframe(self):
+        """
+        Asks the server for a full game state, the server sends deltas only after this request.
+        """
+        self.client_socket.sendto(sl.pack_resync_User(), self.server_address)
+
+    def apply(self, opcode, data):
+        """
+        Applies an unpacked keyframe or delta.
+        Parameters:
+        opcode (int): GAME_STATE_KEYFRAME, GAME_STATE_KEYFRAME_V2 or GAME_STATE_DELTA.
+        data (dict): The unpacked message.
+        Returns:
+        dict: The new game state, or None if the message was stale or could not be applied.
+        """
+        if data['seq'] <= self.last_seq:
+            return None  # Stale or duplicated
+        if opcode != sl.OPCODE.GAME_STATE_DELTA:
+            state = data
+        else:
+            base = self.states.get(data['base_seq'])
+            if base is None:
+                self.request_keyframe()
+                return None
+            state = sl.apply_game_state_delta(base, data)
+
+        self.last_seq = state['seq']
+        self.states[self.last_seq] = state
+        self.states.pop(self.last_seq - STATE_HISTORY, None)
+        self.client_socket.sendto(sl.pack_state_ack_User(self.last_seq), self.server_address)
+        return state
+
+
+def listen_to_server_non_blocking(client_socket, state_sync=None, renderer=None, map_path='map.txt'):
     """
     Non-blocking function to listen for messages from the server and handle them.
 
     Parameters:
     client_socket (socket): The client socket.
+    state_sync (StateSync): Rebuilds the sequenced game states, if the client asked for them.
+    renderer (BoardRenderer): Draws the game states, every state is printed in full when omitted.
+    map_path (str): The map the states are printed on when there is no renderer.
     """
+    show = renderer.update if renderer else functools.partial(print_board, map_path=map_path)
     try:
         message, sender_address = client_socket.recvfrom(BUFFERSIZE)
         opcode = message[0]
@@ -45,16 +105,25 @@ def listen_to_server_non_blocking(client_socket):
         handler = FUNCTIONS.get(opcode, None) #get the handler function for the opcode
 
         if handler:
-            data = handler(message[1:]) #call the handler function with the data
+            data = handler(memoryview(message), 1) #call the handler function with the data, past the opcode
 
-            if opcode == sl.OPCODE.GAME_STATE_UPDATE: 
-                print_board(data)
+            if opcode in (sl.OPCODE.GAME_STATE_UPDATE, sl.OPCODE.GAME_STATE_UPDATE_V2):
+                show(data)
 
-            elif opcode == sl.OPCODE.GAME_END:
+            elif opcode in (sl.OPCODE.GAME_STATE_KEYFRAME, sl.OPCODE.GAME_STATE_KEYFRAME_V2, sl.OPCODE.GAME_STATE_DELTA):
+                state = state_sync.apply(opcode, data) if state_sync else None
+                if state is not None:
+                    show(state)
+
+            elif opcode in (sl.OPCODE.GAME_END, sl.OPCODE.GAME_END_V2):
+                if renderer:
+                    renderer.flush(force=True)
                 cu.clear_print("Game Over, winner", "CMAN" if data['winner'] == Player.CMAN else "SPIRIT" )
                 return False  # Stop the game loop
 
             elif opcode == sl.OPCODE.ERROR:
+                if renderer:
+                    renderer.flush(force=True)
                 cu.clear_print("Error:", data)
                 return False  # Stop the game loop
         else:
@@ -68,15 +137,18 @@ def listen_to_server_non_blocking(client_socket):
     return True
 
 
-def setup_board_from_file():
+@functools.lru_cache(maxsize=None)
+def setup_board_from_file(map_path='map.txt'):
     """
-    Setup the game board from the map.txt file.
+    Setup the game board from the map file. The file is parsed once, later calls return the cached board.
+    Parameters:
+    map_path (str): The path of the map file.
     Returns:
-    list: The initial game board state.
-    list: The indices of the collectible points.
+    tuple: The initial game board state, one tuple of characters per row. Must not be modified.
+    tuple: The indices of the collectible points.
     """
     point_indices = []
-    with open('map.txt', 'r') as file:
+    with open(map_path, 'r') as file:
         init_board = [list(line.strip()) for line in file] 
     for i in range(len(init_board)):
         for j in range(len(init_board[i])):
@@ -84,52 +156,155 @@ def setup_board_from_file():
                 point_indices.append((i,j))
             if init_board[i][j] != 'W': # if not Wall, change to empty (visoualization propuse)
                 init_board[i][j] = ' '
-    return init_board, sorted(point_indices) #return board and point_indices sorted (for predictability, consistency, and efficiency use)
+    #return board and point_indices sorted (for predictability, consistency, and efficiency use)
+    return tuple(tuple(row) for row in init_board), tuple(sorted(point_indices))
 
-def print_board(data):
+
+def board_overlay(data, map_path='map.txt'):
     """
-    Print the game board based on the received data from the server.
+    Computes what is drawn on top of the empty board for a game state.
     Parameters:
     data (dict): The data received from the server.
+    map_path (str): The path of the map file.
+    Returns:
+    dict: (row, column) -> character of the uncollected points, C-Man and the Spirit.
+    list: The status lines shown above the board.
     """
-
     cman_position = data['c_coords'] #get the cman position from the data dictionary
     spirit_position = data['s_coords']  #get the spirit position from the data dictionary
     points_status = (data['collected']) #get the points status from the data dictionary
     attempts = data['attempts'] #get the attempts from the data dictionary
     left_points = 0 
-    default_board_state, collectible_points = setup_board_from_file() #get the default board state and the collectible points
-    board = copy.deepcopy(default_board_state) #copy the default board state to the board
+    _, collectible_points = setup_board_from_file(map_path) #get the collectible points
+    cells = {}
     for i in range(len(collectible_points)): 
         if not points_status[i]: #change_collected
             left_points += 1
-            board[collectible_points[i][0]][collectible_points[i][1]] = 'P' #change the point to P (visual propuse)
-    cu.clear_print()
+            cells[collectible_points[i]] = 'P' #change the point to P (visual propuse)
+    waiting = []
     if 255 == cman_position[0] == cman_position[1]: 
-        print("Waiting for cman")
+        waiting.append("Waiting for cman")
     else:
-        board[cman_position[0]][cman_position[1]] = 'C'
+        cells[tuple(cman_position)] = 'C'
     if 255 == spirit_position[0] == spirit_position[1]:
-        print("Waiting for spirit")
+        waiting.append("Waiting for spirit")
     else:
-        board[spirit_position[0]][spirit_position[1]] = 'S' 
-    print(f"Score: {40 - left_points}")
-    print(f"Left lives: {3 - attempts}")
+        cells[tuple(spirit_position)] = 'S' 
+    status = waiting + [f"Score: {len(collectible_points) - left_points}", f"Left lives: {3 - attempts}"]
+    return cells, status
+
+
+def print_board(data, map_path='map.txt'):
+    """
+    Print the game board based on the received data from the server.
+    Parameters:
+    data (dict): The data received from the server.
+    map_path (str): The path of the map file.
+    """
+    default_board_state, _ = setup_board_from_file(map_path) #get the default board state
+    board = [list(row) for row in default_board_state] #copy the default board state to the board
+    cells, status = board_overlay(data, map_path)
+    for (row, column), char in cells.items():
+        board[row][column] = char
+    cu.clear_print()
+    for line in status:
+        print(line)
     for line in board:
         print("".join(line))
 
 
-def handle_player_input(client_socket, host, port):
+class BoardRenderer:
+    """
+    Draws the game states on an ANSI terminal.
+    The first frame is drawn in full, later frames only redraw the status lines and the board cells
+    that changed (C-Man, the Spirit and the points) with cursor addressed escape sequences.
+    States arriving faster than the refresh rate are coalesced, only the latest one is drawn.
+    """
+    STATUS_LINES = 4  # Two waiting messages at most, the score and the lives
+
+    def __init__(self, map_path='map.txt', refresh_rate=REFRESH_RATE, out=None):
+        self.map_path = map_path
+        self.interval = 1 / refresh_rate
+        self.out = out or sys.stdout
+        self.base, _ = setup_board_from_file(map_path)
+        self.pending = None  # Latest state not drawn yet
+        self.next_draw = 0.0
+        self.cells = None  # Overlay of the frame on screen, None before the first frame
+        self.status = []
+
+    def update(self, data):
+        """
+        Records a new game state, it is drawn by the next flush.
+        """
+        self.pending = data
+
+    def deadline(self):
+        """
+        Returns:
+        float: The time.monotonic() at which the pending state may be drawn, or None if nothing is pending.
+        """
+        return self.next_draw if self.pending is not None else None
+
+    def flush(self, force=False):
+        """
+        Draws the pending state if the refresh interval since the last frame has passed.
+        Parameters:
+        force (bool): Draw the pending state regardless of the refresh interval.
+        """
+        now = time.monotonic()
+        if self.pending is None or (not force and now < self.next_draw):
+            return
+        self.draw(self.pending)
+        self.pending = None
+        self.next_draw = now + self.interval
+
+    def draw(self, data):
+        """
+        Draws a game state, redrawing only what changed since the previous frame.
+        """
+        cells, status = board_overlay(data, self.map_path)
+        status = status + [''] * (self.STATUS_LINES - len(status))
+        parts = []
+        if self.cells is None:
+            parts.append("\033[H\033[J")
+            parts.extend(line + "\n" for line in status)
+            for i, row in enumerate(self.base):
+                parts.append("".join(cells.get((i, j), char) for j, char in enumerate(row)) + "\n")
+        else:
+            for i, line in enumerate(status):
+                if line != self.status[i]:
+                    parts.append(f"\033[{i + 1};1H\033[K{line}")
+            for cell in self.cells.keys() | cells.keys():
+                char = cells.get(cell, self.base[cell[0]][cell[1]])
+                if char != self.cells.get(cell, self.base[cell[0]][cell[1]]):
+                    parts.append(f"\033[{self.STATUS_LINES + cell[0] + 1};{cell[1] + 1}H{char}")
+            parts.append(f"\033[{self.STATUS_LINES + len(self.base) + 1};1H")  # Park the cursor below the board
+        self.cells, self.status = cells, status
+        self.out.write("".join(parts))
+        self.out.flush()
+
+
+KEYS = ['w', 'a', 's', 'd', 'q']
+KEY_DIRECTIONS = {
+    'w': sl.Direction.UP,
+    'a': sl.Direction.LEFT,
+    's': sl.Direction.DOWN,
+    'd': sl.Direction.RIGHT
+}
+
+
+def handle_player_input(client_socket, host, port, input_source):
     """
     Handle user input for player movement or quitting the game.
+    Drains the keys pressed since the last call without blocking, every press is sent as one move.
 
     Parameters:
     client_socket (socket): The client socket.
     host (str): Server address.
     port (int): Server port.
+    input_source (InputSource): The source of the pressed keys.
     """
-    keys = cu.get_pressed_keys(['w', 'a', 's', 'd', 'q']) #get the pressed keys
-
+    keys = input_source.get_keys() #get the pressed keys
 
     if 'q' in keys: #if q is pressed, send a quit message to the server and exit the game
         quit_message = sl.pack_quit_User()
@@ -137,54 +312,82 @@ def handle_player_input(client_socket, host, port):
         cu.clear_print("Exiting game...")
         return False  # Stop the game loop
 
-    direction = None
-    if 'w' in keys:
-        direction = sl.Direction.UP
-    elif 'a' in keys:
-        direction = sl.Direction.LEFT
-    elif 's' in keys:
-        direction = sl.Direction.DOWN
-    elif 'd' in keys:
-        direction = sl.Direction.RIGHT
-
-    if direction is not None:
-        move_message = sl.pack_player_movement_User(direction)
+    for key in keys:
+        move_message = sl.pack_player_movement_User(KEY_DIRECTIONS[key])
         client_socket.sendto(move_message, (host, port))
     return True
 
 
 if __name__ == "__main__":
-    role = 'watcher'
-    host = 'localhost'
-    port = 1337
+    parser = argparse.ArgumentParser(description="C-Man client")
+    parser.add_argument('role', nargs='?', default='watcher', help="cman, spirit, or watcher")
+    parser.add_argument('host', nargs='?', default='localhost', help="server address")
+    parser.add_argument('port', nargs='?', default='1337', help="server port")
+    parser.add_argument('-r', '--room', default=None, help="name of the room to join")
+    parser.add_argument('--map', default='map.txt', help="map file of the server's games (default: %(default)s)")
+    parser.add_argument('--full-state', action='store_true',
+                        help="receive full game states instead of sequenced deltas")
+    parser.add_argument('--input', default='keyboard',
+                        help="source of the key presses: keyboard, stdin, or the path of a script file")
+    parser.add_argument('--refresh-rate', type=float, default=REFRESH_RATE,
+                        help="frames drawn per second at most on terminals (default: %(default)s)")
+    args = parser.parse_args()
+    role = args.role
+    host = args.host
 
-    if len(sys.argv) >= 3: #if the user provides the role and host
-        role = sys.argv[1]
-        host = sys.argv[2]
-
-    if len(sys.argv) == 4: #if the user provides the port in addition to the role and host
-        try:
-            port = int(sys.argv[3])
-        except ValueError:
-            print("Invalid port number")
-            sys.exit(1)
+    try:
+        port = int(args.port)
+    except ValueError:
+        print("Invalid port number")
+        sys.exit(1)
 
     if role not in ['watcher', 'cman', 'spirit']:  
         print("Invalid role")
         sys.exit(1)
 
+    input_source = None
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         client_socket.setblocking(False)  # Set non-blocking mode
-        connect_to_server(client_socket, host, port, role)
+        connect_to_server(client_socket, host, port, role, args.room)
+        state_sync = None
+        if not args.full_state:
+            state_sync = StateSync(client_socket, (host, port))
+            state_sync.request_keyframe()
+
+        renderer = BoardRenderer(args.map, refresh_rate=args.refresh_rate) if sys.stdout.isatty() else None
+        if role != 'watcher':
+            input_source = cu.open_input(args.input, KEYS)
+
+        # Sleep until the server sends something, a key is pressed or a frame is due
+        selector = selectors.DefaultSelector()
+        selector.register(client_socket, selectors.EVENT_READ, 'server')
+        if input_source:
+            selector.register(input_source, selectors.EVENT_READ, 'input')
 
         game_running = True
+        next_heartbeat = time.monotonic() + sl.HEARTBEAT_INTERVAL
         while game_running: #while the game is running
-            game_running = listen_to_server_non_blocking(client_socket)
-            if role != 'watcher' and game_running:
-                game_running = handle_player_input(client_socket, host, port)
+            now = time.monotonic()
+            if now >= next_heartbeat:  # Keep the session alive, watchers may not send anything else
+                client_socket.sendto(sl.pack_heartbeat_User(), (host, port))
+                next_heartbeat = now + sl.HEARTBEAT_INTERVAL
+            deadline = renderer.deadline() if renderer else None
+            deadline = next_heartbeat if deadline is None else min(deadline, next_heartbeat)
+            timeout = max(0.0, deadline - now)
+            for key, _ in selector.select(timeout):
+                if key.data == 'server':
+                    game_running = listen_to_server_non_blocking(client_socket, state_sync, renderer, args.map)
+                elif key.data == 'input':
+                    game_running = handle_player_input(client_socket, host, port, input_source)
+                if not game_running:
+                    break
+            if renderer and game_running:
+                renderer.flush()
             
     except Exception as e:
         cu.clear_print("Error:", e)
     finally:
+        if input_source:
+            input_source.stop()
         client_socket.close()
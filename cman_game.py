@@ -3,7 +3,7 @@ import os
 from enum import IntEnum
 
 MAX_ATTEMPTS = 3
-WIN_SCORE = 32
+WIN_SCORE = 32	# Score C-Man wins with on a map of gm.MAX_POINTS points, other maps scale it
 
 class Player(IntEnum):
 	NONE = -1	# Error value for functions returning a Player value.
@@ -22,7 +22,29 @@ class State(IntEnum):
 	PLAY = 2	# Round has started
 	WIN = 3		# Game ended
 
+def win_score(point_count):
+	"""
+
+	Returns:
+
+	int: The score C-Man wins with on a map of point_count points, WIN_SCORE scaled to the map and rounded up
+
+	"""
+	return (point_count * WIN_SCORE + gm.MAX_POINTS - 1) // gm.MAX_POINTS
+
+COORD_BITS = 16	# Bits of a cell number in the packed player positions, maps have less than 2**16 cells
+COORD_MASK = (1 << COORD_BITS) - 1
+
 class Game():
+	"""
+
+	The state of a single game, kept compact so a server can hold many idle rooms: the static map is
+	shared (see cman_game_map.CompiledMap), the player positions are packed into a single int of cell
+	numbers and the points are a bitmask. The coordinates and points dict of the API are built on demand.
+
+	"""
+	__slots__ = ('map', 'positions', 'collected', 'score', 'lives', 'state', 'winner', 'version', 'win_score')
+
 	def __init__(self, map_path):
 		"""
 
@@ -34,17 +56,9 @@ class Game():
 
 		"""
 		assert os.path.isfile(map_path), "map file does not exist."
-		self.board = gm.read_map(map_path).split('\n')
-		self.board_dims = (len(self.board), len(self.board[0]))
-
-		self.start_coords = []
-		for p_char in gm.PLAYER_CHARS:
-			start_row = [p_char in row for row in self.board].index(True)
-			self.start_coords.append((start_row, self.board[start_row].index(p_char)))
-
-		self.points = {(i,j):1 for i in range(self.board_dims[0])
-							   for j in range(self.board_dims[1])
-							   if self.board[i][j] == gm.POINT_CHAR}
+		self.map = gm.load_map(map_path)	# Shared by every game played on the map
+		self.win_score = win_score(self.map.point_count)
+		self.version = 0	# Bumped on every change of the game state
 		self.restart_game()
 
 	def restart_game(self):
@@ -53,14 +67,13 @@ class Game():
 		Restarts all the variables of this game instance to their initial values.
 
 		"""
-		self.cur_coords = self.start_coords[::]
-		print(self.cur_coords)
-		self.score = 0
-		for p in self.points.keys():
-			self.points[p] = 1
+		self.positions = self.start_positions()
+		self.collected = 0
+		self.score = 0	# C-Man's score, the number of collected points, counted as they are collected
 		self.lives = MAX_ATTEMPTS
 		self.state = State.WAIT
 		self.winner = None
+		self.version += 1
 
 	def next_round(self):
 		"""
@@ -68,8 +81,22 @@ class Game():
 		Moves all player coordinates to their starting coordinates and enable legal moves to be processed.
 
 		"""
-		self.cur_coords = self.start_coords[::]
+		self.positions = self.start_positions()
 		self.state = State.START
+		self.version += 1
+
+	def start_positions(self):
+		"""
+
+		Returns:
+
+		int: The starting cells of the players packed like self.positions, player i in bits COORD_BITS*i and up
+
+		"""
+		positions = 0
+		for player, cell in enumerate(self.map.start_cells):
+			positions |= cell << (COORD_BITS * player)
+		return positions
 
 	def get_current_players_coords(self):
 		"""
@@ -79,7 +106,9 @@ class Game():
 		list(tuple(int, int)): A list with the current coordinates of each player in this game instance
 
 		"""
-		return self.cur_coords
+		cell_coords = self.map.cell_coords
+		positions = self.positions
+		return [cell_coords[positions >> (COORD_BITS * player) & COORD_MASK] for player in range(len(self.map.start_cells))]
 
 	def get_game_progress(self):
 		"""
@@ -101,7 +130,31 @@ class Game():
 		Collected points will have a value of 0, uncollected will have a value of 1
 
 		"""
-		return self.points
+		collected = self.collected
+		size = 8 * self.map.collected_size
+		return {p: (~collected >> (size - 1 - i)) & 1 for i, p in enumerate(self.map.points)}
+
+	def get_version(self):
+		"""
+		
+		Returns:
+
+		int: A number that changes whenever the state of this game instance changes
+
+		"""
+		return self.version
+
+	def get_collected_bytes(self):
+		"""
+		
+		Returns:
+
+		bytes: The collected points of this game instance as a bitmap, one bit per point in the order of get_points
+
+		A collected point has its bit set to 1, an uncollected point to 0
+
+		"""
+		return self.collected.to_bytes(self.map.collected_size, 'big')
 
 	def get_winner(self):
 		"""
@@ -133,6 +186,7 @@ class Game():
 		if self.state != State.WIN:
 			self.state = State.WIN
 			self.winner = player
+			self.version += 1
 		return self.get_winner()
 
 	def can_move(self, player):
@@ -170,24 +224,27 @@ class Game():
 		if not self.can_move(player):
 			return False
 
-		p_coords = self.cur_coords[player]
-		dr = -1 if direction == Direction.UP else 1 if direction == Direction.DOWN else 0
-		dc = -1 if direction == Direction.LEFT else 1 if direction == Direction.RIGHT else 0
-		next_coords = (p_coords[0] + dr, p_coords[1] + dc)
-
-		if any(x < 0 for x in next_coords) or next_coords[0] >= self.board_dims[0] or next_coords[1] >= self.board_dims[1]:
+		if not 0 <= direction <= 3:
 			return False
-		if self.board[next_coords[0]][next_coords[1]] not in gm.PASS_CHARS:
+		shift = COORD_BITS * player
+		positions = self.positions
+		next_cell = self.map.next_cell[4*(positions >> shift & COORD_MASK) + direction]
+
+		if next_cell < 0:
 			return False
 		else:
 			self.state = State.PLAY
-			self.cur_coords[player] = next_coords
-			if player == Player.CMAN and next_coords in self.points.keys():
-				self.score += self.points[next_coords]
-				self.points[next_coords] = 0
-				if self.score >= WIN_SCORE:
-					self.declare_winner(Player.CMAN)
-			if (player == Player.CMAN and next_coords in self.cur_coords[1:]) or (player != Player.CMAN and next_coords == self.cur_coords[0]):
+			positions = positions & ~(COORD_MASK << shift) | next_cell << shift
+			self.positions = positions
+			self.version += 1
+			point_mask = self.map.cell_point_masks[next_cell]
+			if player == Player.CMAN and point_mask:
+				if not self.collected & point_mask:
+					self.collected |= point_mask
+					self.score += 1
+					if self.score >= self.win_score:
+						self.declare_winner(Player.CMAN)
+			if positions & COORD_MASK == positions >> COORD_BITS:	# C-Man and the Spirit share a cell
 				self.lives -= 1
 				if self.lives <= 0:
 					self.declare_winner(Player.SPIRIT)
@@ -1,3 +1,9 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
 CMAN_CHAR = 'C'
 SPIRIT_CHAR = 'S'
 PLAYER_CHARS = [CMAN_CHAR, SPIRIT_CHAR]
@@ -5,7 +11,13 @@ POINT_CHAR = 'P'
 FREE_CHAR = 'F'
 PASS_CHARS = [CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, FREE_CHAR]
 WALL_CHAR = 'W'
-MAX_POINTS = 40
+MAX_POINTS = 40  # Points of the standard map, the most a fixed size (legacy) game state carries
+MAX_MAP_POINTS = 0xFFFF  # Points are numbered with 16 bits on the wire
+CACHE_SUFFIX = '.cmap'  # Compiled maps are cached next to their source
+CACHE_MAGIC = b'CMANM\x01'
+# Magic, byte order of the tables, source mtime in ns, source size, rows, columns, points, C-Man and Spirit start cells.
+# The header is followed by the native int32 tables next_cell (4 per cell) and point_cells (1 per point).
+CACHE_HEADER = struct.Struct('=6scxQQHHIII')
 
 def read_map(path):
     """
@@ -24,7 +36,7 @@ def read_map(path):
         assert map_chars.issubset({CMAN_CHAR, SPIRIT_CHAR, POINT_CHAR, WALL_CHAR, FREE_CHAR, '\n'}), "invalid char in map."
         assert map_data.count(CMAN_CHAR) == 1, "Map needs to have a single C-Man starting point."
         assert map_data.count(SPIRIT_CHAR) == 1, "Map needs to have a single Spirit starting point."
-        assert map_data.count(POINT_CHAR) == MAX_POINTS, f"Map needs to have {MAX_POINTS} score points."
+        assert 0 < map_data.count(POINT_CHAR) <= MAX_MAP_POINTS, f"Map needs to have between 1 and {MAX_MAP_POINTS} score points."
 
         map_lines = map_data.split('\n')
         assert all(len(line) == len(map_lines[0]) for line in map_lines), "map is not square."
@@ -36,4 +48,153 @@ def read_map(path):
         bbc = map_lines[0] == WALL_CHAR*len(map_lines[0]) and map_lines[-1] == WALL_CHAR*len(map_lines[-1])
         assert sbc and tbc and bbc, "map border is open."
 
-        return map_data
\ No newline at end of file
+        return map_data
+
+
+class CompiledMap:
+    """
+
+    An immutable map compiled for the game logic, shared by every game played on it.
+
+    Cells are numbered row by row. next_cell[4*cell + direction] is the cell a move in that direction
+    leads to, or -1 if the move is blocked, and point_cells lists the cell of every point in map order.
+    Both tables are views of a memory-mapped cache file when one could be used, so the processes
+    serving the same map share their pages.
+
+    """
+    __slots__ = ('path', 'board_dims', 'start_cells', 'start_coords', 'next_cell', 'point_cells',
+                 'point_count', 'points', 'cell_coords', 'cell_point_masks', 'collected_size', '_buffer')
+
+    def __init__(self, path, rows, cols, start_cells, next_cell, point_cells, buffer=None):
+        self.path = path
+        self.board_dims = (rows, cols)
+        self.start_cells = tuple(start_cells)
+        self.next_cell = next_cell
+        self.point_cells = point_cells
+        self.point_count = len(point_cells)
+        self.cell_coords = tuple((i, j) for i in range(rows) for j in range(cols))
+        self.start_coords = tuple(self.cell_coords[cell] for cell in self.start_cells)
+        self.points = tuple(self.cell_coords[cell] for cell in point_cells)
+        # Collected points are a bitmask, the first point in the map is the most significant bit
+        self.collected_size = (self.point_count + 7) // 8
+        masks = [0] * (rows * cols)
+        for index, cell in enumerate(point_cells):
+            masks[cell] = 1 << (8*self.collected_size - 1 - index)
+        self.cell_point_masks = tuple(masks)
+        self._buffer = buffer  # Keeps the mapped cache file open
+
+    @classmethod
+    def compile(cls, path):
+        """
+
+        Reads, validates and compiles a textual map.
+
+        Parameters:
+
+        path (str): path to the textual map file
+
+        """
+        board = read_map(path).split('\n')
+        rows, cols = len(board), len(board[0])
+        start_cells = []
+        for p_char in PLAYER_CHARS:
+            start_row = [p_char in row for row in board].index(True)
+            start_cells.append(start_row*cols + board[start_row].index(p_char))
+
+        next_cell = array('i', [-1]) * (4 * rows * cols)
+        for i in range(rows):
+            for j in range(cols):
+                for direction, (dr, dc) in enumerate(((-1, 0), (0, -1), (1, 0), (0, 1))):  # UP, LEFT, DOWN, RIGHT
+                    ni, nj = i + dr, j + dc
+                    if 0 <= ni < rows and 0 <= nj < cols and board[ni][nj] in PASS_CHARS:
+                        next_cell[4*(i*cols + j) + direction] = ni*cols + nj
+        point_cells = array('i', (i*cols + j for i in range(rows) for j in range(cols) if board[i][j] == POINT_CHAR))
+        return cls(path, rows, cols, start_cells, next_cell, point_cells)
+
+    def save(self, cache_path, source_stat):
+        """
+
+        Writes the compiled map to a cache file, atomically.
+
+        Parameters:
+
+        cache_path (str): path of the cache file
+
+        source_stat (os.stat_result): the stat of the textual map the cache is valid for
+
+        """
+        header = CACHE_HEADER.pack(CACHE_MAGIC, sys.byteorder[0].encode(), source_stat.st_mtime_ns, source_stat.st_size,
+                                   *self.board_dims, self.point_count, *self.start_cells)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            f.write(bytes(self.next_cell))
+            f.write(bytes(self.point_cells))
+        os.replace(temp_path, cache_path)
+
+    @classmethod
+    def load(cls, path, cache_path, source_stat):
+        """
+
+        Memory-maps a cache file written by save.
+
+        Returns:
+
+        CompiledMap: The compiled map, or None if the cache is missing or does not match the textual map.
+
+        """
+        try:
+            with open(cache_path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buffer) < CACHE_HEADER.size:
+            buffer.close()
+            return None
+        magic, byteorder, mtime_ns, size, rows, cols, point_count, *start_cells = CACHE_HEADER.unpack_from(buffer)
+        next_cell_end = CACHE_HEADER.size + 4 * (4 * rows * cols)
+        if (magic, byteorder, mtime_ns, size) != (CACHE_MAGIC, sys.byteorder[0].encode(), source_stat.st_mtime_ns, source_stat.st_size) \
+                or len(buffer) != next_cell_end + 4 * point_count:
+            buffer.close()
+            return None
+        view = memoryview(buffer)
+        next_cell = view[CACHE_HEADER.size:next_cell_end].cast('i')
+        point_cells = view[next_cell_end:].cast('i')
+        return cls(path, rows, cols, start_cells, next_cell, point_cells, buffer)
+
+
+_compiled_maps = {}  # Absolute path -> (source mtime in ns, source size, CompiledMap)
+
+def load_map(path):
+    """
+
+    Returns the compiled map of a textual map file. A map is compiled once per process and shared by
+    all the games played on it. The compiled tables are cached in a binary file next to the map
+    (path + CACHE_SUFFIX) which is memory-mapped by the next processes, the textual map is only parsed
+    again when it changed. Directories the cache cannot be written to only lose the cache.
+
+    Parameters:
+
+    path (str): path to the textual map file
+
+    Returns:
+
+    CompiledMap: The shared compiled map
+
+    """
+    source_stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = _compiled_maps.get(key)
+    if cached is not None and cached[:2] == (source_stat.st_mtime_ns, source_stat.st_size):
+        return cached[2]
+
+    cache_path = path + CACHE_SUFFIX
+    compiled = CompiledMap.load(path, cache_path, source_stat)
+    if compiled is None:
+        compiled = CompiledMap.compile(path)
+        try:
+            compiled.save(cache_path, source_stat)
+        except OSError:
+            pass
+    _compiled_maps[key] = (source_stat.st_mtime_ns, source_stat.st_size, compiled)
+    return compiled
@@ -0,0 +1,215 @@
+import argparse
+import mmap
+import struct
+import sys
+import time
+import cman_game as cg
+
+MAGIC = b'CMANJ\x01'
+HEADER = struct.Struct('>6sd')  # Magic, wall clock time the journal was started at
+RECORD = struct.Struct('>BIQ')  # Kind, room id, microseconds since the journal was started
+MOVE_RECORD = struct.Struct('>BIQBB')  # RECORD followed by the player and the direction
+STRING_LENGTH = struct.Struct('>H')
+FLUSH_INTERVAL = 1  # Seconds between two writes of the buffered records
+FLUSH_SIZE = 64 * 1024  # Buffered bytes that are written right away
+
+
+# Kinds of the journal records and the format of their payload
+class RECORD_KIND:
+    ROOM = 0x01  # '>H' name length, name, '>H' map path length, map path: a room and its game were created
+    MOVE = 0x02  # '>BB' player, direction: a move the game accepted
+    NEXT_ROUND = 0x03  # Both players joined, the round started
+    WINNER = 0x04  # '>B' player: a winner was declared because the other player quit
+    GAME_END = 0x05  # '>BHB' winner, C-Man score, C-Man lives: the game ended, as announced to the clients
+    CLOSE = 0x06  # The room was closed
+
+
+PAYLOADS = {
+    RECORD_KIND.MOVE: struct.Struct('>BB'),
+    RECORD_KIND.WINNER: struct.Struct('>B'),
+    RECORD_KIND.GAME_END: struct.Struct('>BHB'),
+}
+
+
+class Journal:
+    """
+    Appends the inputs the rooms accepted and their lifecycle events to a binary file.
+    Records are packed into a memory buffer and written by a scheduler timer, or once the buffer
+    is large, so journaling does not add a write per move. Game is deterministic given the order
+    of its calls, so the journal is enough to replay every game, see replay.
+    Attributes:
+        path (str): The path of the journal file.
+        buffer (bytearray): The records not written yet.
+    """
+
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.file = open(path, 'wb')
+        self.started = clock()
+        self.buffer = bytearray(HEADER.pack(MAGIC, time.time()))
+        self.room_counter = 0
+        self.flush_timer = None
+
+    def micros(self):
+        return int((self.clock() - self.started) * 1000000)
+
+    def open_room(self, name, map_path):
+        """
+        Records the creation of a room.
+        Parameters:
+            name (str): The name of the room.
+            map_path (str): The map of the room's game.
+        Returns:
+            int: The id the records of the room refer to.
+        """
+        self.room_counter += 1
+        self.buffer += RECORD.pack(RECORD_KIND.ROOM, self.room_counter, self.micros())
+        for text in (name, map_path):
+            data = text.encode('utf-8')
+            self.buffer += STRING_LENGTH.pack(len(data)) + data
+        return self.room_counter
+
+    def record_move(self, room_id, player, direction):
+        """
+        Records a move the game of a room accepted.
+        """
+        self.buffer += MOVE_RECORD.pack(RECORD_KIND.MOVE, room_id, self.micros(), player, direction)
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+    def record(self, room_id, kind, *fields):
+        """
+        Records a lifecycle event of a room.
+        Parameters:
+            room_id (int): The id returned by open_room.
+            kind (int): The RECORD_KIND of the event.
+            fields (int): The payload of the event, see RECORD_KIND.
+        """
+        self.buffer += RECORD.pack(kind, room_id, self.micros())
+        if fields:
+            self.buffer += PAYLOADS[kind].pack(*fields)
+
+    def flush(self):
+        """
+        Writes the buffered records to the file.
+        """
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+
+    def flush_periodically(self, scheduler):
+        """
+        Flushes the journal every FLUSH_INTERVAL seconds from the server loop.
+        Parameters:
+            scheduler (Scheduler): The scheduler of the server loop.
+        """
+        self.flush()
+        self.flush_timer = scheduler.call_later(FLUSH_INTERVAL, self.flush_periodically, scheduler)
+
+    def close(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        self.flush()
+        self.file.close()
+
+
+def read_records(data):
+    """
+    Iterates over the records of a journal without copying it.
+    Parameters:
+        data (buffer): The content of the journal, such as an mmap.
+    Yields:
+        tuple: The kind, room id and time in microseconds of every record followed by its payload.
+               A ROOM record carries the room name and map path, the other kinds their PAYLOADS fields.
+    Raises:
+        ValueError: If data is not a journal.
+    """
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        raise ValueError("not a C-Man journal")
+    offset = HEADER.size
+    end = len(data) - RECORD.size
+    while offset <= end:
+        kind, room_id, micros = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if kind == RECORD_KIND.ROOM:
+            texts = []
+            for _ in range(2):
+                if offset + STRING_LENGTH.size > len(data):
+                    return  # Cut while being written
+                length = STRING_LENGTH.unpack_from(data, offset)[0]
+                if offset + 2 + length > len(data):
+                    return
+                texts.append(bytes(data[offset + 2:offset + 2 + length]).decode('utf-8'))
+                offset += 2 + length
+            yield (kind, room_id, micros, *texts)
+        elif kind in PAYLOADS:
+            payload = PAYLOADS[kind]
+            if offset + payload.size > len(data):
+                return  # Cut while being written
+            yield (kind, room_id, micros, *payload.unpack_from(data, offset))
+            offset += payload.size
+        else:
+            yield (kind, room_id, micros)
+
+
+def replay(path, map_path=None):
+    """
+    Re-runs every game of a journal through Game as fast as possible.
+    Parameters:
+        path (str): The path of the journal file.
+        map_path (str): The map to use instead of the recorded ones, for journals made in another directory.
+    Returns:
+        dict: Counts of the replayed records, moves, rooms and game ends, the game ends whose
+              winner, score or lives differ from the recorded ones, and the replay speed.
+    """
+    games = {}
+    result = {'records': 0, 'moves': 0, 'rooms': 0, 'game_ends': 0, 'mismatches': 0}
+    started = time.perf_counter()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for record in read_records(data):
+            kind, room_id = record[0], record[1]
+            result['records'] += 1
+            if kind == RECORD_KIND.MOVE:
+                games[room_id].apply_move(record[3], record[4])
+                result['moves'] += 1
+            elif kind == RECORD_KIND.ROOM:
+                games[room_id] = cg.Game(map_path or record[4])
+                result['rooms'] += 1
+            elif kind == RECORD_KIND.NEXT_ROUND:
+                games[room_id].next_round()
+            elif kind == RECORD_KIND.WINNER:
+                games[room_id].declare_winner(record[3])
+            elif kind == RECORD_KIND.GAME_END:
+                game = games[room_id]
+                result['game_ends'] += 1
+                if (game.get_winner(), game.score, game.lives) != tuple(record[3:]):
+                    result['mismatches'] += 1
+            elif kind == RECORD_KIND.CLOSE:
+                games.pop(room_id, None)
+    elapsed = time.perf_counter() - started
+    result['elapsed_s'] = elapsed
+    result['moves_per_s'] = result['moves'] / elapsed if elapsed else None
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay a C-Man server journal")
+    parser.add_argument('command', choices=['replay', 'dump'])
+    parser.add_argument('path', help="journal file written with the server's --journal option")
+    parser.add_argument('--map', default=None, help="map to replay the games on instead of the recorded ones")
+    args = parser.parse_args()
+
+    kind_names = {value: name for name, value in vars(RECORD_KIND).items() if not name.startswith('_')}
+    try:
+        if args.command == 'replay':
+            for key, value in replay(args.path, args.map).items():
+                print(f"{key}: {value}")
+        else:
+            with open(args.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for kind, room_id, micros, *fields in read_records(data):
+                    print(f"{micros / 1000000:12.6f} room {room_id:<6} {kind_names.get(kind, kind):<10} {' '.join(map(str, fields))}")
+    except (OSError, ValueError) as e:
+        print("Error: ", e)
+        sys.exit(1)
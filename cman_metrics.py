@@ -0,0 +1,219 @@
+import argparse
+import bisect
+import json
+import os
+import socket
+import sys
+import time
+from collections import defaultdict
+import shared_libary as sl
+
+# Upper bounds of the handler latency buckets, in seconds. The last bucket counts everything slower.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+OPCODE_NAMES = {value: name for name, value in vars(sl.OPCODE).items() if not name.startswith('_')}
+STATS_BUFFERSIZE = 65535
+
+
+def opcode_name(opcode):
+    return OPCODE_NAMES.get(opcode, f"0x{opcode:02X}")
+
+
+class Histogram:
+    """
+    Counts latencies in the fixed LATENCY_BUCKETS, recording one is a bisect and an increment.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The count, mean and max in milliseconds, and the count of every bucket
+                  keyed by its upper bound in milliseconds.
+        """
+        bounds = [f"{bound * 1000:g}" for bound in LATENCY_BUCKETS] + ['inf']
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else None,
+            'max_ms': self.max * 1000,
+            'buckets_ms': dict(zip(bounds, self.counts)),
+        }
+
+
+class Metrics:
+    """
+    Counters of a server process: datagrams and bytes in and out per opcode, handler latency
+    per opcode, loop wakeups and errors. Gauges such as the number of rooms are passed in
+    when a snapshot is taken, so they cost nothing between scrapes.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.packets_in = defaultdict(int)
+        self.bytes_in = defaultdict(int)
+        self.packets_out = defaultdict(int)
+        self.bytes_out = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self.wakeups = 0
+        self.errors = 0
+
+    def record_in(self, opcode, size, seconds):
+        """
+        Records a handled datagram.
+        Parameters:
+            opcode (int): The opcode of the datagram.
+            size (int): The size of the datagram in bytes.
+            seconds (float): The time spent handling it.
+        """
+        self.packets_in[opcode] += 1
+        self.bytes_in[opcode] += size
+        self.latency[opcode].record(seconds)
+
+    def record_out(self, opcode, size):
+        """
+        Records a sent datagram.
+        Parameters:
+            opcode (int): The opcode of the datagram.
+            size (int): The size of the datagram in bytes.
+        """
+        self.packets_out[opcode] += 1
+        self.bytes_out[opcode] += size
+
+    def snapshot(self, gauges=None):
+        """
+        Parameters:
+            gauges (dict): Current values to report along with the counters.
+        Returns:
+            dict: The metrics, JSON serializable.
+        """
+        def by_name(counters):
+            return {opcode_name(opcode): value for opcode, value in sorted(counters.items())}
+
+        return {
+            'pid': os.getpid(),
+            'uptime_s': self.clock() - self.started,
+            'gauges': gauges or {},
+            'wakeups': self.wakeups,
+            'errors': self.errors,
+            'packets_in': by_name(self.packets_in),
+            'bytes_in': by_name(self.bytes_in),
+            'packets_out': by_name(self.packets_out),
+            'bytes_out': by_name(self.bytes_out),
+            'handler_latency': {opcode_name(opcode): histogram.snapshot()
+                                for opcode, histogram in sorted(self.latency.items())},
+        }
+
+
+class CountingSocket:
+    """
+    Wraps the server socket (or an asyncio transport) to count the datagrams sent through it.
+    Everything but sendto is passed to the wrapped object, so it can be selected on like the socket.
+    """
+
+    def __init__(self, sock, metrics):
+        self._sock = sock
+        self.metrics = metrics
+
+    def sendto(self, message, addr):
+        self.metrics.record_out(message[0], len(message))
+        return self._sock.sendto(message, addr)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def open_stats_socket(path):
+    """
+    Creates the listening UNIX socket the metrics are scraped from. A stale socket file is replaced.
+    Parameters:
+        path (str): The path of the socket file.
+    Returns:
+        socket: The non blocking listening socket.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(8)
+    listener.setblocking(False)
+    return listener
+
+
+def serve_stats(listener, snapshot):
+    """
+    Answers a pending connection on the stats socket with a JSON snapshot and closes it.
+    Parameters:
+        listener (socket): The listening stats socket, reported readable.
+        snapshot (dict): The metrics to send.
+    """
+    try:
+        connection, _ = listener.accept()
+    except BlockingIOError:
+        return
+    with connection:
+        connection.settimeout(1)
+        try:
+            connection.sendall(json.dumps(snapshot).encode('utf-8') + b"\n")
+        except OSError:
+            pass  # The scraper went away
+
+
+def scrape_unix(path):
+    """
+    Returns:
+        dict: The metrics served on the given stats socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as soc:
+        soc.settimeout(2)
+        soc.connect(path)
+        chunks = []
+        while True:
+            chunk = soc.recv(STATS_BUFFERSIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks))
+
+
+def scrape_udp(host, port):
+    """
+    Returns:
+        dict: The metrics of the server process that answered a STATS message, loopback only.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as soc:
+        soc.settimeout(2)
+        soc.sendto(sl.pack_stats_User(), (host, port))
+        message, _ = soc.recvfrom(STATS_BUFFERSIZE)
+    return sl.unpack_stats_server(message, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the metrics of a running C-Man server")
+    parser.add_argument('socket', nargs='?', help="path of the server's --stats-socket")
+    parser.add_argument('--udp', nargs=2, metavar=('HOST', 'PORT'), help="ask the game port with a STATS message instead")
+    args = parser.parse_args()
+
+    try:
+        if args.udp:
+            stats = scrape_udp(args.udp[0], int(args.udp[1]))
+        elif args.socket:
+            stats = scrape_unix(args.socket)
+        else:
+            parser.error("give the stats socket path or --udp HOST PORT")
+    except (OSError, ValueError) as e:
+        print("Error: ", e)
+        sys.exit(1)
+    print(json.dumps(stats, indent=2))
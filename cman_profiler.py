@@ -0,0 +1,95 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import cman_metrics as cm
+
+PROFILE_SECONDS = 10  # Default length of a profiling window
+TOP_FUNCTIONS = 40  # Functions listed in the text report, by cumulative and by own time
+
+
+class ProfilingWindow:
+    """
+    Profiles the live server loop for a few seconds at a time. The window is opened on demand and
+    closed by a timer of the server's scheduler, the players are served as usual meanwhile.
+    Every window writes a pstats file, which tools such as snakeviz read, and a text report
+    adding the wall time spent in each message handler from the server metrics.
+    Attributes:
+        metrics (Metrics): The metrics of the server, the handler times are taken from them.
+        directory (str): The directory the reports are written to.
+        profiler (Profile): The running profiler, or None outside of a window.
+    """
+
+    def __init__(self, metrics, directory='.'):
+        self.metrics = metrics
+        self.directory = directory
+        self.profiler = None
+        self.started = None
+        self.handler_totals = None
+
+    def handler_snapshot(self):
+        """
+        Returns:
+            dict: Opcode -> (messages handled, seconds spent) since the server started.
+        """
+        return {opcode: (histogram.count, histogram.total) for opcode, histogram in self.metrics.latency.items()}
+
+    def start(self, scheduler, seconds=PROFILE_SECONDS):
+        """
+        Opens a profiling window, unless one is already open.
+        Parameters:
+            scheduler (Scheduler): The scheduler of the server loop, closes the window.
+            seconds (float): The length of the window. It closes at the first loop wakeup after it.
+        Returns:
+            bool: Whether a window was opened.
+        """
+        if self.profiler is not None:
+            return False
+        self.handler_totals = self.handler_snapshot()
+        self.started = time.perf_counter()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        scheduler.call_later(seconds, self.stop)
+        return True
+
+    def stop(self):
+        """
+        Closes the profiling window and writes its reports.
+        Returns:
+            str: The path of the text report.
+        """
+        self.profiler.disable()
+        elapsed = time.perf_counter() - self.started
+        profiler, self.profiler = self.profiler, None
+        base = os.path.join(self.directory, f"cman-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        profiler.dump_stats(base + ".prof")
+        with open(base + ".txt", 'w') as f:
+            f.write(self.report(profiler, elapsed))
+        print(f"Profile of the last {elapsed:.1f}s written to {base}.txt")
+        return base + ".txt"
+
+    def report(self, profiler, elapsed):
+        """
+        Returns:
+            str: The handler times of the window followed by the hottest functions.
+        """
+        out = io.StringIO()
+        out.write(f"Profiling window of {elapsed:.3f}s, pid {os.getpid()}\n\n")
+        out.write(f"{'handler':<20}{'messages':>10}{'wall s':>10}{'share':>8}{'mean us':>10}\n")
+        busy = 0.0
+        for opcode, (count, total) in sorted(self.handler_snapshot().items()):
+            before_count, before_total = self.handler_totals.get(opcode, (0, 0.0))
+            count -= before_count
+            total -= before_total
+            if not count:
+                continue
+            busy += total
+            out.write(f"{cm.opcode_name(opcode):<20}{count:>10}{total:>10.3f}{total / elapsed:>8.1%}"
+                      f"{total / count * 1e6:>10.1f}\n")
+        out.write(f"{'all handlers':<20}{'':>10}{busy:>10.3f}{busy / elapsed:>8.1%}\n")
+        out.write("The rest of the window is spent waiting in the loop, in timers and in the other sockets.\n\n")
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
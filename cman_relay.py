@@ -0,0 +1,271 @@
+import argparse
+import select
+import signal
+import socket
+import sys
+import shared_libary as sl
+import cman_utils as cu
+import cman_game_map as gm
+from cman_scheduler import Scheduler
+
+BUFFERSIZE = 65535  # V2 game states grow with the points of the map
+REJOIN_DELAY = 11  # Seconds after the first game end announcement before joining the next game upstream
+RETRY_DELAY = 2  # Seconds before joining again when the upstream refused or did not answer the relay
+IDLE_TIMEOUT = 30  # Seconds of silence after which a downstream watcher is evicted
+
+
+def legacy_state_update(message):
+    """
+    Transcodes a V2 game state update for the watchers that only decode the legacy one.
+    Parameters:
+        message (bytes): A GAME_STATE_UPDATE_V2 message.
+    Returns:
+        bytes: The same state as a GAME_STATE_UPDATE message, or None if the map has too many points for it.
+    """
+    state = sl.unpack_game_state_update_v2_server(message, 1)
+    collected = state['collected']
+    if collected.size > gm.MAX_POINTS:
+        return None
+    bitmap = collected.value << (gm.MAX_POINTS - collected.size)
+    state['collected'] = bitmap.to_bytes(gm.MAX_POINTS // 8, 'big')
+    return sl.pack_game_state_update_server(state)
+
+
+def legacy_game_end(message):
+    """
+    Transcodes a V2 game end for the watchers that only decode the legacy one.
+    Parameters:
+        message (bytes): A GAME_END_V2 message.
+    Returns:
+        bytes: The same game end as a GAME_END message, the C-Man score capped to a byte. Legacy watchers
+               only watch maps of up to 40 points, whose scores fit.
+    """
+    game_end = sl.unpack_game_end_v2_server(message, 1)
+    return sl.pack_game_end_server(game_end['winner'], game_end['s_score'], min(game_end['c_score'], 0xFF))
+
+
+class Relay:
+    """
+    A spectator relay: joins an upstream server (or relay) as a single watcher and re-broadcasts
+    its game states and game end announcements to its own watchers. Downstream, a relay speaks the
+    watcher side of the server protocol, so relays can be chained into a tree and the game server
+    only ever serves the relays at the top of it.
+    Attributes:
+        upstream (tuple): The address of the upstream server or relay.
+        room (str): The upstream room to watch, or None to let the upstream pick one.
+        upstream_socket (socket): The socket the relay watches the upstream with.
+        downstream_socket (socket): The socket the downstream watchers join.
+        watchers (dict): Address -> time the downstream watcher was last heard from, in joining order.
+        legacy_watchers (set): The downstream watchers that did not announce the VARIABLE_POINTS capability.
+        idle_timeout (float): Seconds of silence after which a downstream watcher is evicted, 0 never evicts.
+        last_state (bytes): The last game state update received from upstream, or None.
+        last_legacy_state (bytes): last_state as a legacy game state update, or None if the map has too many points.
+        joined (bool): Whether the upstream sent a state or a game end since the relay last joined it.
+    """
+
+    def __init__(self, upstream, downstream_socket, room=None, idle_timeout=IDLE_TIMEOUT):
+        self.upstream = upstream
+        self.idle_timeout = idle_timeout
+        self.room = room
+        self.upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.downstream_socket = downstream_socket
+        self.watchers = {}
+        self.legacy_watchers = set()
+        self.last_state = None
+        self.last_legacy_state = None
+        self.scheduler = Scheduler()
+        self.rejoin_timer = None
+        self.joined = False
+
+    def join_upstream(self):
+        """
+        Joins the upstream as a watcher of full game states. The join is sent again until the upstream answers.
+        """
+        self.rejoin_timer = None
+        self.last_state = None
+        self.last_legacy_state = None
+        self.joined = False
+        self.upstream_socket.sendto(sl.pack_join_User('watcher', self.room, sl.CAPABILITY.VARIABLE_POINTS), self.upstream)
+        self.scheduler.call_later(RETRY_DELAY, self.check_joined)
+
+    def check_joined(self):
+        """
+        Joins the upstream again if it did not answer the last join.
+        """
+        if not self.joined and self.rejoin_timer is None:
+            self.upstream_socket.sendto(sl.pack_join_User('watcher', self.room, sl.CAPABILITY.VARIABLE_POINTS),
+                                        self.upstream)
+            self.scheduler.call_later(RETRY_DELAY, self.check_joined)
+
+    def schedule_rejoin(self, delay):
+        """
+        Joins the upstream again after the given delay, unless a rejoin is already scheduled.
+        """
+        if self.rejoin_timer is None:
+            self.rejoin_timer = self.scheduler.call_later(delay, self.next_game)
+
+    def next_game(self):
+        """
+        Drops the downstream watchers of the game that ended, like the server does, and joins the next game.
+        """
+        self.watchers.clear()
+        self.legacy_watchers.clear()
+        self.join_upstream()
+
+    def heartbeat(self):
+        """
+        Keeps the relay's session upstream alive, a relay watching full states sends nothing else.
+        """
+        self.upstream_socket.sendto(sl.pack_heartbeat_User(), self.upstream)
+        self.scheduler.call_later(sl.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def evict_idle_watchers(self):
+        """
+        Drops the downstream watchers silent for idle_timeout seconds.
+        """
+        now = self.scheduler.time()
+        for watcher, last_seen in list(self.watchers.items()):
+            if now - last_seen >= self.idle_timeout:
+                del self.watchers[watcher]
+                self.legacy_watchers.discard(watcher)
+        self.scheduler.call_later(self.idle_timeout, self.evict_idle_watchers)
+
+    def broadcast(self, message, legacy_message=None):
+        """
+        Sends a message to every downstream watcher.
+        Parameters:
+            message (bytes): The message to send.
+            legacy_message (bytes): The message sent to the legacy watchers instead, if it differs.
+        """
+        legacy_message = legacy_message or message
+        for watcher in self.watchers:
+            self.downstream_socket.sendto(legacy_message if watcher in self.legacy_watchers else message, watcher)
+
+    def send_state(self, addr):
+        """
+        Sends the last game state to a downstream watcher. Legacy watchers are dropped with an error
+        when the map has too many points for the legacy game state.
+        """
+        if addr not in self.legacy_watchers:
+            self.downstream_socket.sendto(self.last_state, addr)
+        elif self.last_legacy_state is not None:
+            self.downstream_socket.sendto(self.last_legacy_state, addr)
+        else:
+            self.downstream_socket.sendto(sl.pack_error_server(0x02), addr)
+            self.watchers.pop(addr, None)
+            self.legacy_watchers.discard(addr)
+
+    def handle_upstream_message(self, message):
+        """
+        Handles a message received from the upstream.
+        Parameters:
+            message (bytes): The message received from the upstream.
+        """
+        opcode = message[0]
+        if opcode != sl.OPCODE.ERROR:  # Any state or game end proves the relay joined
+            self.joined = True
+        if opcode == sl.OPCODE.GAME_STATE_UPDATE:  # The upstream predates the V2 game states
+            self.last_state = self.last_legacy_state = message
+            self.broadcast(message)
+        elif opcode == sl.OPCODE.GAME_STATE_UPDATE_V2:
+            self.last_state = message
+            self.last_legacy_state = legacy_state_update(message) if self.legacy_watchers else None
+            if self.legacy_watchers and self.last_legacy_state is None:
+                for watcher in list(self.legacy_watchers):
+                    self.send_state(watcher)
+            self.broadcast(message, self.last_legacy_state)
+        elif opcode == sl.OPCODE.GAME_END:
+            self.broadcast(message)
+            self.schedule_rejoin(REJOIN_DELAY)
+        elif opcode == sl.OPCODE.GAME_END_V2:
+            self.broadcast(message, legacy_game_end(message) if self.legacy_watchers else None)
+            self.schedule_rejoin(REJOIN_DELAY)
+        elif opcode == sl.OPCODE.ERROR:
+            # A refused join is sent again by check_joined. The downstream watchers are kept: the error may
+            # answer a retried join while the relay's first join succeeded.
+            cu.clear_print("Error from upstream:", sl.unpack_error_server(message, 1))
+
+    def handle_downstream_message(self, message, addr):
+        """
+        Handles a message received from a downstream client. Only watchers may join a relay.
+        Parameters:
+            message (bytes): The message received from the client.
+            addr (tuple): The address of the client.
+        """
+        opcode = message[0]
+        if addr in self.watchers:
+            self.watchers[addr] = self.scheduler.time()
+        if opcode == sl.OPCODE.JOIN:
+            if sl.unpack_join_user(message, 1) != 'watcher':
+                self.downstream_socket.sendto(sl.pack_error_server(0x01), addr)
+                return
+            self.watchers[addr] = self.scheduler.time()  # Joining again is harmless, chained relays retry their joins
+            if not sl.unpack_join_capabilities(message, 1) & sl.CAPABILITY.VARIABLE_POINTS:
+                if addr not in self.legacy_watchers and self.last_state is not None and self.last_legacy_state is None:
+                    self.last_legacy_state = legacy_state_update(self.last_state)
+                self.legacy_watchers.add(addr)
+            else:
+                self.legacy_watchers.discard(addr)
+            if self.last_state is not None:
+                self.send_state(addr)
+        elif opcode == sl.OPCODE.RESYNC:
+            # The relay only has full states, they answer a request for a keyframe
+            if addr in self.watchers and self.last_state is not None:
+                self.send_state(addr)
+        elif opcode == sl.OPCODE.QUIT:
+            self.watchers.pop(addr, None)
+            self.legacy_watchers.discard(addr)
+
+    def run(self):
+        """
+        The relay loop: serves the upstream and downstream sockets until the process is terminated.
+        """
+        self.join_upstream()
+        self.scheduler.call_later(sl.HEARTBEAT_INTERVAL, self.heartbeat)
+        if self.idle_timeout:
+            self.scheduler.call_later(self.idle_timeout, self.evict_idle_watchers)
+        sockets = [self.upstream_socket, self.downstream_socket]
+        while True:
+            try:
+                readable, _, _ = select.select(sockets, [], [], self.scheduler.timeout())
+                if self.upstream_socket in readable:
+                    message, addr = self.upstream_socket.recvfrom(BUFFERSIZE)
+                    if addr == self.upstream and message:
+                        self.handle_upstream_message(message)
+                if self.downstream_socket in readable:
+                    message, addr = self.downstream_socket.recvfrom(BUFFERSIZE)
+                    if message:
+                        self.handle_downstream_message(message, addr)
+                self.scheduler.run_due()
+
+            except Exception as e:
+                cu.clear_print(f"Error: {e}")
+
+
+def handle_sigint(signal_number, frame):
+    print("\nRelay is shutting down gracefully...")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, handle_sigint)
+
+    parser = argparse.ArgumentParser(description="C-Man spectator relay")
+    parser.add_argument('upstream_host', help="address of the server or relay to watch")
+    parser.add_argument('upstream_port', type=int, help="port of the server or relay to watch")
+    parser.add_argument('port', nargs='?', type=int, default=1338, help="port the watchers join (default: 1338)")
+    parser.add_argument('--host', default='localhost', help="address to bind (default: localhost)")
+    parser.add_argument('-r', '--room', default=None, help="name of the upstream room to watch")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence after which a watcher is evicted, 0 never evicts (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        upstream = (socket.gethostbyname(args.upstream_host), args.upstream_port)
+        soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        soc.bind((args.host, args.port))
+        Relay(upstream, soc, args.room, args.idle_timeout).run()
+
+    except socket.error as e:
+        print("Error: ", e)
+        sys.exit(1)
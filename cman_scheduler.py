@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import sys
+import time
+
+
+class TimerHandle:
+    """
+    A callback scheduled to run at a deadline. Returned by Scheduler.call_later and Scheduler.call_at.
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the callback from running. Cancelling a timer that already ran has no effect.
+        """
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    A heap of deadlines serviced by the server loop between socket reads.
+    The call_later/call_at interface mirrors the one of an asyncio event loop,
+    so the game handlers can schedule timed work without knowing which engine runs them.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()  # Keeps the heap stable for timers sharing a deadline
+        self._exception_handler = None
+
+    def time(self):
+        """
+        Returns:
+            float: The current time of the scheduler's clock.
+        """
+        return self.clock()
+
+    def call_at(self, when, callback, *args):
+        """
+        Schedules callback(*args) to run once the clock reaches the given deadline.
+        Parameters:
+            when (float): The deadline, in the scheduler's clock.
+            callback (callable): The function to call.
+        Returns:
+            TimerHandle: A handle that can be used to cancel the call.
+        """
+        handle = TimerHandle(when, callback, args)
+        heapq.heappush(self._heap, (when, next(self._counter), handle))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to run after the given delay.
+        Parameters:
+            delay (float): The delay in seconds.
+            callback (callable): The function to call.
+        Returns:
+            TimerHandle: A handle that can be used to cancel the call.
+        """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def set_exception_handler(self, handler):
+        """
+        Sets the function called when a callback raises, like the exception handler of an asyncio event loop.
+        Parameters:
+            handler (callable): Called as handler(scheduler, context), context holding the 'message',
+                                the 'exception' and the 'handle'. None restores the default, printing the error.
+        """
+        self._exception_handler = handler
+
+    def call_exception_handler(self, context):
+        """
+        Reports an exception raised by a callback to the exception handler.
+        Parameters:
+            context (dict): The 'message', 'exception' and 'handle' of the failure.
+        """
+        if self._exception_handler is not None:
+            self._exception_handler(self, context)
+        else:
+            print(f"{context['message']}: {context['exception']!r}", file=sys.stderr)
+
+    def timeout(self):
+        """
+        Returns:
+            float: The number of seconds until the next deadline (0 if one is already due),
+                   or None if nothing is scheduled.
+        """
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
+
+    def run_due(self):
+        """
+        Runs every callback whose deadline has passed, in deadline order.
+        Callbacks scheduled by a running callback are serviced on the next call if they are already due.
+        A callback that raises is reported to the exception handler and the other callbacks still run.
+        Returns:
+            int: The number of callbacks that ran.
+        """
+        now = self.clock()
+        ran = 0
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        for handle in due:
+            if not handle.cancelled:
+                handle.cancelled = True
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    self.call_exception_handler({
+                        'message': f"Exception in callback {getattr(handle.callback, '__qualname__', handle.callback)}",
+                        'exception': e,
+                        'handle': handle,
+                    })
+                ran += 1
+        return ran
+
+    def __len__(self):
+        return sum(1 for _, _, handle in self._heap if not handle.cancelled)
@@ -1,22 +1,261 @@
+import argparse
+import random
 import socket
 import sys
 import shared_libary as sl
 import cman_game as cg
+import cman_game_map as gm
+import cman_bot as cb
 import cman_utils as cu
-import time
 import select
 import signal
+import time
+import cman_metrics as cm
+import cman_profiler as cp
+import cman_journal as cj
+from cman_journal import RECORD_KIND
+from collections import OrderedDict, deque
 from cman_game import Player, State, MAX_ATTEMPTS
+from cman_scheduler import Scheduler
 BUFFERSIZE = 1024
-cman = None
-spirit = None
-cman_moved = False
-watchers = []
+GAME_END_DURATION = 10  # Seconds the game end is announced before the room is closed
+GAME_END_INTERVAL = 1  # Seconds between two game end announcements
+STATE_HISTORY = 64  # Published states a room keeps as bases for deltas
+KEYFRAME_INTERVAL = 32  # Every state whose sequence number is a multiple of it is sent in full
+MAX_QUEUED_INPUTS = 4  # Inputs a player may queue for the next tick, older ones are dropped
+IDLE_TIMEOUT = 30  # Seconds of silence after which a client is evicted
+MAP_PATH = "map.txt"
+BOT_DELAY = 5  # Seconds a free seat waits for a client before a bot takes it
+BOT_RATE = 4  # Moves per second of a bot
+ROLES = ('cman', 'spirit', 'watcher')
+scheduler = Scheduler()  # Timed work serviced by the server loop
+rooms = {}  # room name -> Room
+sessions = OrderedDict()  # client address -> Session of the client, least recently seen first
+room_counter = 0
+map_path = MAP_PATH  # Map of the games of new rooms
+room_name_prefix = ""  # Prepended to generated room names, keeps them unique across worker processes
+tick_rate = 0  # Simulation ticks per second, 0 applies every input as soon as it arrives
+idle_timeout = IDLE_TIMEOUT  # Seconds of silence after which a client is evicted, 0 never evicts
+metrics = cm.Metrics()  # Counters of this process, see stats_snapshot
+stats_socket_path = None  # Path of the UNIX socket serving the metrics, or None
+profiling = cp.ProfilingWindow(metrics)  # Profiles the loop on SIGUSR1 or a PROFILE message
+profile_seconds = cp.PROFILE_SECONDS  # Length of a profiling window
+journal_path = None  # Path of the journal of accepted inputs and room events, or None
+journal = None  # The open Journal, or None
+bot_roles = ()  # Roles ('cman', 'spirit') a bot takes when no client took them for bot_delay seconds
+bot_delay = BOT_DELAY
+bot_rate = BOT_RATE
+bot_rooms = 0  # Rooms played by two bots kept open, for load tests and demos
+bot_socket = None  # The server socket the bots' moves are sent from, see start_bots
+seats_changed = None  # Called with a room whenever a seat was taken or freed or the room closed, see cman_workers
+
+
+class Session:
+    """
+    A client that joined a room.
+    Attributes:
+        address (tuple): The address of the client.
+        role (str): The role of the client in its room (cman, spirit, or watcher).
+        room (Room): The room the client joined.
+        last_seen (float): The scheduler time of the last message received from the client.
+        ack (int): The last acknowledged sequence number, or None for clients served full states.
+        variable_points (bool): Whether the client decodes the V2 game states, which carry any number of points.
+    """
+    __slots__ = ('address', 'role', 'room', 'last_seen', 'ack', 'variable_points')
+
+    def __init__(self, address, role, room, last_seen, variable_points=False):
+        self.address = address
+        self.role = role
+        self.room = room
+        self.last_seen = last_seen
+        self.ack = None
+        self.variable_points = variable_points
+
+
+class Room:
+    """
+    A single match hosted by the server: its own Game instance and the clients taking part in it.
+    Attributes:
+        name (str): The name the clients use to join the room.
+        game (Game): The game instance played in this room.
+        cman (tuple): The address of the C-Man player, a Bot, or None.
+        spirit (tuple): The address of the Spirit player, a Bot, or None.
+        watchers (dict): Address -> Session of the watchers, in joining order.
+        end_timer (TimerHandle): The scheduled closing of the room once its game has ended, or None.
+        seq (int): The sequence number of the last published state.
+        history (dict): Sequence number -> snapshot of the last STATE_HISTORY published states.
+        published_version (int): The game version room.seq was published for.
+        packed (dict): (role, acknowledged seq) -> message packed for room.seq.
+        inputs (tuple): The directions queued by C-Man and by the Spirit for the next tick.
+        tick_timer (TimerHandle): The next scheduled tick, or None while the room is idle.
+        journal_id (int): The id of the room in the journal.
+        bot_room (bool): Whether the room is played by two bots and reopened once its game ends.
+    """
+
+    def __init__(self, name, map_path=MAP_PATH):
+        self.name = name
+        self.game = cg.Game(map_path)
+        self.cman = None
+        self.spirit = None
+        self.watchers = {}
+        self.end_timer = None
+        self.seq = 0
+        self.history = {}
+        self.published_version = None
+        self.packed = {}
+        self.inputs = (deque(maxlen=MAX_QUEUED_INPUTS), deque(maxlen=MAX_QUEUED_INPUTS))
+        self.tick_timer = None
+        self.journal_id = 0
+        self.bot_room = False
+
+    def player_addresses(self):
+        """
+        Returns:
+            list: The addresses of the players that are clients, bots excluded.
+        """
+        return [seat for seat in (self.cman, self.spirit) if seat is not None and not isinstance(seat, cb.Bot)]
+
+    def is_empty(self):
+        """
+        Returns:
+            bool: Whether no client is left in the room, bots do not count.
+        """
+        return not self.player_addresses() and not self.watchers
+
+    def has_free_seat(self, role):
+        """
+        Checks whether a client with the given role may join this room.
+        Parameters:
+            role (str): The requested role (cman, spirit, or watcher).
+        Returns:
+            bool: Whether the role is still available.
+        """
+        if self.game.state == State.WIN:
+            return False
+        if role == 'watcher':
+            return True
+        if role == 'cman':
+            return self.cman is None
+        if role == 'spirit':
+            return self.spirit is None
+        return False
+
+
+def create_room(name=None):
+    """
+    Creates a new room and registers it in the room registry.
+    Parameters:
+        name (str): The name of the room, a unique name is generated when omitted.
+    Returns:
+        Room: The new room.
+    """
+    global room_counter
+    while name is None or name in rooms:
+        room_counter += 1
+        name = f"{room_name_prefix}{room_counter}"
+    room = Room(name, map_path)
+    rooms[name] = room
+    if journal is not None:
+        room.journal_id = journal.open_room(name, map_path)
+    return room
+
+
+def find_room(role, name=None):
+    """
+    Finds the room a joining client should be placed in.
+    A named room is created on demand. Without a name, watchers join the oldest room and players
+    take the first room with a free seat, waiting or left by an evicted player, or open a new room.
+    Parameters:
+        role (str): The requested role (cman, spirit, or watcher).
+        name (str): The room requested by the client, or None.
+    Returns:
+        Room: The room to join.
+    """
+    if name is not None:
+        return rooms.get(name) or create_room(name)
+    for room in rooms.values():
+        if room.has_free_seat(role):
+            return room
+    return create_room()
+
+
+def close_room(room):
+    """
+    Removes a room and all of its clients from the registry.
+    Parameters:
+        room (Room): The room to close.
+    """
+    for addr in [room.cman, room.spirit, *room.watchers]:
+        session = sessions.get(addr)
+        if session is not None and session.room is room:
+            del sessions[addr]
+    if rooms.get(room.name) is room:
+        del rooms[room.name]
+        journal_event(room, RECORD_KIND.CLOSE)
+        notify_seats(room)
+
+
+def notify_seats(room):
+    """
+    Tells the seats_changed listener, if any, that the seats of a room changed.
+    Parameters:
+        room (Room): The room whose seats changed.
+    """
+    if seats_changed is not None:
+        seats_changed(room)
+
+
+def open_journal(path):
+    """
+    Starts journaling the accepted inputs and the room events, see Journal.
+    Parameters:
+        path (str): The path of the journal file, it is overwritten.
+    """
+    global journal
+    journal = cj.Journal(path)
+    journal.flush_periodically(scheduler)
+
+
+def close_journal():
+    """
+    Writes the buffered journal records and closes the journal, if one is open.
+    """
+    global journal
+    if journal is not None:
+        journal.close()
+        journal = None
+
+
+def journal_event(room, kind, *fields):
+    """
+    Records a lifecycle event of a room, if a journal is open.
+    Parameters:
+        room (Room): The room of the event.
+        kind (int): The RECORD_KIND of the event.
+        fields (int): The payload of the event.
+    """
+    if journal is not None:
+        journal.record(room.journal_id, kind, *fields)
+
+
+def apply_move(room, player, direction):
+    """
+    Applies a move to the game of a room and journals it if the game accepted it.
+    Parameters:
+        room (Room): The room of the player.
+        player (Player): The player to move.
+        direction (int): The direction of the move.
+    """
+    if room.game.apply_move(player, direction) and journal is not None:
+        journal.record_move(room.journal_id, player, direction)
 
 
-def current_state(game, address):
+def current_state(room, address):
     """
     Generates and returns the current game state based on the board structure.
+    Parameters:
+        room (Room): The room the client belongs to.
+        address (tuple): The address of the client the state is generated for.
 
     Returns:
         dict: A dictionary containing:
@@ -26,143 +265,572 @@ def current_state(game, address):
             - attempts: Remaining lives for C-Man.
             - collected: Binary string representing collected points (1 for collected, 0 for not collected).
     """
-    # Determine if C-Man can move
-    freeze = 1  # Default value
-    if address in watchers:
-        freeze = 1
-    else:
-        if cman == address:
-            freeze = 0 if game.can_move(Player.CMAN) else 1
-        elif spirit == address:
-            freeze = 0 if game.can_move(Player.SPIRIT) else 1
+    session = sessions.get(address)
+    return state_view(room_snapshot(room), session.role if session is not None else 'watcher')
 
+
+def room_snapshot(room):
+    """
+    Captures the part of the game state that is the same for every client of the room.
+    Parameters:
+        room (Room): The room to capture.
+    Returns:
+        tuple: Whether C-Man and the Spirit may move, their coordinates, the used attempts
+               and the encoded collected points.
+    """
+    game = room.game
     # Get current coordinates for C-Man and Spirit
-    c_x, c_y = game.get_current_players_coords()[Player.CMAN]
-    s_x, s_y = game.get_current_players_coords()[Player.SPIRIT]
+    c_coords, s_coords = game.get_current_players_coords()[Player.CMAN], game.get_current_players_coords()[Player.SPIRIT]
+    return (game.can_move(Player.CMAN), game.can_move(Player.SPIRIT),
+            tuple(c_coords), tuple(s_coords),
+            MAX_ATTEMPTS - game.lives,  # Remaining lives for C-Man
+            encode_points(game))  # Collected points status
 
-    # Remaining lives for C-Man
-    attempts = MAX_ATTEMPTS - game.lives
 
-    # Collected points status
-    collected = encode_points(game)
+def state_view(snapshot, role):
+    """
+    Builds the game state a client receives from a room snapshot.
+    Parameters:
+        snapshot (tuple): A snapshot taken by room_snapshot.
+        role (str): The role of the client in the room (cman, spirit, or watcher).
+    Returns:
+        dict: The game state, see current_state.
+    """
+    cman_can_move, spirit_can_move, c_coords, s_coords, attempts, collected = snapshot
+    # Determine if the client can move
+    freeze = 1  # Default value
+    if role == 'cman':
+        freeze = 0 if cman_can_move else 1
+    elif role == 'spirit':
+        freeze = 0 if spirit_can_move else 1
 
     return {
             'freeze': freeze,
-            'c_coords': (c_x, c_y),
-            's_coords': (s_x, s_y),
+            'c_coords': c_coords,
+            's_coords': s_coords,
             'attempts': attempts,
             'collected': collected
     }
 
 
-def user_try_to_join(game, server_socket, message, addr):
+def publish_state(room):
+    """
+    Takes a snapshot of the room and gives it a new sequence number if the game state changed.
+    The game's version tells whether anything changed since the last snapshot.
+    Parameters:
+        room (Room): The room to publish.
+    Returns:
+        tuple: The current snapshot of the room.
+    """
+    version = room.game.get_version()
+    if version == room.published_version:
+        return room.history[room.seq]
+    snapshot = room_snapshot(room)
+    room.published_version = version
+    if snapshot != room.history.get(room.seq):
+        room.seq += 1
+        room.history[room.seq] = snapshot
+        room.history.pop(room.seq - STATE_HISTORY, None)
+        room.packed.clear()
+    return snapshot
+
+
+def packed_state(room, snapshot, role, ack, variable_points=False):
+    """
+    Returns the message carrying the published snapshot to clients of the given role.
+    Messages are packed once per published state and shared by every client with the same
+    role, acknowledged state and state format, so a broadcast encodes each distinct message once.
+    Parameters:
+        room (Room): The room the snapshot belongs to.
+        snapshot (tuple): The snapshot published as room.seq.
+        role (str): The role of the receiving clients.
+        ack (int): The last state acknowledged by the clients, or None for clients served full states.
+        variable_points (bool): Whether the clients are sent V2 game states instead of the legacy ones.
+    Returns:
+        bytes: A game state update, keyframe or delta.
+    """
+    key = (role, ack, variable_points)
+    message = room.packed.get(key)
+    if message is not None:
+        return message
+
+    state = state_view(snapshot, role)
+    if ack is None:
+        if variable_points:
+            message = sl.pack_game_state_update_v2_server(state, room.game.map.point_count)
+        else:
+            message = sl.pack_game_state_update_server(state)
+    else:
+        base = room.history.get(ack)  # STATE_HISTORY keeps the base within the 255 states a delta can refer back to
+        if base is not None and room.seq % KEYFRAME_INTERVAL != 0:
+            try:
+                message = sl.pack_game_state_delta_server(room.seq, ack, state_view(base, role), state)
+            except ValueError:
+                pass  # Not expressible as a delta
+        if message is None:
+            keyframe_key = (role, 'keyframe', variable_points)
+            message = room.packed.get(keyframe_key)
+            if message is None:
+                if variable_points:
+                    message = sl.pack_game_state_keyframe_v2_server(room.seq, state, room.game.map.point_count)
+                else:
+                    message = sl.pack_game_state_keyframe_server(room.seq, state)
+                room.packed[keyframe_key] = message
+    room.packed[key] = message
+    return message
+
+
+def send_state(room, server_socket, session, snapshot):
+    """
+    Sends a published snapshot to a client of the room.
+    Clients that asked for sequenced states get a delta against the last state they acknowledged,
+    or a keyframe when that state is too old or a keyframe is due. Other clients get the full state.
+    Parameters:
+        room (Room): The room the client belongs to.
+        server_socket (socket): The server socket object.
+        session (Session): The session of the client.
+        snapshot (tuple): The snapshot published as room.seq.
     """
-    Unpack the message and determine the role of the user, send a message back to the user
+    message = packed_state(room, snapshot, session.role, session.ack, session.variable_points)
+    server_socket.sendto(message, session.address)
+
+
+def user_try_to_join(server_socket, message, addr):
+    """
+    Unpack the message and determine the role and the room of the user, send a message back to the user
     with the game state and the role of the user.
     Parameters:
-        game (Game): The current game instance.
         server_socket (socket): The server socket object.
         message (bytes): The message received from the client.
         addr (tuple): The address of the client.
+    Returns:
+        Room: The room the user joined, or None if the join was refused.
     """
 
-    role = sl.unpack_join_user(message[1:])
-    global cman, spirit, watchers
+    role = sl.unpack_join_user(message, 1)
+    room_name = sl.unpack_join_room(message, 1)
+    variable_points = bool(sl.unpack_join_capabilities(message, 1) & sl.CAPABILITY.VARIABLE_POINTS)
 
-    if role == 'watcher':
-        watchers.append(addr)
-        server_socket.sendto(sl.pack_game_state_update_server(current_state(game, addr)), addr)
-    elif role == 'cman' and cman is None:
-        cman = addr
-        server_socket.sendto(sl.pack_game_state_update_server(current_state(game, addr)), addr)
-    elif role == 'spirit' and spirit is None:
-        spirit = addr
-        server_socket.sendto(sl.pack_game_state_update_server(current_state(game, addr)), addr)
-    else:
-        error_message = sl.pack_error_server(0x01)  # Example error code
+    session = sessions.get(addr)
+    if session is not None and session.role == role and room_name in (None, session.room.name):
+        # The answer to the first join was lost and the client joins again: answer it again
+        session.last_seen = scheduler.time()
+        sessions.move_to_end(addr)
+        send_state(session.room, server_socket, session, publish_state(session.room))
+        return session.room
+
+    error_code = 0x01  # Example error code
+    room = None
+    if session is None and role in ROLES:  # Unknown roles are refused before a room is opened for them
+        room_count = len(rooms)
+        candidate = find_room(role, room_name)
+        if candidate.has_free_seat(role):
+            if variable_points or candidate.game.map.point_count <= gm.MAX_POINTS:
+                room = candidate
+            else:
+                error_code = 0x02  # The legacy game state cannot carry the points of the map
+        if room is None and len(rooms) > room_count:  # The room was opened for this refused join
+            close_room(candidate)
+
+    if room is None:
+        error_message = sl.pack_error_server(error_code)
         server_socket.sendto(error_message, addr)
-    
-def broadcast_game_state(game, server_socket):
+        return None
+
+    session = sessions[addr] = Session(addr, role, room, scheduler.time(), variable_points)
+    if role == 'watcher':
+        room.watchers[addr] = session
+    elif role == 'cman':
+        room.cman = addr
+        if room.spirit is None:
+            schedule_bot(room, 'spirit', server_socket)
+    elif role == 'spirit':
+        room.spirit = addr
+        if room.cman is None:
+            schedule_bot(room, 'cman', server_socket)
+    if role != 'watcher':
+        notify_seats(room)
+    send_state(room, server_socket, session, publish_state(room))
+    return room
+
+
+def broadcast_game_state(room, server_socket, snapshot=None):
     """
-    Sends the current game state to all watchers.
+    Sends the current game state to all watchers of the room.
+    Parameters:
+        room (Room): The room to broadcast.
+        server_socket (socket): The server socket object.
+        snapshot (tuple): The snapshot published as room.seq, published now when omitted.
     """
-    for watcher in watchers:
-        state_update = sl.pack_game_state_update_server(current_state(game, watcher))
-        server_socket.sendto(state_update, watcher)
+    if snapshot is None:
+        snapshot = publish_state(room)
+    for session in room.watchers.values():
+        send_state(room, server_socket, session, snapshot)
 
 
-def player_movement(game, server_socket, message, addr):
+def player_movement(room, server_socket, message, addr):
     """
     Unpack the message and apply the move to the player, send a message back to the user
     with the updated game state.
     Parameters:
-        game (Game): The current game instance.
+        room (Room): The room the user belongs to.
         server_socket (socket): The server socket object.
         message (bytes): The message received from the client.
         addr (tuple): The address of the client.
     """
-    direction = sl.unpack_player_movement_user(message[1:])
+    direction = sl.unpack_player_movement_user(message, 1)
     direction_int = int(direction)
-    if addr == cman:
-        game.apply_move(Player.CMAN, direction_int)
-    elif addr == spirit:
-        game.apply_move(Player.SPIRIT, direction_int)
-    
-    state_update = sl.pack_game_state_update_server(current_state(game, addr))
-    server_socket.sendto(state_update, addr)
-    broadcast_game_state(game, server_socket)
+    if tick_rate:
+        queue_movement(room, server_socket, addr, direction_int)
+        return
+    if addr == room.cman:
+        apply_move(room, Player.CMAN, direction_int)
+    elif addr == room.spirit:
+        apply_move(room, Player.SPIRIT, direction_int)
+
+    snapshot = publish_state(room)
+    send_state(room, server_socket, sessions[addr], snapshot)
+    broadcast_game_state(room, server_socket, snapshot)
 
 
-def handle_game_end(game, server_socket):
+def queue_movement(room, server_socket, addr, direction):
     """
-    Notify all clients of the game end and restart the game after a delay.
+    Queues a player's move for the next tick of the room, and starts ticking if the room was idle.
     Parameters:
-        game (Game): The current game instance.
+        room (Room): The room the user belongs to.
+        server_socket (socket): The server socket object.
+        addr (tuple): The address of the client.
+        direction (int): The direction of the move.
+    """
+    if addr == room.cman:
+        queue_input(room, server_socket, Player.CMAN, direction)
+    elif addr == room.spirit:
+        queue_input(room, server_socket, Player.SPIRIT, direction)
+
+
+def queue_input(room, server_socket, player, direction):
+    """
+    Queues a move of a player, client or bot, for the next tick of the room.
+    Parameters:
+        room (Room): The room of the player.
+        server_socket (socket): The server socket object.
+        player (Player): The player to move.
+        direction (int): The direction of the move.
+    """
+    room.inputs[player].append(direction)
+    if room.tick_timer is None:
+        room.tick_timer = scheduler.call_later(1 / tick_rate, tick, room, server_socket, scheduler.time())
+
+
+def tick(room, server_socket, started):
+    """
+    Advances the room by one tick: applies the queued inputs alternately, C-Man first, then sends
+    one snapshot to the players and the watchers. Ticks run at a fixed rate while inputs keep arriving.
+    Parameters:
+        room (Room): The room to advance.
+        server_socket (socket): The server socket object.
+        started (float): The scheduler time the ticking started at, ticks are aligned on it.
+    """
+    room.tick_timer = None
+    cman_inputs, spirit_inputs = room.inputs
+    if not cman_inputs and not spirit_inputs:
+        return  # Idle, the next input starts ticking again
+    while cman_inputs or spirit_inputs:
+        if cman_inputs:
+            apply_move(room, Player.CMAN, cman_inputs.popleft())
+        if spirit_inputs:
+            apply_move(room, Player.SPIRIT, spirit_inputs.popleft())
+
+    snapshot = publish_state(room)
+    for player in room.player_addresses():
+        send_state(room, server_socket, sessions[player], snapshot)
+    broadcast_game_state(room, server_socket, snapshot)
+    update_room(room, server_socket)
+
+    if rooms.get(room.name) is room and room.end_timer is None:
+        interval = 1 / tick_rate
+        ticks = int((scheduler.time() - started) / interval) + 1
+        room.tick_timer = scheduler.call_at(started + ticks * interval, tick, room, server_socket, started)
+
+
+def state_ack(room, server_socket, message, addr):
+    """
+    Records the last game state a client applied, later states are sent as deltas against it.
+    Parameters:
+        room (Room): The room the user belongs to.
+        server_socket (socket): The server socket object.
+        message (bytes): The message received from the client.
+        addr (tuple): The address of the client.
+    """
+    seq = sl.unpack_state_ack_user(message, 1)
+    session = sessions[addr]
+    if session.ack is not None and session.ack < seq <= room.seq:
+        session.ack = seq
+
+
+def resync(room, server_socket, message, addr):
+    """
+    Sends a keyframe of the current game state to a client and serves it sequenced states from then on.
+    Parameters:
+        room (Room): The room the user belongs to.
+        server_socket (socket): The server socket object.
+        message (bytes): The message received from the client.
+        addr (tuple): The address of the client.
+    """
+    session = sessions[addr]
+    session.ack = 0  # No acknowledged state, the next state is a keyframe
+    send_state(room, server_socket, session, publish_state(room))
+
+
+def handle_game_end(room, server_socket):
+    """
+    Notify all clients of the room of the game end and schedule the closing of the room.
+    The game end is announced every GAME_END_INTERVAL seconds for GAME_END_DURATION seconds,
+    the server keeps serving the other rooms meanwhile.
+    Parameters:
+        room (Room): The room whose game has ended.
         server_socket (socket): The server socket object.
     """
-    global cman, spirit, watchers  # Declare globals at the top of the function
+    if room.end_timer is not None:  # The game end is already being announced
+        return
 
+    game = room.game
     winner = game.get_winner()
-    game_end_message = sl.pack_game_end_server(winner, MAX_ATTEMPTS - game.lives, game.score)
+    attempts = MAX_ATTEMPTS - game.lives
+    # The C-Man score outgrows a byte on large maps, which only clients of the V2 messages may join
+    game_end_messages = (sl.pack_game_end_server(winner, attempts, min(game.score, 0xFF)),
+                         sl.pack_game_end_v2_server(winner, attempts, game.score))
+    journal_event(room, RECORD_KIND.GAME_END, winner, game.score, game.lives)
 
-    # Notify all clients repeatedly for 10 seconds
-    end_time = time.time() + 10
-    while time.time() < end_time:
-        if cman:
-            server_socket.sendto(game_end_message, cman)
-        if spirit:
-            server_socket.sendto(game_end_message, spirit)
-        for watcher in watchers:
-            server_socket.sendto(game_end_message, watcher)
-        time.sleep(1)  # Send the message every second
+    announce_game_end(room, server_socket, game_end_messages, GAME_END_DURATION // GAME_END_INTERVAL)
+    room.end_timer = scheduler.call_later(GAME_END_DURATION, restart_room, room)
+    if room.bot_room:
+        scheduler.call_later(GAME_END_DURATION, start_bot_room, server_socket)
 
-    # Restart the game
-    cman = None
-    spirit = None
-    watchers = []
-    game.restart_game()
-    print("Game restarted and server is waiting for new clients.")
 
+def announce_game_end(room, server_socket, game_end_messages, remaining):
+    """
+    Sends the game end message to every client of the room and schedules the next announcement.
+    Parameters:
+        room (Room): The room whose game has ended.
+        server_socket (socket): The server socket object.
+        game_end_messages (tuple): The packed GAME_END and GAME_END_V2 messages, the second one is sent
+                                   to the clients with the VARIABLE_POINTS capability.
+        remaining (int): The number of announcements left, including this one.
+    """
+    for player in room.player_addresses():
+        server_socket.sendto(game_end_messages[sessions[player].variable_points], player)
+    for watcher, session in room.watchers.items():
+        server_socket.sendto(game_end_messages[session.variable_points], watcher)
+    if remaining > 1:
+        scheduler.call_later(GAME_END_INTERVAL, announce_game_end, room, server_socket, game_end_messages, remaining - 1)
+
+
+def restart_room(room):
+    """
+    Frees a room whose game has ended, its clients may join a new game.
+    Parameters:
+        room (Room): The room to close.
+    """
+    if room.tick_timer is not None:
+        room.tick_timer.cancel()
+        room.tick_timer = None
+    close_room(room)
+    room.end_timer = None
+    print(f"Game in room {room.name} ended, the room was closed.")
 
 
-def quit_game(game, server_socket, message, addr):
+def quit_game(room, server_socket, message, addr):
     """
     Remove the user from the game and notify the other user of the game end and the winner.
     Parameters:
-        game (Game): The current game instance.
+        room (Room): The room the user belongs to.
+        server_socket (socket): The server socket object.
+        message (bytes): The message received from the client.
+        addr (tuple): The address of the client.
+    """
+    if addr == room.cman:
+        room.cman = None
+        declare_winner(room, cg.Player.SPIRIT)
+    elif addr == room.spirit:
+        room.spirit = None
+        declare_winner(room, cg.Player.CMAN)
+    else:
+        room.watchers.pop(addr, None)
+    sessions.pop(addr, None)
+    notify_seats(room)
+
+
+def declare_winner(room, player):
+    """
+    Ends the game of a room in favour of a player, unless it already has a winner.
+    Parameters:
+        room (Room): The room whose game ends.
+        player (Player): The winner.
+    """
+    if room.game.state != State.WIN:
+        room.game.declare_winner(player)
+        journal_event(room, RECORD_KIND.WINNER, player)
+
+
+def schedule_bot(room, role, server_socket):
+    """
+    Gives a free seat of a room to a bot if no client takes it within bot_delay seconds.
+    Parameters:
+        room (Room): The room with the free seat.
+        role (str): The free seat (cman or spirit), only the roles in bot_roles are given to bots.
+        server_socket (socket): The server socket object.
+    """
+    if role in bot_roles:
+        scheduler.call_later(bot_delay, seat_bot, room, role, server_socket)
+
+
+def seat_bot(room, role, server_socket):
+    """
+    Seats a bot in a room and starts moving it, unless the seat was taken or the room closed meanwhile.
+    Parameters:
+        room (Room): The room with the free seat.
+        role (str): The seat to give to the bot (cman or spirit).
+        server_socket (socket): The server socket object.
+    """
+    if rooms.get(room.name) is not room or not room.has_free_seat(role):
+        return
+    bot = cb.Bot(room.game, Player.CMAN if role == 'cman' else Player.SPIRIT)
+    if role == 'cman':
+        room.cman = bot
+    else:
+        room.spirit = bot
+    notify_seats(room)
+    # Spread the moves of the bots seated at the same time over the interval
+    bot.timer = scheduler.call_later(random.random() / bot_rate, bot_move, room, bot, server_socket)
+    update_room(room, server_socket)
+
+
+def bot_move(room, bot, server_socket):
+    """
+    Plays a move of a bot, like player_movement or queue_movement do for a client, and schedules the next one.
+    The bot waits while its seat has no opponent and stops once the game ended or the bot lost its seat.
+    Parameters:
+        room (Room): The room of the bot.
+        bot (Bot): The bot to move.
+        server_socket (socket): The server socket object.
+    """
+    if rooms.get(room.name) is not room or bot not in (room.cman, room.spirit) or room.game.state == State.WIN:
+        return
+    opponent = room.spirit if bot.player == Player.CMAN else room.cman
+    if opponent is not None and room.game.can_move(bot.player):
+        direction = bot.decide()
+        if tick_rate:
+            queue_input(room, server_socket, bot.player, direction)
+        else:
+            apply_move(room, bot.player, direction)
+            snapshot = publish_state(room)
+            for player in room.player_addresses():
+                send_state(room, server_socket, sessions[player], snapshot)
+            broadcast_game_state(room, server_socket, snapshot)
+            update_room(room, server_socket)
+    bot.timer = scheduler.call_later(1 / bot_rate, bot_move, room, bot, server_socket)
+
+
+def start_bot_room(server_socket):
+    """
+    Opens a room played by two bots. It is opened again once its game ended, see handle_game_end.
+    Parameters:
+        server_socket (socket): The server socket object.
+    """
+    room = create_room()
+    room.bot_room = True
+    for role in ('cman', 'spirit'):
+        seat_bot(room, role, server_socket)
+
+
+def prepare_bots():
+    """
+    Computes the next hop table of the map before serving when bots may play, so seating the first bot does
+    not stall the loop. Worker processes are forked afterwards and share it.
+    Raises:
+        ValueError: If the map is too large for the bots, see cman_bot.MAX_WALKABLE_CELLS.
+    """
+    if bot_roles or bot_rooms:
+        cb.next_hop_table(gm.load_map(map_path))
+
+
+def start_bots(server_socket):
+    """
+    Lets bots take the free seats from the given socket and opens the bot_rooms rooms played by bots.
+    Called by the engines once the server socket is ready.
+    Parameters:
+        server_socket (socket): The server socket object.
+    """
+    global bot_socket
+    bot_socket = server_socket
+    for _ in range(bot_rooms):
+        start_bot_room(server_socket)
+
+
+def heartbeat(room, server_socket, message, addr):
+    """
+    Keeps a client alive while it has nothing else to send, receiving it already refreshed its session.
+    Parameters:
+        room (Room): The room the user belongs to.
         server_socket (socket): The server socket object.
         message (bytes): The message received from the client.
         addr (tuple): The address of the client.
     """
-    global cman, spirit, watchers
-    if addr == cman:
-        cman = None
-        game.declare_winner(cg.Player.SPIRIT)
-    elif addr == spirit:
-        spirit = None
-        game.declare_winner(cg.Player.CMAN)
-    elif addr in watchers:
-        watchers.remove(addr)
+
+
+def evict_session(session):
+    """
+    Removes a client that went silent from its room. Unlike a quit, an evicted player does not lose
+    the game: the seat is freed and the next player asking for the role takes it over.
+    Parameters:
+        session (Session): The session of the silent client.
+    """
+    room = session.room
+    addr = session.address
+    if addr == room.cman:
+        room.cman = None
+        room.inputs[Player.CMAN].clear()
+        if room.spirit in sessions:
+            schedule_bot(room, 'cman', bot_socket)
+    elif addr == room.spirit:
+        room.spirit = None
+        room.inputs[Player.SPIRIT].clear()
+        if room.cman in sessions:
+            schedule_bot(room, 'spirit', bot_socket)
+    else:
+        room.watchers.pop(addr, None)
+    del sessions[addr]
+    notify_seats(room)
+    if room.is_empty() and room.end_timer is None and not room.bot_room:  # An ending room is closed by restart_room
+        if room.tick_timer is not None:
+            room.tick_timer.cancel()
+            room.tick_timer = None
+        close_room(room)
+
+
+def evict_idle_sessions():
+    """
+    Evicts the clients silent for idle_timeout seconds and schedules the next check for the
+    moment the least recently seen client would expire. Sessions are ordered by last_seen,
+    so a check only looks at the sessions it evicts.
+    """
+    now = scheduler.time()
+    while sessions:
+        session = next(iter(sessions.values()))
+        if now - session.last_seen < idle_timeout:
+            break
+        evict_session(session)
+    delay = next(iter(sessions.values())).last_seen + idle_timeout - now if sessions else idle_timeout
+    scheduler.call_later(delay, evict_idle_sessions)
+
+
+def watch_sessions():
+    """
+    Starts evicting the idle clients, unless idle_timeout is 0.
+    """
+    if idle_timeout:
+        scheduler.call_later(idle_timeout, evict_idle_sessions)
 
 
 def error_server(error_code):
@@ -179,7 +847,10 @@ def error_server(error_code):
 FUNCTIONS = {
     sl.OPCODE.JOIN: user_try_to_join,
     sl.OPCODE.PLAYER_MOVEMENT: player_movement,
+    sl.OPCODE.STATE_ACK: state_ack,
+    sl.OPCODE.RESYNC: resync,
     sl.OPCODE.QUIT: quit_game,
+    sl.OPCODE.HEARTBEAT: heartbeat,
     sl.OPCODE.GAME_STATE_UPDATE: current_state,
     sl.OPCODE.GAME_END: handle_game_end,
     sl.OPCODE.ERROR: error_server
@@ -189,109 +860,262 @@ FUNCTIONS = {
 def encode_points(game):
     """
     Encodes the points on the board into a compact binary format.
+    The game keeps the collected points as a bitmask, encoding it is a single int to bytes conversion.
 
     Parameters:
         game (Game): The current game instance.
 
     Returns:
         bytes: A bytes object where each bit represents the state of a point
-               (1 for uncollected, 0 for collected), packed into bytes (8 bits each).
+               (1 for collected, 0 for uncollected), packed into bytes (8 bits each).
     """
-    points = list(game.get_points().keys())  # Get the list of point coordinates
-    encoded_bytes = []
-    curr_value = 0
+    return game.get_collected_bytes()
+
 
-    for i in range(1, len(points) + 1): 
-        curr_value *= 2 # Shift left by 1 bit
-        if game.get_points()[points[i - 1]] == 0:  # Check if the point is uncollected #changed_collected
-            curr_value += 1 # Set the least significant bit to 1
-        if i % 8 == 0:  # Pack into a byte after 8 bits
-            encoded_bytes.append(curr_value) # Append the current value to the list
-            curr_value = 0
+def update_room(room, server_socket):
+    """
+    Advances the room's game after a message was handled: starts the round once both
+    players have joined and ends the game once a winner was declared.
+    Parameters:
+        room (Room): The room to update.
+        server_socket (socket): The server socket object.
+    """
+    game = room.game
+    if room.cman and room.spirit and game.state == State.WAIT:
+        game.next_round()
+        journal_event(room, RECORD_KIND.NEXT_ROUND)
+    elif game.state == State.WIN:
+        handle_game_end(room, server_socket)
+    elif room.is_empty() and game.state == State.WAIT and not room.bot_room:
+        close_room(room)
 
-    if len(points) % 8 != 0: # If the last byte is not full
-        encoded_bytes.append(curr_value)
 
-    return bytes(encoded_bytes) # Return the bytes object
+def stats_snapshot():
+    """
+    Returns:
+        dict: The metrics of this process along with the current room and client counts.
+    """
+    return metrics.snapshot({
+        'rooms': len(rooms),
+        'sessions': len(sessions),
+        'watchers': sum(len(room.watchers) for room in rooms.values()),
+        'bots': sum(isinstance(seat, cb.Bot) for room in rooms.values() for seat in (room.cman, room.spirit)),
+        'timers': len(scheduler) if isinstance(scheduler, Scheduler) else None,
+    })
 
 
-def start_game(server_socket):
+def send_stats(server_socket, addr):
     """
-    Starts the game server and listens for incoming messages from clients.
+    Answers a STATS message with the metrics of this process. Only local clients are answered.
     Parameters:
         server_socket (socket): The server socket object.
+        addr (tuple): The address of the client.
     """
+    if addr[0] in ('127.0.0.1', '::1'):
+        server_socket.sendto(sl.pack_stats_server(stats_snapshot()), addr)
 
-    game = cg.Game("map.txt")
-    if game is None:
-        print("Error: Could not load game.")
-        return
 
-    def handle_client_message(message, addr):
-        """
-        Handles a message received from a client.
-        Parameters:
-            message (bytes): The message received from the client.
-            addr (tuple): The address of the client.
-        """
-        # Unpack the message and determine the opcode
-        opcode = message[0]
+def start_profiling(seconds=0):
+    """
+    Profiles the server loop for a few seconds, see ProfilingWindow.
+    Parameters:
+        seconds (float): The length of the window, 0 for profile_seconds.
+    """
+    if not profiling.start(scheduler, seconds or profile_seconds):
+        print("A profiling window is already open.")
+
+
+def handle_timer_error(loop, context):
+    """
+    Counts and prints an exception raised by a scheduled callback, the other callbacks keep running.
+    Installed as the exception handler of the scheduler, or of the asyncio event loop taking its place.
+    Parameters:
+        loop (Scheduler): The scheduler or event loop that ran the callback.
+        context (dict): The 'message' and, usually, the 'exception' of the failure.
+    """
+    metrics.errors += 1
+    cu.clear_print(f"Error: {context.get('exception', context['message'])}")
+
+
+def handle_sigusr1(signal_number, frame):
+    start_profiling()
+
+
+def handle_client_message(server_socket, message, addr):
+    """
+    Handles a message received from a client and records how long it took.
+    Parameters:
+        server_socket (socket): The server socket object.
+        message (bytes): The message received from the client.
+        addr (tuple): The address of the client.
+    """
+    started = time.perf_counter()
+    route_client_message(server_socket, message, addr)
+    metrics.record_in(message[0], len(message), time.perf_counter() - started)
+
+
+def route_client_message(server_socket, message, addr):
+    """
+    Routes a message received from a client to the client's room.
+    Parameters:
+        server_socket (socket): The server socket object.
+        message (bytes): The message received from the client.
+        addr (tuple): The address of the client.
+    """
+    # Unpack the message and determine the opcode
+    opcode = message[0]
+    if opcode == sl.OPCODE.JOIN:
+        room = user_try_to_join(server_socket, message, addr)
+    elif opcode == sl.OPCODE.STATS:
+        send_stats(server_socket, addr)
+        return
+    elif opcode == sl.OPCODE.PROFILE:
+        if addr[0] in ('127.0.0.1', '::1'):
+            start_profiling(sl.unpack_profile_user(message, 1))
+        return
+    else:
+        session = sessions.get(addr)
+        if session is None:  # Not part of any room, nothing to route the message to
+            return
+        session.last_seen = scheduler.time()
+        sessions.move_to_end(addr)
+        room = session.room
         # Call the appropriate function based on the opcode
-        if opcode == sl.OPCODE.JOIN:
-            user_try_to_join(game, server_socket, message, addr)
-        elif opcode == sl.OPCODE.PLAYER_MOVEMENT:
-            player_movement(game, server_socket, message, addr)
+        if opcode == sl.OPCODE.PLAYER_MOVEMENT:
+            player_movement(room, server_socket, message, addr)
+        elif opcode == sl.OPCODE.STATE_ACK:
+            state_ack(room, server_socket, message, addr)
+        elif opcode == sl.OPCODE.RESYNC:
+            resync(room, server_socket, message, addr)
         elif opcode == sl.OPCODE.QUIT:
-            quit_game(game, server_socket, message, addr)
-        elif opcode == sl.OPCODE.GAME_END:
-            handle_game_end(game, server_socket)
+            quit_game(room, server_socket, message, addr)
+        elif opcode == sl.OPCODE.HEARTBEAT:
+            heartbeat(room, server_socket, message, addr)
         else:
             error_message = sl.pack_error_server(0xFF)  # Unknown opcode
             server_socket.sendto(error_message, addr)
+    if room is not None:
+        update_room(room, server_socket)
 
+
+def start_game(server_socket):
+    """
+    Starts the game server and listens for incoming messages from clients.
+    Every message is routed to the room of the client that sent it.
+    Parameters:
+        server_socket (socket): The server socket object.
+    """
+    scheduler.set_exception_handler(handle_timer_error)
+    watch_sessions()
+    if journal_path:
+        open_journal(journal_path)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handle_sigusr1)
+    server_socket = cm.CountingSocket(server_socket, metrics)
+    start_bots(server_socket)
+    stats_socket = cm.open_stats_socket(stats_socket_path) if stats_socket_path else None
+    sockets = [server_socket] + ([stats_socket] if stats_socket else [])
     while True:  # Main server loop
         try:
-            # Use select to wait for socket activity with a timeout
-            readable, _, _ = select.select([server_socket], [], [], 1.0)
+            # Use select to wait for socket activity until the next scheduled deadline
+            readable, _, _ = select.select(sockets, [], [], scheduler.timeout())
+            metrics.wakeups += 1
             if server_socket in readable:
                 message, addr = server_socket.recvfrom(BUFFERSIZE)
-                handle_client_message(message, addr)
-
-                if cman and spirit and game.state == State.WAIT:
-                    game.next_round()
-                elif game.state == State.WIN:
-                    handle_game_end(game, server_socket)
-                    game.restart_game()
+                handle_client_message(server_socket, message, addr)
+            if stats_socket in readable:
+                cm.serve_stats(stats_socket, stats_snapshot())
+            scheduler.run_due()
 
         except Exception as e:
+            metrics.errors += 1
             cu.clear_print(f"Error: {e}") 
 
 # Graceful shutdown function
 def handle_sigint(signal_number, frame):
     print("\nServer is shutting down gracefully...")
+    close_journal()
     sys.exit(0)
 
 
 if __name__ == "__main__":
+    # Run the importable module, so the engines, the worker processes and the settings share the same globals
+    import cman_server as server
     host = 'localhost'
-    port = 1337
-    signal.signal(signal.SIGINT, handle_sigint)
+    signal.signal(signal.SIGINT, server.handle_sigint)
+    signal.signal(signal.SIGTERM, server.handle_sigint)
 
-    if len(sys.argv) == 2: # If only the port number is provided
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print("Invalid port number")
-            sys.exit(1)
-    if len(sys.argv) > 3:
-        print("wrong number of arguments")
+    parser = argparse.ArgumentParser(description="C-Man server")
+    parser.add_argument('port', nargs='?', default='1337', help="port to bind")
+    parser.add_argument('--map', default=MAP_PATH, help="map file of the games (default: %(default)s)")
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select',
+                        help="server loop implementation (default: select)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port with SO_REUSEPORT (select engine only)")
+    parser.add_argument('--tick-rate', type=float, default=0,
+                        help="simulate every room at a fixed number of ticks per second, sending one snapshot "
+                             "per tick (default: apply every input immediately)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence after which a client is evicted and its seat freed, "
+                             "0 never evicts (default: %(default)s)")
+    parser.add_argument('--stats-socket', default=None,
+                        help="path of a UNIX socket serving the server metrics as JSON, "
+                             "every worker serves its own at <path>.<worker>")
+    parser.add_argument('--profile-seconds', type=float, default=cp.PROFILE_SECONDS,
+                        help="length of the profiling window opened by SIGUSR1 (default: %(default)s)")
+    parser.add_argument('--profile-dir', default='.',
+                        help="directory the profiling reports are written to (default: the working directory)")
+    parser.add_argument('--journal', default=None,
+                        help="record the accepted inputs and the room events in this binary journal, "
+                             "every worker writes its own at <path>.<worker>")
+    parser.add_argument('--bots', choices=['cman', 'spirit', 'both'], default=None,
+                        help="let a bot take the C-Man or Spirit seat, or both, when no client took it")
+    parser.add_argument('--bot-delay', type=float, default=BOT_DELAY,
+                        help="seconds a free seat waits for a client before a bot takes it (default: %(default)s)")
+    parser.add_argument('--bot-rate', type=float, default=BOT_RATE,
+                        help="moves per second of a bot (default: %(default)s)")
+    parser.add_argument('--bot-rooms', type=int, default=0,
+                        help="rooms played by two bots kept open, every worker opens its own (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        port = int(args.port)
+    except ValueError:
+        print("Invalid port number")
         sys.exit(1)
+    if args.bot_rate <= 0:
+        parser.error("--bot-rate must be positive")
+    server.map_path = args.map
+    server.tick_rate = args.tick_rate
+    server.idle_timeout = args.idle_timeout
+    server.stats_socket_path = args.stats_socket
+    server.journal_path = args.journal
+    server.profile_seconds = args.profile_seconds
+    server.profiling.directory = args.profile_dir
+    server.bot_roles = ('cman', 'spirit') if args.bots == 'both' else (args.bots,) if args.bots else ()
+    server.bot_delay = args.bot_delay
+    server.bot_rate = args.bot_rate
+    server.bot_rooms = args.bot_rooms
     try:
-        soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        soc.bind((host, port))
-        start_game(soc)
+        server.prepare_bots()
+    except (OSError, ValueError) as e:
+        print("Error: ", e)
+        sys.exit(1)
+    try:
+        if args.workers > 1:
+            if args.engine != 'select':
+                print("Worker processes are only supported by the select engine")
+                sys.exit(1)
+            import cman_workers
+            cman_workers.start_workers(host, port, args.workers)
+        elif args.engine == 'asyncio':
+            import cman_server_async
+            cman_server_async.start_game(host, port)
+        else:
+            soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            soc.bind((host, port))
+            server.start_game(soc)
         
     except socket.error as e:   
         print("Error: ", e)
         sys.exit(1)
-        
\ No newline at end of file
@@ -0,0 +1,76 @@
+import asyncio
+import signal
+import cman_metrics as cm
+import cman_server as cs
+import cman_utils as cu
+
+
+class CManServerProtocol(asyncio.DatagramProtocol):
+    """
+    Serves the game over an asyncio datagram endpoint.
+    Every datagram is handed to the same handlers as the select based server loop,
+    the transport takes the place of the server socket.
+    """
+
+    def __init__(self):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = cm.CountingSocket(transport, cs.metrics)
+
+    def datagram_received(self, data, addr):
+        """
+        Handles a message received from a client.
+        Parameters:
+            data (bytes): The message received from the client.
+            addr (tuple): The address of the client.
+        """
+        try:
+            cs.handle_client_message(self.transport, data, addr)
+        except Exception as e:
+            cs.metrics.errors += 1
+            cu.clear_print(f"Error: {e}")
+
+    def error_received(self, exc):
+        cu.clear_print(f"Error: {exc}")
+
+
+async def serve(host, port):
+    """
+    Binds the server endpoint and serves clients until the task is cancelled.
+    Parameters:
+        host (str): The address to bind.
+        port (int): The port to bind.
+    """
+    loop = asyncio.get_running_loop()
+    # Game end announcements and room restarts become event loop callbacks
+    cs.scheduler = loop
+    loop.set_exception_handler(cs.handle_timer_error)
+    transport, protocol = await loop.create_datagram_endpoint(CManServerProtocol, local_addr=(host, port))
+    cs.watch_sessions()
+    if cs.journal_path:
+        cs.open_journal(cs.journal_path)
+    cs.start_bots(protocol.transport)  # After the journal, so the rooms of the bots are recorded
+    if hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1, cs.start_profiling)
+    stats_socket = None
+    if cs.stats_socket_path:
+        stats_socket = cm.open_stats_socket(cs.stats_socket_path)
+        loop.add_reader(stats_socket, lambda: cm.serve_stats(stats_socket, cs.stats_snapshot()))
+    try:
+        await asyncio.Future()  # Serve forever
+    finally:
+        transport.close()
+        if stats_socket:
+            loop.remove_reader(stats_socket)
+            stats_socket.close()
+
+
+def start_game(host, port):
+    """
+    Starts the asyncio game server and listens for incoming messages from clients.
+    Parameters:
+        host (str): The address to bind.
+        port (int): The port to bind.
+    """
+    asyncio.run(serve(host, port))
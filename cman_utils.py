@@ -1,4 +1,8 @@
-import pynput, time
+import queue, socket, sys, threading, time
+try:
+    import pynput
+except ImportError:
+    pynput = None  # Only the keyboard input source needs it
 
 def _flush_input():
     try:
@@ -41,6 +45,210 @@ def get_pressed_keys(keys_filter = None):
     else:
         return [k for k in keys_filter if k in keys_lst]
 
+class InputSource:
+    """
+
+    A long-lived source of key presses. Every press is pushed into a thread safe queue
+    and the game loop drains it without blocking, so no press is lost between two iterations.
+    The source also has a file descriptor that becomes readable when a key is queued, so the
+    game loop can wait for it with select alongside its sockets.
+
+    Parameters:
+
+    keys_filter (list[str]): A list of specific keys to report. If omitted, every key is reported.
+
+    """
+    def __init__(self, keys_filter = None):
+        self.keys_filter = keys_filter
+        self.events = queue.Queue()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def fileno(self):
+        """
+
+        Returns:
+
+        int: A file descriptor that is readable while pressed keys are queued.
+
+        """
+        return self._wakeup_recv.fileno()
+
+    def push(self, key):
+        """
+
+        Queues a key press, unless it is filtered out.
+
+        """
+        if self.keys_filter is None or key in self.keys_filter:
+            self.events.put(key)
+            try:
+                self._wakeup_send.send(b'\0')
+            except BlockingIOError:
+                pass  # The reader is already woken up
+
+    def get_keys(self):
+        """
+
+        Returns the keys pressed since the last call, in the order they were pressed. Never blocks.
+
+        Returns:
+
+        list[str]: The pressed keys.
+
+        """
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        keys_lst = []
+        while True:
+            try:
+                keys_lst.append(self.events.get_nowait())
+            except queue.Empty:
+                return keys_lst
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+
+class KeyboardInput(InputSource):
+    """
+
+    Reports the keys pressed on the keyboard through a single pynput listener that lives as long as the game.
+
+    """
+    def __init__(self, keys_filter = None):
+        super().__init__(keys_filter)
+        if pynput is None:
+            raise RuntimeError("keyboard input requires the pynput package.")
+        self.listener = pynput.keyboard.Listener(on_press=self._on_press)
+
+    def _on_press(self, key):
+        try:
+            self.push(key.char)
+        except AttributeError:
+            self.push(str(key))
+
+    def get_keys(self):
+        keys_lst = super().get_keys()
+        if keys_lst:
+            _flush_input()  # The presses were also typed into the terminal
+        return keys_lst
+
+    def start(self):
+        self.listener.start()
+        return self
+
+    def stop(self):
+        self.listener.stop()
+        _flush_input()
+
+
+class StreamInput(InputSource):
+    """
+
+    Reports the characters read from a stream, every character being a key press. Needs no display,
+    so it can drive the game from a pipe or the standard input. On a terminal the input is read
+    without waiting for Enter.
+
+    Parameters:
+
+    stream (file): The text stream to read. Defaults to the standard input.
+
+    """
+    def __init__(self, keys_filter = None, stream = None):
+        super().__init__(keys_filter)
+        self.stream = stream or sys.stdin
+        self._saved_mode = None
+
+    def _read(self):
+        while True:
+            char = self.stream.read(1)
+            if not char:
+                return
+            if not char.isspace():
+                self.push(char)
+
+    def start(self):
+        try:
+            import termios, tty
+            if self.stream.isatty():
+                self._saved_mode = termios.tcgetattr(self.stream)
+                tty.setcbreak(self.stream)
+        except ImportError:
+            pass
+        threading.Thread(target=self._read, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._saved_mode is not None:
+            import termios
+            termios.tcsetattr(self.stream, termios.TCSADRAIN, self._saved_mode)
+            self._saved_mode = None
+
+
+class ScriptedInput(InputSource):
+    """
+
+    Replays key presses from a script file, for tests and automated players.
+    Every line either lists keys to press one after the other, or reads "wait <seconds>".
+
+    Parameters:
+
+    path (str): The path to the script file.
+
+    interval (float): The delay between two key presses, in seconds.
+
+    """
+    def __init__(self, path, keys_filter = None, interval = 0.1):
+        super().__init__(keys_filter)
+        with open(path, 'r') as f:
+            self.script = f.read().splitlines()
+        self.interval = interval
+
+    def _play(self):
+        for line in self.script:
+            words = line.split()
+            if len(words) == 2 and words[0] == 'wait':
+                time.sleep(float(words[1]))
+                continue
+            for char in ''.join(words):
+                self.push(char)
+                time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._play, daemon=True).start()
+        return self
+
+
+def open_input(name, keys_filter = None):
+    """
+
+    Creates and starts an input source.
+
+    Parameters:
+
+    name (str): "keyboard", "stdin", or the path to a script file.
+
+    keys_filter (list[str]): A list of specific keys to report. If omitted, every key is reported.
+
+    Returns:
+
+    InputSource: The started input source.
+
+    """
+    if name == 'keyboard':
+        return KeyboardInput(keys_filter).start()
+    if name == 'stdin':
+        return StreamInput(keys_filter).start()
+    return ScriptedInput(name, keys_filter).start()
+
 def clear_print(*args, **kwargs):
     """
 
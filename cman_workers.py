@@ -0,0 +1,431 @@
+import json
+import os
+import re
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+import cman_metrics as cm
+import cman_server as cs
+import cman_utils as cu
+import shared_libary as sl
+from cman_game import State
+
+BYTE = struct.Struct('>B')
+REPORT_INTERVAL = 1  # Seconds between two load reports of a worker
+FORWARD_HEADER = struct.Struct('>BB4sH')  # Kind, worker it comes from, client IPv4 address and port of an inbox datagram
+WORKER_ROOM = re.compile(r'^w(\d+)-(m?)\d+$')  # Names of the rooms generated by a worker, w<k>-m<n> by the lobby
+LOBBY_WORKER = 0  # Worker matching the players that join without a room name
+MATCH_MEMORY = 10  # Seconds a JOIN sent again by a client goes to the room the lobby placed it in
+OTHER_ROLE = {'cman': 'spirit', 'spirit': 'cman'}
+WAITING_ROLES = (None, 'cman', 'spirit')  # Roles a room of the lobby waits for, as sent in a SEATS datagram
+
+
+# Kinds of the datagrams the workers send to each other's inbox
+class FORWARD_KIND:
+    MESSAGE = 0x00  # A client datagram, for the worker hosting the client's room
+    OWNER = 0x01  # '>B' the worker the lobby placed the client on, for the worker receiving the client's datagrams
+    SEATS = 0x02  # '>B' index in WAITING_ROLES followed by the name of a room of the lobby, for the lobby
+
+
+def room_owner(room_name, worker_count):
+    """
+    Returns the index of the worker that hosts a room.
+    Rooms generated by a worker stay on it, named rooms are spread by a hash of their name.
+    Parameters:
+        room_name (str): The name of the room.
+        worker_count (int): The number of workers.
+    Returns:
+        int: The index of the owning worker.
+    """
+    match = WORKER_ROOM.match(room_name)
+    if match and int(match.group(1)) < worker_count:
+        return int(match.group(1))
+    return zlib.crc32(room_name.encode('utf-8')) % worker_count
+
+
+def pack_forward(message, addr, origin, kind=FORWARD_KIND.MESSAGE):
+    """
+    Prepends the kind, the sending worker and the client address to a datagram sent to another worker.
+    """
+    return FORWARD_HEADER.pack(kind, origin, socket.inet_aton(addr[0]), addr[1]) + message
+
+
+def unpack_forward(data):
+    """
+    Splits a datagram received from another worker.
+    Returns:
+        tuple: The FORWARD_KIND, the sending worker, the message and the client address.
+    """
+    kind, origin, ip, port = FORWARD_HEADER.unpack_from(data)
+    return kind, origin, data[FORWARD_HEADER.size:], (socket.inet_ntoa(ip), port)
+
+
+def is_lobby_join(message):
+    """
+    Returns:
+        bool: Whether a client datagram is a player's JOIN without a room name, which the lobby places.
+    """
+    return (len(message) > 0 and message[0] == sl.OPCODE.JOIN and sl.unpack_join_room(message, 1) is None
+            and sl.unpack_join_user(message, 1) != 'watcher')
+
+
+class Worker:
+    """
+    A server process sharing the game port with its siblings through SO_REUSEPORT.
+    The kernel spreads the clients over the workers by address, so a datagram may reach a worker
+    that does not host the client's room. Such datagrams are forwarded to the owning worker over
+    its inbox, and the owner answers the client directly from the shared port. Game state is
+    therefore never shared between processes.
+    Players joining without a room name are all sent to LOBBY_WORKER, which only matches them: it puts
+    them in a room waiting for their role, or names a new room for the next worker in turn, and forwards
+    their JOIN with the room name. The hosts report the seats of these rooms back to the lobby.
+    Watchers joining without a room name watch a room of the worker that received them.
+    Attributes:
+        index (int): The index of this worker.
+        server_socket (socket): The socket bound to the shared game port.
+        inboxes (list): One datagram socket per worker receiving the forwarded messages.
+        report_socket (socket): The socket the load reports are sent to the supervisor on.
+        owners (OrderedDict): Client address -> (index of the worker hosting the client's room, scheduler time
+                              the client was last seen), for remote rooms, least recently seen first.
+        matches (OrderedDict): On the lobby, client address -> (room the client was placed in, scheduler time),
+                               so a JOIN sent again within MATCH_MEMORY seconds goes to the same room.
+        waiting (dict): On the lobby, role -> OrderedDict of the names of the rooms waiting for that role.
+        reported (dict): Name -> role waited for, of the rooms of the lobby hosted here, as last reported.
+    """
+
+    def __init__(self, index, server_socket, inboxes, report_socket):
+        self.index = index
+        self.server_socket = server_socket
+        self.inboxes = inboxes
+        self.report_socket = report_socket
+        self.owners = OrderedDict()
+        self.matches = OrderedDict()
+        self.waiting = {'cman': OrderedDict(), 'spirit': OrderedDict()}
+        self.reported = {}
+        self.next_host = 0
+        self.lobby_rooms = 0
+        self.handled = 0
+        self.forwarded = 0
+        self.cpu_time = sum(os.times()[:2])
+
+    def route(self, message, addr):
+        """
+        Handles a datagram received from a client, or forwards it to the worker hosting the client's room.
+        Parameters:
+            message (bytes): The message received from the client.
+            addr (tuple): The address of the client.
+        """
+        if message and message[0] == sl.OPCODE.JOIN:
+            room_name = sl.unpack_join_room(message, 1)
+            if room_name is not None:
+                owner = room_owner(room_name, len(self.inboxes))
+            else:
+                owner = LOBBY_WORKER if is_lobby_join(message) else self.index
+        else:
+            owner = self.owners[addr][0] if addr in self.owners else self.index
+        if owner == self.index or (message and message[0] == sl.OPCODE.QUIT):
+            self.owners.pop(addr, None)
+        else:
+            self.owners[addr] = (owner, cs.scheduler.time())
+            self.owners.move_to_end(addr)
+
+        if owner == self.index:
+            self.deliver(message, addr, self.index)
+        else:
+            self.forward(owner, message, addr)
+
+    def forward(self, owner, message, addr):
+        """
+        Forwards a client datagram to the worker hosting the client's room.
+        """
+        self.forwarded += 1
+        self.inboxes[owner].send(pack_forward(message, addr, self.index))
+
+    def deliver(self, message, addr, origin):
+        """
+        Handles a client datagram meant for this worker, received directly or from the worker origin.
+        """
+        if self.index == LOBBY_WORKER:
+            if is_lobby_join(message):
+                self.match(message, addr, origin)
+                return
+            if origin != self.index and message and message[0] == sl.OPCODE.JOIN:
+                self.owners.pop(addr, None)  # The client now joins a room of this worker
+            elif origin != self.index and addr in self.owners:
+                # Sent by origin before it learnt where the lobby placed the client
+                self.forward(self.owners[addr][0], message, addr)
+                return
+        self.handled += 1
+        cs.handle_client_message(self.server_socket, message, addr)
+
+    def match(self, message, addr, origin):
+        """
+        Places a player joining without a room name, on the lobby: in the oldest room waiting for the
+        player's role, or in a new room named for the next worker in turn, which then waits for the other role.
+        The JOIN is forwarded with the room name, and origin learns which worker hosts the client.
+        Parameters:
+            message (bytes): The JOIN of the client.
+            addr (tuple): The address of the client.
+            origin (int): The worker that received the JOIN from the client.
+        """
+        role = sl.unpack_join_user(message, 1)
+        now = cs.scheduler.time()
+        while self.matches and now - next(iter(self.matches.values()))[1] >= MATCH_MEMORY:
+            self.matches.popitem(last=False)
+        if addr in self.matches:
+            room_name = self.matches[addr][0]  # A retried join, its answer was lost
+        elif role not in OTHER_ROLE:
+            self.handled += 1
+            cs.handle_client_message(self.server_socket, message, addr)  # Refused by the server
+            return
+        elif self.waiting[role]:
+            room_name = self.waiting[role].popitem(last=False)[0]
+        else:
+            host = self.next_host
+            self.next_host = (host + 1) % len(self.inboxes)
+            self.lobby_rooms += 1
+            room_name = f"w{host}-m{self.lobby_rooms}"
+            self.waiting[OTHER_ROLE[role]][room_name] = True  # Until its host reports the seats
+        self.matches.pop(addr, None)
+        self.matches[addr] = (room_name, now)
+
+        owner = room_owner(room_name, len(self.inboxes))
+        if origin != self.index:
+            self.inboxes[origin].send(pack_forward(BYTE.pack(owner), addr, self.index, FORWARD_KIND.OWNER))
+        self.set_owner(addr, owner)
+        message = sl.pack_join_User(role, room_name, sl.unpack_join_capabilities(message, 1))
+        if owner == self.index:
+            self.handled += 1
+            cs.handle_client_message(self.server_socket, message, addr)
+        else:
+            self.forward(owner, message, addr)
+
+    def set_owner(self, addr, owner):
+        """
+        Records the worker hosting the room of a client.
+        """
+        if owner == self.index:
+            self.owners.pop(addr, None)
+        else:
+            self.owners[addr] = (owner, cs.scheduler.time())
+            self.owners.move_to_end(addr)
+
+    def report_seats(self, room):
+        """
+        Tells the lobby which role a room it named waits for, when that changed. Installed as
+        cman_server.seats_changed.
+        Parameters:
+            room (Room): The room whose seats changed.
+        """
+        name_match = WORKER_ROOM.match(room.name)
+        if not name_match or not name_match.group(2):
+            return  # Not a room of the lobby
+        waiting = None
+        if cs.rooms.get(room.name) is room and room.game.state != State.WIN and (room.cman is None) != (room.spirit is None):
+            waiting = 'cman' if room.cman is None else 'spirit'
+        if self.reported.get(room.name) == waiting:
+            return
+        if waiting is None:
+            self.reported.pop(room.name, None)
+        else:
+            self.reported[room.name] = waiting
+        if self.index == LOBBY_WORKER:
+            self.update_waiting(room.name, waiting)
+        else:
+            payload = BYTE.pack(WAITING_ROLES.index(waiting)) + room.name.encode('utf-8')
+            self.inboxes[LOBBY_WORKER].send(pack_forward(payload, ('0.0.0.0', 0), self.index, FORWARD_KIND.SEATS))
+
+    def update_waiting(self, room_name, waiting):
+        """
+        Records the role a room of the lobby waits for, on the lobby.
+        Parameters:
+            room_name (str): The name of the room.
+            waiting (str): The role the room waits for, or None once it is full or closed.
+        """
+        for role, rooms in self.waiting.items():
+            if role != waiting:
+                rooms.pop(room_name, None)
+        if waiting is not None:
+            self.waiting[waiting][room_name] = True
+
+    def receive(self, data):
+        """
+        Handles a datagram of another worker received on the inbox.
+        """
+        kind, origin, message, addr = unpack_forward(data)
+        if kind == FORWARD_KIND.MESSAGE:
+            self.deliver(message, addr, origin)
+        elif kind == FORWARD_KIND.OWNER:
+            self.set_owner(addr, message[0])
+        elif kind == FORWARD_KIND.SEATS:
+            self.update_waiting(message[1:].decode('utf-8'), WAITING_ROLES[message[0]])
+
+    def expire_owners(self):
+        """
+        Forgets the owners of the clients silent for idle_timeout seconds, which their owning worker evicted
+        meanwhile or whose room closed, and schedules the next check like cman_server.evict_idle_sessions.
+        """
+        now = cs.scheduler.time()
+        while self.owners and now - next(iter(self.owners.values()))[1] >= cs.idle_timeout:
+            self.owners.popitem(last=False)
+        delay = next(iter(self.owners.values()))[1] + cs.idle_timeout - now if self.owners else cs.idle_timeout
+        cs.scheduler.call_later(delay, self.expire_owners)
+
+    def report(self):
+        """
+        Sends the load of this worker to the supervisor and schedules the next report.
+        """
+        cpu_time = sum(os.times()[:2])
+        load = {
+            'worker': self.index,
+            'pid': os.getpid(),
+            'handled': self.handled,
+            'forwarded': self.forwarded,
+            'cpu': (cpu_time - self.cpu_time) / REPORT_INTERVAL,
+            'rooms': len(cs.rooms),
+            'clients': len(cs.sessions),
+        }
+        self.handled = self.forwarded = 0
+        self.cpu_time = cpu_time
+        try:
+            self.report_socket.send(json.dumps(load).encode('utf-8'))
+        except OSError:
+            pass  # The supervisor is gone or busy, the next report will catch up
+        cs.scheduler.call_later(REPORT_INTERVAL, self.report)
+
+    def run(self):
+        """
+        The worker loop: serves the shared port and the worker's inbox until the process is terminated.
+        """
+        inbox = self.inboxes[self.index]
+        cs.room_name_prefix = f"w{self.index}-"
+        cs.seats_changed = self.report_seats
+        cs.scheduler.set_exception_handler(cs.handle_timer_error)
+        cs.scheduler.call_later(REPORT_INTERVAL, self.report)
+        cs.watch_sessions()
+        if cs.idle_timeout:
+            cs.scheduler.call_later(cs.idle_timeout, self.expire_owners)
+        if cs.journal_path:
+            cs.open_journal(f"{cs.journal_path}.{self.index}")
+        self.server_socket = cm.CountingSocket(self.server_socket, cs.metrics)
+        cs.start_bots(self.server_socket)
+        sockets = [self.server_socket, inbox]
+        stats_socket = None
+        if cs.stats_socket_path:
+            stats_socket = cm.open_stats_socket(f"{cs.stats_socket_path}.{self.index}")
+            sockets.append(stats_socket)
+        while True:
+            try:
+                readable, _, _ = select.select(sockets, [], [], cs.scheduler.timeout())
+                cs.metrics.wakeups += 1
+                if self.server_socket in readable:
+                    message, addr = self.server_socket.recvfrom(cs.BUFFERSIZE)
+                    self.route(message, addr)
+                if inbox in readable:
+                    self.receive(inbox.recv(cs.BUFFERSIZE + FORWARD_HEADER.size))
+                if stats_socket in readable:
+                    cm.serve_stats(stats_socket, cs.stats_snapshot())
+                cs.scheduler.run_due()
+
+            except Exception as e:
+                cs.metrics.errors += 1
+                cu.clear_print(f"Error: {e}")
+
+
+def stop_worker(signal_number, frame):
+    cs.close_journal()
+    os._exit(0)
+
+
+def bind_shared_socket(host, port):
+    """
+    Creates a UDP socket bound to the game port that other workers may bind as well.
+    """
+    soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    soc.bind((host, port))
+    return soc
+
+
+def start_workers(host, port, worker_count):
+    """
+    Forks the worker processes and supervises them, printing the load of every worker.
+    Parameters:
+        host (str): The address to bind.
+        port (int): The port shared by all workers.
+        worker_count (int): The number of worker processes.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        print("Error: worker processes require SO_REUSEPORT and fork support.")
+        sys.exit(1)
+
+    # Every worker may write to every inbox, only its owner reads from it
+    inbox_pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(worker_count)]
+    report_socket, worker_report_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    report_socket.setblocking(False)
+    worker_report_socket.setblocking(False)
+
+    pids = []
+    for index in range(worker_count):
+        server_socket = bind_shared_socket(host, port)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor shuts the workers down
+            signal.signal(signal.SIGTERM, stop_worker)
+            signal.signal(signal.SIGUSR1, cs.handle_sigusr1)  # The supervisor passes profiling requests on
+            report_socket.close()
+            inboxes = [pair[1] for pair in inbox_pairs]
+            inboxes[index] = inbox_pairs[index][0]
+            Worker(index, server_socket, inboxes, worker_report_socket).run()
+            os._exit(0)
+        server_socket.close()
+        pids.append(pid)
+
+    def stop_workers(signal_number, frame):
+        print("\nServer is shutting down gracefully...")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    def profile_workers(signal_number, frame):
+        for pid in pids:
+            if pid:
+                os.kill(pid, signal.SIGUSR1)
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGUSR1, profile_workers)
+    print(f"Serving on {host}:{port} with {worker_count} workers.")
+
+    loads = {}
+    next_print = time.monotonic() + REPORT_INTERVAL
+    while True:
+        readable, _, _ = select.select([report_socket], [], [], max(0.0, next_print - time.monotonic()))
+        while readable:
+            try:
+                load = json.loads(report_socket.recv(4096))
+                loads[load['worker']] = load
+            except BlockingIOError:
+                break
+            except ValueError:
+                continue
+        for index, pid in enumerate(pids):
+            if pid and os.waitpid(pid, os.WNOHANG)[0] == pid:
+                print(f"Worker {index} (pid {pid}) exited.")
+                pids[index] = 0
+                loads.pop(index, None)
+        if time.monotonic() >= next_print:
+            next_print += REPORT_INTERVAL
+            if loads:
+                print(" | ".join(
+                    f"w{load['worker']}: {load['handled']} msg/s, {load['forwarded']} fwd/s, "
+                    f"cpu {load['cpu']:.0%}, {load['rooms']} rooms, {load['clients']} clients"
+                    for _, load in sorted(loads.items())))
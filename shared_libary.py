@@ -1,29 +1,163 @@
+import json
 import struct
 from cman_game import Direction
 FORMAT = '>B'
+ROOM_SEPARATOR = b'\x00'
+HEARTBEAT_INTERVAL = 5  # Seconds between two heartbeats of an idle client, servers evict clients silent for much longer
 
 
 # Define the OPCODEs for the protocol
 class OPCODE: # Operation Code
     JOIN = 0x00
     PLAYER_MOVEMENT = 0x01
+    STATE_ACK = 0x02
+    RESYNC = 0x03
+    HEARTBEAT = 0x04
+    STATS = 0x05
+    PROFILE = 0x06
     QUIT = 0x0F
     GAME_STATE_UPDATE = 0x80
+    GAME_STATE_KEYFRAME = 0x81
+    GAME_STATE_DELTA = 0x82
+    GAME_STATE_UPDATE_V2 = 0x83
+    GAME_STATE_KEYFRAME_V2 = 0x84
+    STATS_REPLY = 0x85
+    GAME_END_V2 = 0x86
     GAME_END = 0x8F
     ERROR = 0xFF
 
 
+# Flags of the fields present in a game state delta, in the order they are packed
+class DELTA:
+    FREEZE = 0x01  # '>B'
+    CMAN = 0x02  # '>BB'
+    SPIRIT = 0x04  # '>BB'
+    ATTEMPTS = 0x08  # '>B'
+    COLLECTED = 0x10  # '>H' count followed by one '>H' index per newly collected point
+
+
+# Capability flags a client sends in its JOIN message
+class CAPABILITY:
+    VARIABLE_POINTS = 0x01  # Decodes the V2 game states, which carry any number of points
+
+
+# Encodings of the collected points of a V2 game state, the server sends the smallest one
+class COLLECTED_ENCODING:
+    BITMAP = 0x00  # (point count + 7) // 8 bytes, the first point being the most significant bit
+    COLLECTED = 0x01  # '>H' count followed by the '>H' indices of the collected points
+    UNCOLLECTED = 0x02  # '>H' count followed by the '>H' indices of the points left to collect
+
+
 # Define the packet formats for each OPCODE
 PACKET_FORMATS = {
-    0x00: '>B',  # Join
+    0x00: '>B',  # Join: role, then optionally a separator, the room, a separator and the capability flags
     0x01: '>B',  # Player Movement
+    0x02: '>I',  # State Ack
+    0x03: '',  # Resync
+    0x04: '',  # Heartbeat
+    0x05: '',  # Stats request, answered on loopback only
+    0x06: '>H',  # Profile request (seconds, 0 for the server's default), accepted on loopback only
     0x0F: '',  # Quit
     0x80: '>BBBBBB5s',  # Game State Update
+    0x81: '>IBBBBBB5s',  # Game State Keyframe
+    0x82: '>IBB',  # Game State Delta header (seq, seq - base_seq, flags), followed by the changed fields
+    0x83: '>BBBBBBHB',  # Game State Update V2 (point count, collected encoding), followed by the collected points
+    0x84: '>IBBBBBBHB',  # Game State Keyframe V2, see 0x83
+    0x85: '',  # Stats reply, UTF-8 JSON
+    0x86: '>BHH',  # Game End V2, the scores of maps with more than 255 points
     0x8F: 'BBB',  # Game End
     0xFF: '>11s',  # Error
 }
 
 
+# Precompiled codecs of the fixed size messages, the opcode included
+OPCODE_CODEC = struct.Struct(FORMAT)
+STATE_UPDATE_CODEC = struct.Struct('>BBBBBBB5s')
+KEYFRAME_CODEC = struct.Struct('>BIBBBBBB5s')
+DELTA_HEADER_CODEC = struct.Struct('>BIBB')
+GAME_END_CODEC = struct.Struct('>BBBB')
+GAME_END_V2_CODEC = struct.Struct('>BBHH')
+ERROR_CODEC = struct.Struct('>BB')
+STATE_ACK_CODEC = struct.Struct('>BI')
+BYTE_CODEC = struct.Struct('>B')
+COORDS_CODEC = struct.Struct('>BB')
+COUNT_CODEC = struct.Struct('>H')
+STATE_UPDATE_V2_CODEC = struct.Struct('>BBBBBBBHB')
+KEYFRAME_V2_CODEC = struct.Struct('>BIBBBBBBHB')
+# The same layouts without the opcode, the unpack functions read them at the offset of the payload
+STATE_UPDATE_FIELDS = struct.Struct('>BBBBBB5s')
+KEYFRAME_FIELDS = struct.Struct('>IBBBBBB5s')
+DELTA_HEADER_FIELDS = struct.Struct('>IBB')
+GAME_END_FIELDS = struct.Struct('>BBB')
+GAME_END_V2_FIELDS = struct.Struct('>BHH')
+STATE_ACK_FIELDS = struct.Struct('>I')
+STATE_UPDATE_V2_FIELDS = struct.Struct('>BBBBBBHB')
+KEYFRAME_V2_FIELDS = struct.Struct('>IBBBBBBHB')
+QUIT_MESSAGE = OPCODE_CODEC.pack(OPCODE.QUIT)
+RESYNC_MESSAGE = OPCODE_CODEC.pack(OPCODE.RESYNC)
+HEARTBEAT_MESSAGE = OPCODE_CODEC.pack(OPCODE.HEARTBEAT)
+STATS_MESSAGE = OPCODE_CODEC.pack(OPCODE.STATS)
+PROFILE_CODEC = struct.Struct('>BH')
+MOVEMENT_MESSAGES = {int(d): OPCODE_CODEC.pack(OPCODE.PLAYER_MOVEMENT) + str(int(d)).encode() for d in Direction}
+
+
+class CollectedBits:
+    """
+    Read-only view of a collected points bitmap, the first point being the most significant bit.
+    Bits are only extracted when they are accessed, so unpacking a game state does not build a list.
+    Compares equal to a list of the same bits.
+    """
+    __slots__ = ('value', 'size')
+
+    def __init__(self, value, size):
+        self.value = value
+        self.size = size
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, 'big'), len(data) * 8)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("collected point index out of range")
+        return self.value >> (self.size - 1 - index) & 1
+
+    def __iter__(self):
+        return (self.value >> bit & 1 for bit in range(self.size - 1, -1, -1))
+
+    def __eq__(self, other):
+        if isinstance(other, CollectedBits):
+            return self.value == other.value and self.size == other.size
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"CollectedBits({self.value:#x}, {self.size})"
+
+    def count(self):
+        """
+        Returns:
+        int: The number of collected points.
+        """
+        return bin(self.value).count('1')
+
+    def with_collected(self, indices):
+        """
+        Returns a copy of the bitmap with the given points marked as collected.
+        """
+        value = self.value
+        for index in indices:
+            value |= 1 << (self.size - 1 - index)
+        return CollectedBits(value, self.size)
+
+
 def pack_message_client(opcode, data) -> bytes:
     """
     binary message format include the request type from the client and the data
@@ -31,16 +165,23 @@ def pack_message_client(opcode, data) -> bytes:
     opcode (int): The operation code for the message.
     data (bytes): The data to be sent in the message.
     """
-    return struct.pack(FORMAT, opcode) + data 
+    return OPCODE_CODEC.pack(opcode) + data 
 
 
-def pack_join_User(role) -> bytes:
+def pack_join_User(role, room=None, capabilities=0) -> bytes:
     """"
     Pack the role of the player into a binary message.
     Parameters:
     role (str): The role of the player (cman, spirit, or watcher).
+    room (str): Optional name of the room to join, the server picks one when omitted.
+    capabilities (int): CAPABILITY flags of the client, servers send legacy game states to clients without flags.
     """
-    return pack_message_client(OPCODE.JOIN, role.encode('utf-8'))
+    data = role.encode('utf-8')
+    if room or capabilities:
+        data += ROOM_SEPARATOR + (room or '').encode('utf-8')
+    if capabilities:
+        data += ROOM_SEPARATOR + BYTE_CODEC.pack(capabilities)
+    return pack_message_client(OPCODE.JOIN, data)
 
 
 def pack_player_movement_User(direction) -> bytes:
@@ -49,14 +190,29 @@ def pack_player_movement_User(direction) -> bytes:
     Parameters:
     direction (Direction): The direction the player wants to move.
     """
-    return pack_message_client(OPCODE.PLAYER_MOVEMENT, str(int(direction)).encode())
+    return MOVEMENT_MESSAGES[int(direction)]
 
 
 def pack_quit_User() -> bytes:
     """
     Pack the quit message into a binary message.
     """
-    return pack_message_client(OPCODE.QUIT, b'')
+    return QUIT_MESSAGE
+
+
+def _validate_state(state: dict):
+    """
+    Checks that a game state dictionary can be packed.
+    """
+    freeze = state['freeze']
+    c_coords = state['c_coords']
+    s_coords = state['s_coords']
+    # Non integers are rejected by the codecs themselves, only the ranges are checked here
+    assert freeze == 0 or freeze == 1, "Freeze must be 0 or 1."
+    assert len(c_coords) == 2 and 0 <= c_coords[0] < 256 and 0 <= c_coords[1] < 256, \
+        "CMan coordinates must be two integers in the range [0, 255]."
+    assert len(s_coords) == 2 and 0 <= s_coords[0] < 256 and 0 <= s_coords[1] < 256, \
+        "Spirit coordinates must be two integers in the range [0, 255]."
 
 
 def pack_game_state_update_server(state: dict) -> bytes:
@@ -69,35 +225,195 @@ def pack_game_state_update_server(state: dict) -> bytes:
     - c_coords (tuple[int, int]): CMan coordinates
     - s_coords (tuple[int, int]): Spirit coordinates
     - attempts (int): Number of attempts remaining
-    - collected (list[int]): List representing the collected points
+    - collected (bytes): The collected points bitmap
     returns:
     bytes: The packed binary representation of the game state.
     """
-    # Extract data from the state dictionary
-    freeze = state['freeze']
+    _validate_state(state)
     c_coords = state['c_coords']
     s_coords = state['s_coords']
-    attempts = state['attempts']
-    collected = state['collected']
-    # Validate inputs
-    assert isinstance(freeze, int) and 0 <= freeze <= 1, "Freeze must be 0 or 1."
-    assert len(c_coords) == 2 and all(isinstance(coord, int) and 0 <= coord < 256 for coord in c_coords), \
-        "CMan coordinates must be two integers in the range [0, 255]."
-    assert len(s_coords) == 2 and all(isinstance(coord, int) and 0 <= coord < 256 for coord in s_coords), \
-        "Spirit coordinates must be two integers in the range [0, 255]."
+    return STATE_UPDATE_CODEC.pack(
+        OPCODE.GAME_STATE_UPDATE,
+        state['freeze'],
+        c_coords[0], c_coords[1],
+        s_coords[0], s_coords[1],
+        state['attempts'],
+        state['collected']
+    )
+
 
-    # Pack the data
-    return pack_message_client(OPCODE.GAME_STATE_UPDATE, struct.pack(
-            '>BBBBBB5s',
-            freeze,
-            c_coords[0], c_coords[1],
-            s_coords[0], s_coords[1],
-            attempts,
-            collected  
-        )
+def pack_game_state_keyframe_server(seq, state: dict) -> bytes:
+    """
+    Pack a full game state tagged with its sequence number into a binary message.
+    Parameters:
+    seq (int): The sequence number of the state.
+    state (dict): The game state dictionary, see pack_game_state_update_server.
+    returns:
+    bytes: The packed binary representation of the keyframe.
+    """
+    _validate_state(state)
+    c_coords = state['c_coords']
+    s_coords = state['s_coords']
+    return KEYFRAME_CODEC.pack(
+        OPCODE.GAME_STATE_KEYFRAME, seq,
+        state['freeze'],
+        c_coords[0], c_coords[1],
+        s_coords[0], s_coords[1],
+        state['attempts'],
+        state['collected']
     )
 
 
+def _set_indices(bits, bit_count):
+    """
+    Returns:
+    list: The indices of the set bits of a bitmap, the first index being the most significant bit.
+    """
+    indices = []
+    while bits:
+        bit = (bits & -bits).bit_length() - 1  # Lowest set bit
+        indices.append(bit_count - 1 - bit)
+        bits &= bits - 1
+    indices.reverse()
+    return indices
+
+
+def pack_collected(collected: bytes, point_count) -> tuple:
+    """
+    Encodes the collected points of a V2 game state in the smallest of the COLLECTED_ENCODING.
+    A bitmap is best in mid game, the index lists at the start and the end of a game.
+    Parameters:
+    collected (bytes): The collected points bitmap, the first point being the most significant bit.
+    point_count (int): The number of points of the map.
+    Returns:
+    tuple: The COLLECTED_ENCODING and the encoded points.
+    """
+    bits = int.from_bytes(collected, 'big')
+    bit_count = len(collected) * 8
+    collected_count = bin(bits).count('1')
+    bitmap_size = len(collected)
+    if 2 + 2 * collected_count < bitmap_size and collected_count <= point_count - collected_count:
+        indices = _set_indices(bits, bit_count)
+        return COLLECTED_ENCODING.COLLECTED, struct.pack(f'>H{len(indices)}H', len(indices), *indices)
+    if 2 + 2 * (point_count - collected_count) < bitmap_size:
+        padding = bit_count - point_count
+        uncollected = ~bits & ((1 << bit_count) - 1) & ~((1 << padding) - 1)
+        indices = _set_indices(uncollected, bit_count)
+        return COLLECTED_ENCODING.UNCOLLECTED, struct.pack(f'>H{len(indices)}H', len(indices), *indices)
+    return COLLECTED_ENCODING.BITMAP, bytes(collected)
+
+
+def unpack_collected(data: bytes, offset, point_count, encoding):
+    """
+    Decodes the collected points of a V2 game state.
+    Parameters:
+    data (bytes): The binary data containing the game state.
+    offset (int): The position of the encoded points in data.
+    point_count (int): The number of points of the map.
+    encoding (int): The COLLECTED_ENCODING of the points.
+    Returns:
+    CollectedBits: The collected points.
+    Raises:
+    ValueError: If the encoding is unknown.
+    """
+    size = (point_count + 7) // 8
+    if encoding == COLLECTED_ENCODING.BITMAP:
+        return CollectedBits.from_bytes(bytes(data[offset:offset + size]))
+    if encoding not in (COLLECTED_ENCODING.COLLECTED, COLLECTED_ENCODING.UNCOLLECTED):
+        raise ValueError(f"unknown collected points encoding {encoding}.")
+    count = COUNT_CODEC.unpack_from(data, offset)[0]
+    bits = CollectedBits(0, size * 8).with_collected(struct.unpack_from(f'>{count}H', data, offset + 2))
+    if encoding == COLLECTED_ENCODING.UNCOLLECTED:
+        padding = size * 8 - point_count
+        bits = CollectedBits(~bits.value & ((1 << size * 8) - 1) & ~((1 << padding) - 1), size * 8)
+    return bits
+
+
+def pack_game_state_update_v2_server(state: dict, point_count) -> bytes:
+    """
+    Pack the game state of a map with any number of points, for clients with CAPABILITY.VARIABLE_POINTS.
+    Parameters:
+    state (dict): The game state dictionary, see pack_game_state_update_server, collected may be of any size.
+    point_count (int): The number of points of the map.
+    returns:
+    bytes: The packed binary representation of the game state.
+    """
+    _validate_state(state)
+    c_coords = state['c_coords']
+    s_coords = state['s_coords']
+    encoding, collected = pack_collected(state['collected'], point_count)
+    return STATE_UPDATE_V2_CODEC.pack(
+        OPCODE.GAME_STATE_UPDATE_V2,
+        state['freeze'],
+        c_coords[0], c_coords[1],
+        s_coords[0], s_coords[1],
+        state['attempts'],
+        point_count, encoding
+    ) + collected
+
+
+def pack_game_state_keyframe_v2_server(seq, state: dict, point_count) -> bytes:
+    """
+    Pack a full game state of a map with any number of points tagged with its sequence number.
+    Parameters:
+    seq (int): The sequence number of the state.
+    state (dict): The game state dictionary, see pack_game_state_update_v2_server.
+    point_count (int): The number of points of the map.
+    returns:
+    bytes: The packed binary representation of the keyframe.
+    """
+    _validate_state(state)
+    c_coords = state['c_coords']
+    s_coords = state['s_coords']
+    encoding, collected = pack_collected(state['collected'], point_count)
+    return KEYFRAME_V2_CODEC.pack(
+        OPCODE.GAME_STATE_KEYFRAME_V2, seq,
+        state['freeze'],
+        c_coords[0], c_coords[1],
+        s_coords[0], s_coords[1],
+        state['attempts'],
+        point_count, encoding
+    ) + collected
+
+
+def pack_game_state_delta_server(seq, base_seq, base: dict, state: dict) -> bytes:
+    """
+    Pack the fields of the game state that changed since a state the client acknowledged.
+    Parameters:
+    seq (int): The sequence number of the new state.
+    base_seq (int): The sequence number of the acknowledged state, at most 255 states older than seq.
+    base (dict): The acknowledged game state.
+    state (dict): The new game state.
+    returns:
+    bytes: The packed binary representation of the delta.
+    Raises:
+    ValueError: If points were uncollected since the base state, the client needs a keyframe then.
+    """
+    flags = 0
+    fields = []
+    if state['freeze'] != base['freeze']:
+        flags |= DELTA.FREEZE
+        fields.append(BYTE_CODEC.pack(state['freeze']))
+    if state['c_coords'] != base['c_coords']:
+        flags |= DELTA.CMAN
+        fields.append(COORDS_CODEC.pack(*state['c_coords']))
+    if state['s_coords'] != base['s_coords']:
+        flags |= DELTA.SPIRIT
+        fields.append(COORDS_CODEC.pack(*state['s_coords']))
+    if state['attempts'] != base['attempts']:
+        flags |= DELTA.ATTEMPTS
+        fields.append(BYTE_CODEC.pack(state['attempts']))
+    if state['collected'] != base['collected']:
+        old_bits = int.from_bytes(base['collected'], 'big')
+        new_bits = int.from_bytes(state['collected'], 'big')
+        if old_bits & ~new_bits:
+            raise ValueError("points were uncollected since the base state.")
+        indices = _set_indices(new_bits & ~old_bits, len(state['collected']) * 8)
+        flags |= DELTA.COLLECTED
+        fields.append(struct.pack(f'>H{len(indices)}H', len(indices), *indices))
+    return DELTA_HEADER_CODEC.pack(OPCODE.GAME_STATE_DELTA, seq, seq - base_seq, flags) + b''.join(fields)
+
+
 def pack_game_end_server(winner, s_score, c_score) -> bytes:
     """
     Pack the game end message into a binary message.
@@ -106,13 +422,19 @@ def pack_game_end_server(winner, s_score, c_score) -> bytes:
     s_score (int): The score of the Spirit player.
     c_score (int): The score of the CMan player.
     """
-    return pack_message_client(OPCODE.GAME_END, struct.pack(
-        '>BBB',
-        winner,
-        s_score,
-        c_score
-    )
-)
+    return GAME_END_CODEC.pack(OPCODE.GAME_END, winner, s_score, c_score)
+
+
+def pack_game_end_v2_server(winner, s_score, c_score) -> bytes:
+    """
+    Pack the game end message for the clients with the VARIABLE_POINTS capability, whose C-Man
+    score may not fit in a byte.
+    Parameters:
+    winner (int): The winner of the game (0 for CMan, 1 for Spirit).
+    s_score (int): The score of the Spirit player.
+    c_score (int): The score of the CMan player.
+    """
+    return GAME_END_V2_CODEC.pack(OPCODE.GAME_END_V2, winner, s_score, c_score)
 
 
 def pack_error_server(error_code) -> bytes:
@@ -121,56 +443,264 @@ def pack_error_server(error_code) -> bytes:
     Parameters:
     error_code (int): The error code to be sent.
     """
-    return pack_message_client(OPCODE.ERROR, struct.pack('>B', error_code))
+    return ERROR_CODEC.pack(OPCODE.ERROR, error_code)
 
 
-def unpack_join_user(data: bytes) -> str:
+def pack_state_ack_User(seq) -> bytes:
+    """
+    Pack the acknowledgement of the last game state the client applied.
+    Parameters:
+    seq (int): The sequence number of the applied state.
+    """
+    return STATE_ACK_CODEC.pack(OPCODE.STATE_ACK, seq)
+
+
+def pack_resync_User() -> bytes:
+    """
+    Pack a request for a full game state keyframe.
+    A client sending it is served sequenced keyframes and deltas from then on.
+    """
+    return RESYNC_MESSAGE
+
+
+def pack_heartbeat_User() -> bytes:
+    """
+    Pack a heartbeat, telling the server the client is still there while it has nothing else to send.
+    """
+    return HEARTBEAT_MESSAGE
+
+
+def pack_stats_User() -> bytes:
+    """
+    Pack a request for the server's metrics.
+    """
+    return STATS_MESSAGE
+
+
+def pack_profile_User(seconds=0) -> bytes:
+    """
+    Pack a request to profile the server loop.
+    Parameters:
+    seconds (int): The length of the profiling window, 0 for the server's default.
+    """
+    return PROFILE_CODEC.pack(OPCODE.PROFILE, seconds)
+
+
+def pack_stats_server(stats: dict) -> bytes:
+    """
+    Pack the server's metrics into a binary message.
+    Parameters:
+    stats (dict): The metrics, JSON serializable.
+    """
+    return pack_message_client(OPCODE.STATS_REPLY, json.dumps(stats).encode('utf-8'))
+
+
+# The unpack functions read the payload at the given offset, so callers can pass the whole
+# datagram (or a memoryview of it) with offset 1 instead of slicing the opcode off.
+
+def unpack_join_user(data: bytes, offset=0) -> str:
     """
     Unpack the role of the player from a binary message.
     Parameters:
     data (bytes): The binary data containing the role of the player.
+    offset (int): The position of the payload in data.
+    """
+    return bytes(data[offset:]).split(ROOM_SEPARATOR, 1)[0].decode('utf-8')
+
+
+def unpack_join_room(data: bytes, offset=0):
+    """
+    Unpack the requested room name from a join message.
+    Parameters:
+    data (bytes): The binary data containing the role of the player.
+    offset (int): The position of the payload in data.
+    Returns:
+    str: The room name, or None if the client did not ask for a specific room.
     """
-    return data.decode('utf-8')
+    parts = bytes(data[offset:]).split(ROOM_SEPARATOR, 2)
+    if len(parts) < 2 or not parts[1]:
+        return None
+    return parts[1].decode('utf-8')
 
 
-def unpack_player_movement_user(data: bytes) -> str:
+def unpack_join_capabilities(data: bytes, offset=0) -> int:
+    """
+    Unpack the capability flags of the client from a join message.
+    Parameters:
+    data (bytes): The binary data containing the join message.
+    offset (int): The position of the payload in data.
+    Returns:
+    int: The CAPABILITY flags, 0 for clients that do not send any.
+    """
+    parts = bytes(data[offset:]).split(ROOM_SEPARATOR, 2)
+    if len(parts) < 3 or not parts[2]:
+        return 0
+    return parts[2][0]
+
+
+def unpack_player_movement_user(data: bytes, offset=0) -> str:
     """
     Unpack the player movement direction from a binary message.
     Parameters:
     data (bytes): The binary data containing the player movement direction.
+    offset (int): The position of the payload in data.
     """
-    return data.decode('utf-8')
+    if len(data) == offset + 1:  # The single digit the clients send, read without slicing the datagram
+        return chr(data[offset])
+    return bytes(data[offset:]).decode('utf-8')
 
 
 
-def unpack_game_state_update_server(data: bytes) -> dict:
+def unpack_game_state_update_server(data: bytes, offset=0) -> dict:
     """
     Unpack the game state from a binary message.
     Parameters:
     data (bytes): The binary data containing the game state.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The game state, the collected points being a CollectedBits view.
+    """
+    # Unpack the binary data
+    freeze, c_x, c_y, s_x, s_y, attempts, collected_bytes = STATE_UPDATE_FIELDS.unpack_from(data, offset)
+
+    return {
+        'freeze': freeze,
+        'c_coords': (c_x, c_y),
+        's_coords': (s_x, s_y),
+        'attempts': attempts,
+        'collected': CollectedBits.from_bytes(collected_bytes)
+    }
+
+
+def unpack_game_state_keyframe_server(data: bytes, offset=0) -> dict:
+    """
+    Unpack a full game state tagged with its sequence number.
+    Parameters:
+    data (bytes): The binary data containing the keyframe.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The game state, see unpack_game_state_update_server, with an additional 'seq' key.
+    """
+    seq, freeze, c_x, c_y, s_x, s_y, attempts, collected_bytes = KEYFRAME_FIELDS.unpack_from(data, offset)
+    return {
+        'seq': seq,
+        'freeze': freeze,
+        'c_coords': (c_x, c_y),
+        's_coords': (s_x, s_y),
+        'attempts': attempts,
+        'collected': CollectedBits.from_bytes(collected_bytes)
+    }
+
+
+def unpack_game_state_update_v2_server(data: bytes, offset=0) -> dict:
+    """
+    Unpack a game state of a map with any number of points.
+    Parameters:
+    data (bytes): The binary data containing the game state.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The game state, see unpack_game_state_update_server, with an additional 'point_count' key.
     """
-    freeze, c_x, c_y, s_x, s_y, attempts, collected_bytes = struct.unpack('>BBBBBB5s', data)# Unpack the binary data
+    freeze, c_x, c_y, s_x, s_y, attempts, point_count, encoding = STATE_UPDATE_V2_FIELDS.unpack_from(data, offset)
+    return {
+        'freeze': freeze,
+        'c_coords': (c_x, c_y),
+        's_coords': (s_x, s_y),
+        'attempts': attempts,
+        'point_count': point_count,
+        'collected': unpack_collected(data, offset + STATE_UPDATE_V2_FIELDS.size, point_count, encoding)
+    }
 
-    # Convert collected_bytes into a list of 40 bits
-    collected_bits = bin(int.from_bytes(collected_bytes, 'big'))[2:].zfill(40)
-    collected = [int(bit) for bit in collected_bits]
 
+def unpack_game_state_keyframe_v2_server(data: bytes, offset=0) -> dict:
+    """
+    Unpack a full game state of a map with any number of points tagged with its sequence number.
+    Parameters:
+    data (bytes): The binary data containing the keyframe.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The game state, see unpack_game_state_update_v2_server, with an additional 'seq' key.
+    """
+    seq, freeze, c_x, c_y, s_x, s_y, attempts, point_count, encoding = KEYFRAME_V2_FIELDS.unpack_from(data, offset)
     return {
+        'seq': seq,
         'freeze': freeze,
         'c_coords': (c_x, c_y),
         's_coords': (s_x, s_y),
         'attempts': attempts,
-        'collected': collected
+        'point_count': point_count,
+        'collected': unpack_collected(data, offset + KEYFRAME_V2_FIELDS.size, point_count, encoding)
     }
 
 
-def unpack_game_end_server(data: bytes) -> dict:
+def unpack_game_state_delta_server(data: bytes, offset=0) -> dict:
+    """
+    Unpack a game state delta.
+    Parameters:
+    data (bytes): The binary data containing the delta.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The 'seq' and 'base_seq' of the delta and the changed fields, newly collected points
+          are listed by index under 'collected_indices'.
+    """
+    seq, distance, flags = DELTA_HEADER_FIELDS.unpack_from(data, offset)
+    offset += DELTA_HEADER_FIELDS.size
+    delta = {'seq': seq, 'base_seq': seq - distance}
+    if flags & DELTA.FREEZE:
+        delta['freeze'] = data[offset]
+        offset += 1
+    if flags & DELTA.CMAN:
+        delta['c_coords'] = COORDS_CODEC.unpack_from(data, offset)
+        offset += 2
+    if flags & DELTA.SPIRIT:
+        delta['s_coords'] = COORDS_CODEC.unpack_from(data, offset)
+        offset += 2
+    if flags & DELTA.ATTEMPTS:
+        delta['attempts'] = data[offset]
+        offset += 1
+    if flags & DELTA.COLLECTED:
+        count = COUNT_CODEC.unpack_from(data, offset)[0]
+        delta['collected_indices'] = struct.unpack_from(f'>{count}H', data, offset + 2)
+    return delta
+
+
+def apply_game_state_delta(base: dict, delta: dict) -> dict:
+    """
+    Apply an unpacked delta to the unpacked state it was computed against.
+    Parameters:
+    base (dict): The base game state.
+    delta (dict): The unpacked delta.
+    Returns:
+    dict: The new game state, tagged with the delta's 'seq'.
+    """
+    state = dict(base)
+    for key in ('freeze', 'c_coords', 's_coords', 'attempts'):
+        if key in delta:
+            state[key] = delta[key]
+    if delta.get('collected_indices'):
+        state['collected'] = base['collected'].with_collected(delta['collected_indices'])
+    state['seq'] = delta['seq']
+    return state
+
+
+def unpack_state_ack_user(data: bytes, offset=0) -> int:
+    """
+    Unpack the sequence number acknowledged by a client.
+    Parameters:
+    data (bytes): The binary data containing the acknowledgement.
+    offset (int): The position of the payload in data.
+    """
+    return STATE_ACK_FIELDS.unpack_from(data, offset)[0]
+
+
+def unpack_game_end_server(data: bytes, offset=0) -> dict:
     """
     Unpack the game end message from a binary message.
     Parameters:
     data (bytes): The binary data containing the game end message.
+    offset (int): The position of the payload in data.
     """
-    winner, s_score, c_score = struct.unpack('>BBB', data)
+    winner, s_score, c_score = GAME_END_FIELDS.unpack_from(data, offset)
     return {
         'winner': winner,
         's_score': s_score,
@@ -178,12 +708,48 @@ def unpack_game_end_server(data: bytes) -> dict:
     }
 
 
-def unpack_error_server(data: bytes) -> int:
+def unpack_game_end_v2_server(data: bytes, offset=0) -> dict:
+    """
+    Unpack the V2 game end message from a binary message.
+    Parameters:
+    data (bytes): The binary data containing the game end message.
+    offset (int): The position of the payload in data.
+    Returns:
+    dict: The game end, see unpack_game_end_server.
+    """
+    winner, s_score, c_score = GAME_END_V2_FIELDS.unpack_from(data, offset)
+    return {
+        'winner': winner,
+        's_score': s_score,
+        'c_score': c_score
+    }
+
+
+def unpack_error_server(data: bytes, offset=0) -> int:
     """
     Unpack the error message from a binary message.
     Parameters:
     data (bytes): The binary data containing the error message.
+    offset (int): The position of the payload in data.
+    """
+    return BYTE_CODEC.unpack_from(data, offset)[0]
+
+
+def unpack_stats_server(data: bytes, offset=0) -> dict:
     """
-    return struct.unpack('>B', data)[0]
+    Unpack the server's metrics from a binary message.
+    Parameters:
+    data (bytes): The binary data containing the metrics.
+    offset (int): The position of the payload in data.
+    """
+    return json.loads(bytes(data[offset:]).decode('utf-8'))
 
 
+def unpack_profile_user(data: bytes, offset=0) -> int:
+    """
+    Unpack the length of the requested profiling window.
+    Parameters:
+    data (bytes): The binary data containing the request.
+    offset (int): The position of the payload in data.
+    """
+    return COUNT_CODEC.unpack_from(data, offset)[0]
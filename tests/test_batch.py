@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip('numpy')
+import cman_batch as cbt  # noqa: E402
+
+MAP_PATH = os.path.join(ROOT, 'map.txt')
+
+
+def test_batch_matches_game():
+    result = cbt.cross_check(MAP_PATH, size=32, steps=300)
+    assert result['mismatches'] == 0
+    # Both ends of a game are compared, not only the moves in between
+    assert result['cman_wins'] > 0
+    assert result['spirit_wins'] > 0
+
+
+def test_cross_check_detects_a_diverging_batch(monkeypatch):
+    init = cbt.BatchGame.__init__
+
+    def init_with_lower_win_score(self, map_path, size):
+        init(self, map_path, size)
+        self.win_score -= 1
+
+    monkeypatch.setattr(cbt.BatchGame, '__init__', init_with_lower_win_score)
+    assert cbt.cross_check(MAP_PATH, size=32, steps=300)['mismatches'] > 0
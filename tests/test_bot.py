@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cman_bot as cb  # noqa: E402
+import cman_game_map as gm  # noqa: E402
+
+MAP_PATH = os.path.join(ROOT, 'map.txt')
+
+
+def test_maps_above_the_walkable_cell_limit_are_refused(monkeypatch):
+    compiled_map = gm.load_map(MAP_PATH)
+    size = cb.NextHopTable(compiled_map).size
+    monkeypatch.setattr(cb, 'MAX_WALKABLE_CELLS', size - 1)
+    with pytest.raises(ValueError, match=f"this map has {size}"):
+        cb.NextHopTable(compiled_map)
@@ -0,0 +1,44 @@
+import io
+import os
+import select
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cman_utils as cu  # noqa: E402
+
+KEYS = ['w', 'a', 's', 'd', 'q']
+
+
+def read_keys(source, count, timeout=2):
+    """
+    Waits on the source's file descriptor, like the client's game loop, until count keys were read.
+    """
+    keys = []
+    deadline = time.monotonic() + timeout
+    while len(keys) < count and time.monotonic() < deadline:
+        readable, _, _ = select.select([source], [], [], deadline - time.monotonic())
+        if readable:
+            keys += source.get_keys()
+    return keys
+
+
+def test_stream_input_reports_filtered_characters_in_order():
+    source = cu.StreamInput(KEYS, io.StringIO("w x a\nd\n\nq")).start()
+    assert read_keys(source, 4) == ['w', 'a', 'd', 'q']
+    assert source.get_keys() == []
+    source.stop()
+
+
+def test_scripted_input_replays_keys_and_waits(tmp_path):
+    script = tmp_path / 'moves.txt'
+    script.write_text("w w\nwait 0.2\nd z\n")
+    source = cu.open_input(str(script), KEYS)
+    assert isinstance(source, cu.ScriptedInput)
+    assert read_keys(source, 2) == ['w', 'w']
+    # The last key only comes after the wait
+    assert source.get_keys() == []
+    assert read_keys(source, 1) == ['d']
+    source.stop()
@@ -0,0 +1,30 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cman_journal as cj  # noqa: E402
+
+
+def test_journal_cut_anywhere_is_read_up_to_the_cut(tmp_path):
+    journal = cj.Journal(str(tmp_path / 'journal.bin'))
+    room_id = journal.open_room('room-1', 'map.txt')
+    journal.record(room_id, cj.RECORD_KIND.NEXT_ROUND)
+    journal.record_move(room_id, 0, 1)
+    journal.record(room_id, cj.RECORD_KIND.GAME_END, 0, 300, 2)
+    journal.record(room_id, cj.RECORD_KIND.CLOSE)
+    journal.close()
+    with open(journal.path, 'rb') as f:
+        data = f.read()
+
+    records = list(cj.read_records(data))
+    assert [record[0] for record in records] == [
+        cj.RECORD_KIND.ROOM, cj.RECORD_KIND.NEXT_ROUND, cj.RECORD_KIND.MOVE,
+        cj.RECORD_KIND.GAME_END, cj.RECORD_KIND.CLOSE]
+    assert records[0][3:] == ('room-1', 'map.txt')
+    assert records[3][3:] == (0, 300, 2)
+
+    for size in range(cj.HEADER.size, len(data)):
+        cut = list(cj.read_records(data[:size]))
+        assert cut == records[:len(cut)]
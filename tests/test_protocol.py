@@ -0,0 +1,129 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import shared_libary as sl  # noqa: E402
+
+BASE = {
+    'freeze': 1,
+    'c_coords': (3, 4),
+    's_coords': (9, 1),
+    'attempts': 3,
+    'collected': bytes([0b10000000, 0, 0, 0, 0b00000001])
+}
+
+
+def unpacked(state, seq):
+    return sl.unpack_game_state_keyframe_server(sl.pack_game_state_keyframe_server(seq, state), 1)
+
+
+def round_trip(base, state, seq=12, base_seq=10):
+    message = sl.pack_game_state_delta_server(seq, base_seq, base, state)
+    assert message[0] == sl.OPCODE.GAME_STATE_DELTA
+    delta = sl.unpack_game_state_delta_server(message, 1)
+    assert delta['seq'] == seq
+    assert delta['base_seq'] == base_seq
+    return message, sl.apply_game_state_delta(unpacked(base, base_seq), delta)
+
+
+def test_unchanged_state_is_a_bare_header():
+    message, state = round_trip(BASE, dict(BASE))
+    assert len(message) == sl.DELTA_HEADER_CODEC.size
+    assert state == unpacked(BASE, 12)
+
+
+@pytest.mark.parametrize('changes, flag', [
+    ({'freeze': 0}, sl.DELTA.FREEZE),
+    ({'c_coords': (4, 4)}, sl.DELTA.CMAN),
+    ({'s_coords': (9, 2)}, sl.DELTA.SPIRIT),
+    ({'attempts': 2}, sl.DELTA.ATTEMPTS),
+    ({'collected': bytes([0b11000000, 0, 0, 0, 0b00000001])}, sl.DELTA.COLLECTED),
+])
+def test_each_field_round_trips(changes, flag):
+    message, state = round_trip(BASE, dict(BASE, **changes))
+    assert message[sl.DELTA_HEADER_CODEC.size - 1] == flag
+    assert state == unpacked(dict(BASE, **changes), 12)
+
+
+def test_all_fields_round_trip():
+    new = {
+        'freeze': 0,
+        'c_coords': (5, 6),
+        's_coords': (7, 8),
+        'attempts': 1,
+        'collected': bytes([0b11110000, 0, 0b1, 0, 0b00000011])
+    }
+    message, state = round_trip(BASE, new, seq=300, base_seq=45)
+    assert message[sl.DELTA_HEADER_CODEC.size - 1] == (
+        sl.DELTA.FREEZE | sl.DELTA.CMAN | sl.DELTA.SPIRIT | sl.DELTA.ATTEMPTS | sl.DELTA.COLLECTED)
+    assert state == unpacked(new, 300)
+
+
+def test_newly_collected_points_are_sent_by_index():
+    new = dict(BASE, collected=bytes([0b10100000, 0, 0, 0, 0b00000011]))
+    delta = sl.unpack_game_state_delta_server(sl.pack_game_state_delta_server(2, 1, BASE, new), 1)
+    assert delta['collected_indices'] == (2, 38)
+
+
+def test_uncollected_points_need_a_keyframe():
+    new = dict(BASE, collected=bytes(5))
+    with pytest.raises(ValueError):
+        sl.pack_game_state_delta_server(2, 1, BASE, new)
+
+
+def bitmap(point_count, collected):
+    bits = 0
+    for index in collected:
+        bits |= 1 << ((point_count + 7) // 8 * 8 - 1 - index)
+    return bits.to_bytes((point_count + 7) // 8, 'big')
+
+
+@pytest.mark.parametrize('collected, encoding', [
+    ([], sl.COLLECTED_ENCODING.COLLECTED),
+    ([0, 17, 299], sl.COLLECTED_ENCODING.COLLECTED),
+    (range(0, 300, 2), sl.COLLECTED_ENCODING.BITMAP),
+    ([index for index in range(300) if index != 5], sl.COLLECTED_ENCODING.UNCOLLECTED),
+    (range(300), sl.COLLECTED_ENCODING.UNCOLLECTED),
+])
+def test_collected_points_use_the_smallest_encoding(collected, encoding):
+    data = bitmap(300, collected)
+    chosen, packed = sl.pack_collected(data, 300)
+    assert chosen == encoding
+    assert len(packed) <= len(data)
+    assert sl.unpack_collected(packed, 0, 300, chosen) == sl.CollectedBits.from_bytes(data)
+
+
+def test_unknown_collected_encoding_is_refused():
+    with pytest.raises(ValueError):
+        sl.unpack_collected(b'\x00\x00', 0, 300, 0x7F)
+
+
+def test_v2_keyframe_round_trips():
+    state = dict(BASE, collected=bitmap(300, [1, 250]))
+    unpacked_state = sl.unpack_game_state_keyframe_v2_server(sl.pack_game_state_keyframe_v2_server(7, state, 300), 1)
+    assert unpacked_state['seq'] == 7
+    assert unpacked_state['point_count'] == 300
+    assert unpacked_state['collected'] == sl.CollectedBits.from_bytes(state['collected'])
+    assert unpacked_state['c_coords'] == state['c_coords']
+
+
+@pytest.mark.parametrize('role, room, capabilities', [
+    ('cman', None, 0),
+    ('spirit', 'room-1', 0),
+    ('watcher', None, sl.CAPABILITY.VARIABLE_POINTS),
+    ('cman', 'room-1', sl.CAPABILITY.VARIABLE_POINTS),
+])
+def test_join_round_trips(role, room, capabilities):
+    message = sl.pack_join_User(role, room, capabilities)
+    assert sl.unpack_join_user(message, 1) == role
+    assert sl.unpack_join_room(message, 1) == room
+    assert sl.unpack_join_capabilities(message, 1) == capabilities
+
+
+def test_game_end_v2_carries_large_scores():
+    message = sl.pack_game_end_v2_server(1, 3, 621)
+    assert message[0] == sl.OPCODE.GAME_END_V2
+    assert sl.unpack_game_end_v2_server(message, 1) == {'winner': 1, 's_score': 3, 'c_score': 621}